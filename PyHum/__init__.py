@@ -57,7 +57,7 @@ __version__ = '1.4.6'
 import matplotlib
 matplotlib.use('TKagg')
 
-from PyHum._pyhum_read import read
+from PyHum._pyhum_read import read, tail
 from PyHum._pyhum_correct import correct
 from PyHum._pyhum_rmshadows import rmshadows
 from PyHum._pyhum_map import map
@@ -55,23 +55,21 @@
 from __future__ import print_function
 from __future__ import division
 from scipy.io import savemat, loadmat
-import os, time #, sys, getopt
+import os, time, tempfile #, sys, getopt
 try:
    from Tkinter import Tk
    from tkFileDialog import askopenfilename, askdirectory
 except:
    pass
-from joblib import Parallel, delayed, cpu_count
 import PyHum.io as io
 
 #numerical
 import numpy as np
 import PyHum.utils as humutils
-import PyHum.ppdrc as ppdrc
+import PyHum.ppdrc_fast as ppdrc
 
 from scipy.special import jv
 from scipy.ndimage.filters import median_filter
-from skimage.restoration import denoise_tv_chambolle
 
 #plotting
 import matplotlib.pyplot as plt
@@ -84,13 +82,15 @@ np.seterr(invalid='ignore')
 import warnings
 warnings.filterwarnings("ignore")
 
+# range independent parts of the beam pattern, by instrument (see get_beam_pattern)
+beam_patterns = {}
 
 # =========================================================
 # =============== begin program ======================
 # ========================================================
 
 #################################################
-def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp, salinity, dconcfile):
+def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp, salinity, dconcfile, writeall=0, stage_cache=None):
 
     '''
     Remove water column and carry out some rudimentary radiometric corrections, 
@@ -98,7 +98,7 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
 
     Syntax
     ----------
-    [] = PyHum.correct(humfile, sonpath, maxW, doplot, correct_withwater, ph, temp, salinity, dconcfile)
+    [] = PyHum.correct(humfile, sonpath, maxW, doplot, correct_withwater, ph, temp, salinity, dconcfile, writeall, stage_cache)
 
     Parameters
     ----------
@@ -137,6 +137,13 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
        30 1700 2200
        100 15 2650
 
+    writeall : int, *optional* [Default=0]
+       1 = also write the incidence angle and transmission losses of each sample
+       (which are only used internally)
+    stage_cache : int, *optional* [Default=None]
+       if 1, nothing is done if the inputs and parameters are unchanged since
+       the last run, 0 = always run. None = as PyHum.io.STAGE_CACHE
+
     Returns
     -------
     sonpath+base+'_data_star_l.dat': memory-mapped file
@@ -157,6 +164,14 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
         contains the cosine of the range which is used to correct
         for attenuation with range
 
+    if writeall == 1:
+
+       sonpath+base+'_data_incidentangle.dat': memory-mapped file
+           contains the incidence angle of each sample
+
+       sonpath+base+'_data_TL.dat': memory-mapped file
+           contains the transmission losses of each sample
+
     sonpath+base+'_data_dwnlow_l.dat': memory-mapped file
         contains the low freq. downward scan with water column removed
 
@@ -235,6 +250,11 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
        temp = np.asarray(temp,float)
        print('Temperature is %s' % (str(temp)))
 
+    if writeall:
+       writeall = int(writeall)
+       if writeall==1:
+          print("Incidence angles and transmission losses will be written to file")
+
     if dconcfile is not None:
        try:
           print('Suspended sediment size/conc. file is %s' % (dconcfile))
@@ -265,6 +285,13 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
     # add wattage to metadata dict 
     meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
 
+    inputs = [base+f for f in ['_data_port.dat', '_data_star.dat', '_data_dwnlow.dat', '_data_dwnhi.dat', '_data_port2.dat', '_data_star2.dat', '_data_dwnlow2.dat', '_data_dwnhi2.dat']]
+    if dconcfile is not None and os.path.isfile(dconcfile):
+       inputs.append(os.path.abspath(dconcfile))
+    stage_hash, done = io.get_stage(sonpath, base, 'correct', {'maxW': maxW, 'doplot': doplot, 'dofilt': dofilt, 'correct_withwater': correct_withwater, 'ph': ph, 'temp': temp, 'salinity': salinity, 'writeall': writeall}, inputs, meta, skip=['maxW'], cache=stage_cache)
+    if done:
+       return
+
     dep_m = meta['dep_m'][0]
     pix_m = meta['pix_m'][0]
 
@@ -285,22 +312,13 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
        alpha = 0
 
     # load memory mapped scans
-    shape_port = np.squeeze(meta['shape_port'])
-    if shape_port!='':
-       
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_port2.dat'))):
-          port_fp = io.get_mmap_data(sonpath, base, '_data_port2.dat', 'int16', tuple(shape_port))
+    port = io.get_mmap_latest(sonpath, base, ['_data_port2.dat', '_data_port.dat'], 'int16')
+    if port is not None:
+       port_fp, shape_port = port
 
-       else:
-          port_fp = io.get_mmap_data(sonpath, base, '_data_port.dat', 'int16', tuple(shape_port))       
-
-    shape_star = np.squeeze(meta['shape_star'])
-    if shape_star!='':
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_star2.dat'))):
-          star_fp = io.get_mmap_data(sonpath, base, '_data_star2.dat', 'int16', tuple(shape_star))       
-
-       else:
-          star_fp = io.get_mmap_data(sonpath, base, '_data_star.dat', 'int16', tuple(shape_star))        
+    star = io.get_mmap_latest(sonpath, base, ['_data_star2.dat', '_data_star.dat'], 'int16')
+    if star is not None:
+       star_fp, shape_star = star
 
     if len(shape_star)==2:
        extent = shape_star[0] 
@@ -309,130 +327,66 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
 
     bed = np.asarray(bed,'int')+int(0.25*ft)
 
-    # calculate in dB
-    ######### star
-    Zt, R, A = remove_water(star_fp, bed, shape_star, dep_m, pix_m, 1,  maxW)
-
-    Zt = np.squeeze(Zt)
-    
-    # create memory mapped file for Z)
-    shape_star = io.set_mmap_data(sonpath, base, '_data_star_l.dat', 'float32', Zt)    
-    del Zt
-    
-    A = np.squeeze(A)
-    # create memory mapped file for A
-    shape_A = io.set_mmap_data(sonpath, base, '_data_incidentangle.dat', 'float32', A)         
-    del A
-
-    R = np.squeeze(R)
-    R[np.isnan(R)] = 0
-
-    try:
-       alpha_w = water_atten(R,meta['f'],meta['c'], ph, temp, salinity)
-    except:
-       alpha_w = 1e-5
-
-    # compute transmission losses
-    TL = (40 * np.log10(R) + alpha_w + (2*alpha)*R/1000)/255
-    del alpha_w
-
-    # create memory mapped file for R
-    shape_R = io.set_mmap_data(sonpath, base, '_data_range.dat', 'float32', R)  
-    del R 
-    
-    TL[np.isnan(TL)] = 0
-    TL[TL<0] = 0
-    shape_TL = io.set_mmap_data(sonpath, base, '_data_TL.dat', 'float32', TL)     
-    del TL      
-
-    A_fp = io.get_mmap_data(sonpath, base, '_data_incidentangle.dat', 'float32', shape_star)
-    TL_fp = io.get_mmap_data(sonpath, base, '_data_TL.dat', 'float32', shape_star)
-
-    R_fp = io.get_mmap_data(sonpath, base, '_data_range.dat', 'float32', shape_star)
-        
-    if correct_withwater == 1:
-       Zt = correct_scans(star_fp, A_fp, TL_fp, dofilt)
-
-       # create memory mapped file for Z)
-       shape_star = io.set_mmap_data(sonpath, base, '_data_star_lw.dat', 'float32', Zt)       
-
-    #we are only going to access the portion of memory required
-    star_fp = io.get_mmap_data(sonpath, base, '_data_star_l.dat', 'float32', shape_star)     
-
-    ##Zt = correct_scans(star_fp, A_fp, TL_fp, dofilt)
- 
     #phi=1.69
-    alpha=59 # vertical beam width at 3db
+    beam=59 # vertical beam width at 3db
     theta=35 #opening angle theta 
-    
-    # lambertian correction
-    Zt = correct_scans_lambertian(star_fp, A_fp, TL_fp, R_fp, meta['c'], meta['f'], theta, alpha)
-    
-    Zt = np.squeeze(Zt)
 
-    avg = np.nanmedian(Zt,axis=0)
+    # water column removal, geometry, attenuation and radiometric corrections
+    # are done together on each chunk of raw scans (see correct_chunk),
+    # and each output is written as soon as it is made
+    if writeall!=1: # remove any left from an earlier run
+       io.del_mmap_data(sonpath, base, '_data_incidentangle.dat')
+       io.del_mmap_data(sonpath, base, '_data_TL.dat')
+
+    ######### star
+    io.map_chunks(correct_chunk, [get_spec(star_fp)], 
+       make_outputs(sonpath, base, ['_data_star_l.dat', '_data_range.dat', 
+                                    '_data_incidentangle.dat' if writeall==1 else None, 
+                                    '_data_TL.dat' if writeall==1 else None, 
+                                    '_data_star_lw.dat' if correct_withwater==1 else None, 
+                                    '_data_star_la.dat'], np.shape(star_fp)), 
+       get_chunkargs(np.shape(star_fp), bed, dep_m, (pix_m, maxW, meta['f'], meta['c'], ph, temp, salinity, alpha, dofilt, correct_withwater, theta, beam)))
+    shape_star = np.shape(star_fp)
+
+    st = io.open_store(sonpath, base, '_data_star_la.dat', mode='r+')
+    avg = nanmedian_store(st)
     ##avg = median_filter(avg,int(len(avg)/10))
     
-    Zt2 = Zt-avg + np.nanmean(avg)
-    Zt2 = Zt2 + np.abs(np.nanmin(Zt2))
-
-    try:
-       Zt2 = median_filter(Zt2, (3,3))
-    except:
-       pass
+    # Zt-avg + np.nanmean(avg), shifted to be positive and smoothed, in place
+    level_store(st, avg, 1)
+    st.close()
+    del st
 
     ##Zt2 = np.empty(np.shape(Zt)) 
     ##for kk in range(np.shape(Zt)[1]):
     ##   Zt2[:,kk] = (Zt[:,kk] - avg) + np.nanmean(avg)
     ##Zt2[Zt<=0] = np.nan
     ##Zt2[Zt2<=0] = np.nan    
-    del Zt
-    
-    # create memory mapped file for Z
-    shape_star = io.set_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', Zt2)
-    del Zt2    
     
     #we are only going to access the portion of memory required
     star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', shape_star) 
 
     ######### port
-    if correct_withwater == 1:
-       Zt = correct_scans(port_fp, A_fp, TL, dofilt)
-
-       # create memory mapped file for Z)
-       shape_port = io.set_mmap_data(sonpath, base, '_data_port_lw.dat', 'float32', Zt)        
-
-    Zt = remove_water(port_fp, bed, shape_port, dep_m, pix_m, 0,  maxW)
-
-    Zt = np.squeeze(Zt)
-    
-    # create memory mapped file for Z
-    shape_port = io.set_mmap_data(sonpath, base, '_data_port_l.dat', 'float32', Zt)       
-
-    #we are only going to access the portion of memory required
-    port_fp = io.get_mmap_data(sonpath, base, '_data_port_l.dat', 'float32', shape_port)     
-    
-    ##Zt = correct_scans(port_fp, A_fp, TL_fp, dofilt)
-    
-    # lambertian correction
-    Zt = correct_scans_lambertian(port_fp, A_fp, TL_fp, R_fp, meta['c'], meta['f'], theta, alpha)
-    
-    Zt = np.squeeze(Zt)
-    
-    Zt2 = Zt-avg + np.nanmean(avg)
-    Zt2 = Zt2 + np.abs(np.nanmin(Zt2))
+    # range, incidence angle and transmission losses are the same as starboard
+    io.map_chunks(correct_chunk, [get_spec(port_fp)], 
+       make_outputs(sonpath, base, ['_data_port_l.dat', None, None, None, 
+                                    '_data_port_lw.dat' if correct_withwater==1 else None, 
+                                    '_data_port_la.dat'], np.shape(port_fp)), 
+       get_chunkargs(np.shape(port_fp), bed, dep_m, (pix_m, maxW, meta['f'], meta['c'], ph, temp, salinity, alpha, dofilt, correct_withwater, theta, beam)))
+    shape_port = np.shape(port_fp)
+
+    # levelled with the starboard average
+    st = io.open_store(sonpath, base, '_data_port_la.dat', mode='r+')
+    level_store(st, avg, 0)
+    st.close()
+    del st
 
     ##Zt2 = np.empty(np.shape(Zt))
     ##for kk in range(np.shape(Zt)[1]):
     ##   Zt2[:,kk] = (Zt[:,kk] - avg) + np.nanmean(avg)
     ##Zt2[Zt<=0] = np.nan
     ##Zt2[Zt2<=0] = np.nan    
-    del Zt
         
-    # create memory mapped file for Z
-    shape_port = io.set_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', Zt2)       
-    del Zt2
-
     #we are only going to access the portion of memory required
     port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', shape_port) 
 
@@ -460,76 +414,23 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
 
 
     # load memory mapped scans
-    shape_low = np.squeeze(meta['shape_low'])
-    shape_hi = np.squeeze(meta['shape_hi'])
-    
-    if shape_low!='':
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_dwnlow2.dat'))):
-          try:
-             low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow2.dat', 'int16', tuple(shape_low))           
-
-          except:
-             low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow.dat', 'int16', tuple(shape_low)) 
-
-          finally:
-             low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow.dat', 'int16', tuple(shape_hi))              
-
-             #if 'shape_hi' in locals():
-             #   low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow2.dat', 'int16', tuple(shape_hi))              
-
-       else:
-
-          try:
-             low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow.dat', 'int16', tuple(shape_low))           
-
-          except:
-             if 'shape_hi' in locals():
-                low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow.dat', 'int16', tuple(shape_hi))              
-
-    shape_hi = np.squeeze(meta['shape_hi'])
-
-    if shape_hi!='':
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_dwnhi2.dat'))):
-          try:
-             hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi2.dat', 'int16', tuple(shape_hi))           
-
-          except:
-             hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi.dat', 'int16', tuple(shape_hi)) 
-
-          finally:
-             hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi.dat', 'int16', tuple(shape_low))              
-
-
-             #if 'shape_low' in locals():
-             #   hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi2.dat', 'int16', tuple(shape_low))               
-
-       else:
-          try:
-             hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi.dat', 'int16', tuple(shape_hi))            
-
-          except:
-             if 'shape_low' in locals():
-                hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi.dat', 'int16', tuple(shape_low))               
+    low = io.get_mmap_latest(sonpath, base, ['_data_dwnlow.dat'], 'int16')
+    if low is not None:
+       low_fp = low[0]
 
+    hi = io.get_mmap_latest(sonpath, base, ['_data_dwnhi.dat'], 'int16')
+    if hi is not None:
+       hi_fp = hi[0]
 
     if 'low_fp' in locals():
        ######### low
-       Zt = remove_water(low_fp, bed, shape_low, dep_m, pix_m, 0,  maxW)
-       Zt = np.squeeze(Zt)
-
-       # create memory mapped file for Z
-       shape_low = io.set_mmap_data(sonpath, base, '_data_dwnlow_l.dat', 'float32', Zt)       
-       del Zt   
+       # transmission losses are those of the sidescan, if the scans are the same size
+       io.map_chunks(correct_chunk2, [get_spec(low_fp)], 
+          make_outputs(sonpath, base, ['_data_dwnlow_l.dat', '_data_dwnlow_la.dat'], np.shape(low_fp)), 
+          get_chunkargs(np.shape(low_fp), bed, dep_m, (pix_m, maxW, meta['f'], meta['c'], ph, temp, salinity, alpha, np.shape(low_fp)==shape_star)))
+       shape_low = np.shape(low_fp)
 
        #we are only going to access the portion of memory required
-       low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow_l.dat', 'float32', shape_low)         
-       Zt = correct_scans2(low_fp, TL_fp)
-
-       # create memory mapped file for Z
-       shape_low = io.set_mmap_data(sonpath, base, '_data_dwnlow_la.dat', 'float32', Zt)    
-       del Zt    
-
-       #we are only going to access the lowion of memory required
        low_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow_la.dat', 'float32', shape_low)        
        
        if doplot==1:
@@ -541,23 +442,13 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
 
     if 'hi_fp' in locals():
        ######### hi
-       Zt = remove_water(hi_fp, bed, shape_hi, dep_m, pix_m, 0,  maxW)
-       Zt = np.squeeze(Zt)
-
-       # create memory mapped file for Z
-       shape_hi = io.set_mmap_data(sonpath, base, '_data_dwnhi_l.dat', 'float32', Zt) 
-       del Zt       
+       # transmission losses are those of the sidescan, if the scans are the same size
+       io.map_chunks(correct_chunk2, [get_spec(hi_fp)], 
+          make_outputs(sonpath, base, ['_data_dwnhi_l.dat', '_data_dwnhi_la.dat'], np.shape(hi_fp)), 
+          get_chunkargs(np.shape(hi_fp), bed, dep_m, (pix_m, maxW, meta['f'], meta['c'], ph, temp, salinity, alpha, np.shape(hi_fp)==shape_star)))
+       shape_hi = np.shape(hi_fp)
 
        #we are only going to access the portion of memory required
-       hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi_l.dat', 'float32', shape_hi)        
-
-       Zt = correct_scans2(hi_fp, TL_fp)
-
-       # create memory mapped file for Z
-       shape_hi = io.set_mmap_data(sonpath, base, '_data_dwnhi_la.dat', 'float32', Zt)     
-       del Zt  
-
-       #we are only going to access the hiion of memory required
        hi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi_la.dat', 'float32', shape_hi)        
        
        if doplot==1:
@@ -567,6 +458,8 @@ def correct(humfile, sonpath, maxW, doplot, dofilt, correct_withwater, ph, temp,
           else:
              plot_dwnhi_scans(hi_fp, dist_m, shape_hi, ft, sonpath, 0)
 
+    io.set_stage(sonpath, base, 'correct', stage_hash, [base+f for f in ['_data_star_l.dat', '_data_incidentangle.dat', '_data_range.dat', '_data_TL.dat', '_data_star_lw.dat', '_data_star_la.dat', '_data_port_lw.dat', '_data_port_l.dat', '_data_port_la.dat', '_data_dwnlow_l.dat', '_data_dwnlow_la.dat', '_data_dwnhi_l.dat', '_data_dwnhi_la.dat']])
+
     if os.name=='posix': # true if linux/mac
        elapsed = (time.time() - start)
     else: # windows
@@ -634,103 +527,179 @@ def custom_save(figdirec,root):
     plt.savefig(os.path.normpath(os.path.join(figdirec,root)),bbox_inches='tight',dpi=400)
 
 # =========================================================
-def remove_water(fp,bed,shape, dep_m, pix_m, calcR,  maxW):
-    Zt = []
-    if calcR==1:
-       R = []
-       A = []
-
-    if  len(np.shape(fp))>2:
-       for p in range(len(fp)):
-          data_dB = fp[p]*(10*np.log10(maxW)/255)
-
-          Zbed = np.squeeze(bed[shape[-1]*p:shape[-1]*(p+1)])
-
-          # shift proportionally depending on where the bed is
-          for k in range(np.shape(data_dB)[1]):
-             try:
-                data_dB[:,k] = np.r_[data_dB[Zbed[k]:,k], np.zeros( (np.shape(data_dB)[0] -  np.shape(data_dB[Zbed[k]:,k])[0] ,) )]
-             except:
-                data_dB[:,k] = np.ones(np.shape(data_dB)[0])
-
-          Zt.append(data_dB)    
-
-          if calcR ==1:
-             extent = shape[1]
-             yvec = np.linspace(pix_m,extent*pix_m,extent)
-             d = dep_m[shape[-1]*p:shape[-1]*(p+1)]
-
-             a = np.ones(np.shape(fp[p]))
-             for k in range(len(d)): 
-                a[:,k] = d[k]/yvec
-
-             r = np.ones(np.shape(fp[p]))
-             for k in range(len(d)): 
-                r[:,k] = np.sqrt(yvec**2 - d[k]**2)
-
-             # shift proportionally depending on where the bed is
-             for k in range(np.shape(r)[1]):
-                try:
-                   r[:,k] = np.r_[r[Zbed[k]:,k], np.zeros( (np.shape(r)[0] -  np.shape(r[Zbed[k]:,k])[0] ,) )]
-                   a[:,k] = np.r_[a[Zbed[k]:,k], np.zeros( (np.shape(a)[0] -  np.shape(a[Zbed[k]:,k])[0] ,) )]
-                except:
-                   r[:,k] = np.ones(np.shape(r)[0])
-                   a[:,k] = np.ones(np.shape(a)[0])
-
-             R.append(r)
-             A.append(a)
+def get_spec(fp):
+    # (sonpath, base, string, dtype, shape) of the file behind fp, for io.map_chunks
+    return ('', '', fp.filename, fp.dtype, np.shape(fp))
+
+# =========================================================
+def make_outputs(sonpath, base, strings, shape):
+    # creates the float32 files named in strings (None for results that
+    # are not wanted), and returns them as outputs for io.map_chunks
+    outputs = []
+    for string in strings:
+       if string is None:
+          outputs.append(None)
+       else:
+          io.create_store(sonpath, base, string, 'float32', shape).close()
+          outputs.append((sonpath, base, string))
+    return outputs
 
+# =========================================================
+def get_chunkargs(shape, bed, dep_m, args):
+    # (bed picks, depths, extent)+args for each chunk of scans of the given shape
+    if len(shape)>2:
+       return [(np.squeeze(bed[shape[-1]*p:shape[-1]*(p+1)]), dep_m[shape[-1]*p:shape[-1]*(p+1)], shape[1])+tuple(args) for p in range(shape[0])]
     else:
+       return [(np.squeeze(bed), dep_m, shape[0])+tuple(args)]
 
-       data_dB = fp*(10*np.log10(maxW)/255)
+# =========================================================
+def correct_chunk(fp, Zbed, d, extent, pix_m, maxW, f, c, ph, temp, salinity, alpha, dofilt, correct_withwater, theta, beam):
+    # fused radiometric correction of one chunk of raw sidescan: water column
+    # removal, slant range, incidence angle, attenuation, transmission loss, and
+    # lambertian (and, if correct_withwater==1, water column retained) corrected
+    # intensities. Returns (Zt, R, A, TL, Zw, Zla), all float32 (Zw is None
+    # if not asked for)
+    Zt, R, A, TL = rm_water_tl(fp, Zbed, d, extent, pix_m, maxW, f, c, ph, temp, salinity, alpha)
+
+    if correct_withwater == 1:
+       Zw = c_scans(fp, A, TL, dofilt)
+    else:
+       Zw = None
 
-       Zbed = np.squeeze(bed)
+    # lambertian correction
+    Zla = c_scans_lambertian(Zt, A, TL, R, c, f, theta, beam)
+    return Zt, R, A, TL, Zw, Zla
 
-       # shift proportionally depending on where the bed is
-       for k in range(np.shape(data_dB)[1]):
-          try:
-            data_dB[:,k] = np.r_[data_dB[Zbed[k]:,k], np.zeros( (np.shape(data_dB)[0] -  np.shape(data_dB[Zbed[k]:,k])[0] ,) )]
-          except:
-             data_dB[:,k] = np.ones(np.shape(data_dB)[0])
+# =========================================================
+def correct_chunk2(fp, Zbed, d, extent, pix_m, maxW, f, c, ph, temp, salinity, alpha, withtl):
+    # as correct_chunk, for one chunk of raw downward looking scans:
+    # returns (Zt, Zla), water column removed and corrected for transmission
+    # losses (if withtl, otherwise not)
+    if withtl:
+       Zt, R, A, TL = rm_water_tl(fp, Zbed, d, extent, pix_m, maxW, f, c, ph, temp, salinity, alpha)
+       del R, A
+    else:
+       Zt = np.asarray(rm_water(fp, Zbed, d, extent, pix_m, 0,  maxW), 'float32')
+       TL = None
+    return Zt, c_scans2(Zt, TL)
+
+# =========================================================
+def rm_water_tl(fp, Zbed, d, extent, pix_m, maxW, f, c, ph, temp, salinity, alpha):
+    # water column removal, slant range, incidence angle and transmission losses
+    # (for water attenuation at f, c, ph, temp and salinity, and sediment
+    # attenuation alpha) of one chunk, as float32
+    Zt, R, A = rm_water(fp, Zbed, d, extent, pix_m, 1,  maxW)
+
+    R[np.isnan(R)] = 0
+
+    try:
+       alpha_w = water_atten(R, f, c, ph, temp, salinity)
+    except:
+       alpha_w = 1e-5
 
-       Zt.append(data_dB)    
+    # compute transmission losses
+    TL = (40 * np.log10(R) + alpha_w + (2*alpha)*R/1000)/255
+    del alpha_w
+
+    TL[np.isnan(TL)] = 0
+    TL[TL<0] = 0
+    return np.asarray(Zt, 'float32'), np.asarray(R, 'float32'), np.asarray(A, 'float32'), np.asarray(TL, 'float32')
 
-       if calcR ==1:
-          extent = shape[0]
-          yvec = np.linspace(pix_m,extent*pix_m,extent)
-          d = dep_m
+# =========================================================
+def rm_water(fp, Zbed, d, extent, pix_m, calcR,  maxW):
+    data_dB = fp*(10*np.log10(maxW)/255)
 
-          a = np.ones(np.shape(fp))
-          for k in range(len(d)): 
-             a[:,k] = d[k]/yvec
+    # shift proportionally depending on where the bed is
+    idx, invalid, nopick = get_bed_shift(np.shape(data_dB)[0], Zbed, np.shape(data_dB)[1])
+    data_dB = bed_shift(data_dB, idx, invalid, nopick)
 
-          r = np.ones(np.shape(fp))
-          for k in range(len(d)): 
-             r[:,k] = np.sqrt(yvec**2 - d[k]**2)
+    if calcR !=1:
+       return data_dB
 
-          # shift proportionally depending on where the bed is
-          for k in range(np.shape(r)[1]):
-             try:
-                r[:,k] = np.r_[r[Zbed[k]:,k], np.zeros( (np.shape(r)[0] -  np.shape(r[Zbed[k]:,k])[0] ,) )]
-                a[:,k] = np.r_[a[Zbed[k]:,k], np.zeros( (np.shape(a)[0] -  np.shape(a[Zbed[k]:,k])[0] ,) )]
-             except:
-                r[:,k] = np.ones(np.shape(r)[0])
-                a[:,k] = np.ones(np.shape(a)[0])
+    yvec = np.squeeze(np.linspace(pix_m,extent*pix_m,extent))
+    d = np.asarray(d)
 
-          R.append(r)
-          A.append(a)
+    a = np.ones(np.shape(fp))
+    a[:,:len(d)] = d[np.newaxis,:]/yvec[:,np.newaxis]
+
+    r = np.ones(np.shape(fp))
+    r[:,:len(d)] = np.sqrt(yvec[:,np.newaxis]**2 - d[np.newaxis,:]**2)
+
+    # shift proportionally depending on where the bed is
+    r = bed_shift(r, idx, invalid, nopick)
+    a = bed_shift(a, idx, invalid, nopick)
+
+    return data_dB, r, np.pi/2 - np.arctan(a)
 
-    if calcR ==1:
-       return Zt, R, np.pi/2 - np.arctan(A)
-    else:
-       return Zt
- 
 # =========================================================
-def correct_scans(fp, a_fp, TL, dofilt):
+def get_bed_shift(n, Zbed, ncols):
+    # indices into the flattened (n, ncols) array that shift each column up by
+    # its bed pick, as np.r_[x[Zbed[k]:,k], zeros] would (so negative picks count
+    # from the end), which of those samples fall off the end (and are zero
+    # filled), and which columns have no pick at all (and are set to ones)
+    Zbed = np.atleast_1d(Zbed) if np.ndim(Zbed)>0 else np.zeros(0, 'int')
+    m = min(ncols, len(Zbed))
+
+    nopick = np.ones(ncols, 'bool')
+    nopick[:m] = False
+    z = np.zeros(ncols, 'int64')
+    z[:m] = Zbed[:m]
+
+    start = np.where(z>=0, z, np.maximum(n+z, 0))
+    idx = np.arange(n)[:,np.newaxis] + start[np.newaxis,:]
+    invalid = idx>=n
+    idx = np.minimum(idx, n-1)*ncols + np.arange(ncols)[np.newaxis,:]
+    return idx, invalid, nopick
+
+# =========================================================
+def bed_shift(x, idx, invalid, nopick):
+    # gathers the columns of x shifted up to the bed (see get_bed_shift)
+    out = np.take(x, idx)
+    out[invalid] = 0
+    out[:,nopick] = 1
+    return out
+
+# =========================================================
+def nanmedian_store(fp, blocksize=64):
+    # np.nanmedian(fp, axis=0), taken blocksize rows at a time
+    # so that the whole of a chunked array is never in memory
     if np.ndim(fp)==2:
-       return c_scans(fp, a_fp, TL, dofilt)
-    else:
-       return Parallel(n_jobs = cpu_count(), verbose=0)(delayed(c_scans)(fp[p], a_fp[p], TL[p], dofilt) for p in range(len(fp)))
+       return np.nanmedian(np.asarray(fp[:]), axis=0)
+    if isinstance(fp, io.CompressedStore):
+       # each chunk is decompressed once, into a raw scratch array,
+       # rather than once for every block of rows
+       with tempfile.TemporaryFile() as ff:
+          tmp = np.memmap(ff, dtype=fp.dtype, mode='w+', shape=fp.shape)
+          for p in range(fp.chunks):
+             tmp[p] = fp.read_chunk(p)
+          avg = nanmedian_store(tmp, blocksize)
+          del tmp
+       return avg
+    avg = np.empty(np.shape(fp)[1:], 'float32')
+    for i in range(0, np.shape(fp)[1], blocksize):
+       avg[i:i+blocksize] = np.nanmedian(np.asarray(fp[:,i:i+blocksize]), axis=0)
+    return avg
+
+# =========================================================
+def level_store(st, avg, dofilt):
+    # subtracts avg from the corrected scans in store st, adds its mean and
+    # shifts so the minimum is zero, chunk by chunk, in place:
+    # Zt2 = Zt-avg + np.nanmean(avg); Zt2 = Zt2 + np.abs(np.nanmin(Zt2))
+    m = np.nanmean(avg)
+    mn = np.nan
+    for p in range(st.chunks):
+       mn = np.nanmin([mn, np.nanmin(st.read_chunk(p)-avg + m)])
+
+    for p in range(st.chunks):
+       Zt2 = st.read_chunk(p)-avg + m + np.abs(mn)
+       # median filtering only applies to a single (2d) chunk
+       if dofilt==1 and st.chunks==1:
+          try:
+             Zt2 = median_filter(Zt2, (3,3))
+          except:
+             pass
+       st.write_chunk(p, Zt2)
+       del Zt2
 
 # =========================================================
 def c_scans(fp, a_fp, TL, dofilt):
@@ -746,30 +715,39 @@ def c_scans(fp, a_fp, TL, dofilt):
    
 
 # =========================================================
-def correct_scans_lambertian(fp, a_fp, TL, R, c, f, theta, alpha):
-    if np.ndim(fp)==2:
-       return c_scans_lambertian(fp, a_fp, TL, R, c, f, theta, alpha)
-    else:
-       return Parallel(n_jobs = cpu_count(), verbose=0)(delayed(c_scans_lambertian)(fp[p], a_fp[p], TL[p], R[p], c, f, theta, alpha) for p in range(len(fp)))
-       
+def get_beam_pattern(c, f, theta, alpha):
+   '''
+   the beam pattern used by c_scans_lambertian is phi = (k / R**2) * b
+   where k and b depend only on sound speed c, frequency f (kHz), opening
+   angle theta and beam width alpha. They are worked out once per instrument
+   and kept for every later chunk
+   '''
+   key = (float(np.squeeze(c)), float(np.squeeze(f)), float(np.squeeze(theta)), float(np.squeeze(alpha)))
+   if key not in beam_patterns:
+      c, f, theta, alpha = key
+      lam = c/(f*1000)
+
+      #transducer radius
+      a = 0.61*lam / (np.sin(alpha/2))
+   
+      M = (f*1000)/(a**4)
+
+      beam_patterns[key] = (M*(f*1000)*a**4, (2*jv(1,(2*np.pi/lam)*a*np.sin(np.deg2rad(theta))) / (2*np.pi/lam)*a*np.sin(np.deg2rad(theta)))**2)
+   return beam_patterns[key]
+
 # =========================================================
 def c_scans_lambertian(fp, a_fp, TL, R, c, f, theta, alpha):
 
-   lam = c/(f*1000)
-   
-   Rtmp = np.deg2rad(R.copy()) ##/2
+   Rtmp = np.deg2rad(R) ##/2
    try:
       Rtmp[np.where(Rtmp==0)] = Rtmp[np.where(Rtmp!=0)[0][-1]]
    except:
       pass
       
-   #transducer radius
-   a = 0.61*lam / (np.sin(alpha/2))
-   
-   M = (f*1000)/(a**4)
-   
+   k, b = get_beam_pattern(c, f, theta, alpha)
+
    # no 'M' constant of proportionality
-   phi = ((M*(f*1000)*a**4) / Rtmp**2)*(2*jv(1,(2*np.pi/lam)*a*np.sin(np.deg2rad(theta))) / (2*np.pi/lam)*a*np.sin(np.deg2rad(theta)))**2  
+   phi = (k / Rtmp**2)*b
    
    phi = np.squeeze(phi)
    phi[phi==np.inf]=np.nan
@@ -793,17 +771,10 @@ def c_scans_lambertian(fp, a_fp, TL, R, c, f, theta, alpha):
 
    mask = np.isnan(mg)
    mg[np.isnan(mg)] = 0
-   mg = denoise_tv_chambolle(mg.copy(), weight=.2, multichannel=False).astype('float32')
+   mg = humutils.denoise_tv(mg, .2)
    mg[mask==True] = np.nan
    return mg   
 
-# =========================================================
-def correct_scans2(fp, TL):
-    if np.ndim(fp)==2:
-       return c_scans2(fp, TL)
-    else:
-       return Parallel(n_jobs = cpu_count(), verbose=0)(delayed(c_scans2)(fp[p], TL[p]) for p in range(len(fp)))
-
 # =========================================================
 def c_scans2(fp, TL):
    #nodata = fp==0
@@ -819,10 +790,10 @@ def c_scans2(fp, TL):
 
 # =========================================================
 def do_ppdrc(fp, filtsize):
-   dat = fp.astype('float64')
+   dat = fp.astype('float32')
    dat[np.isnan(dat)] = 0
    dat1 = ppdrc.ppdrc(dat, filtsize)
-   dat1 = humutils.rescale(dat1.getdata(),np.min(dat),np.max(dat))
+   dat1 = humutils.rescale(dat1,np.min(dat),np.max(dat))
    dat1[np.isnan(fp)] = np.nan
    return dat1
    
@@ -75,6 +75,7 @@ from math import log10 as log10
 from sklearn.cluster import MiniBatchKMeans
 
 import PyHum.utils as humutils #runningMeanFast, nan_helper
+import PyHum.io as io
 
 # plotting
 import matplotlib.pyplot as plt
@@ -271,19 +272,9 @@ def e1e2(humfile, sonpath, cs2cs_args, ph, temp, salinity, beam, transfreq, inte
     #del meta
 
     # load memory mapped scans
-    shape_hi= np.squeeze(meta['shape_hi'])
-    if shape_hi!='':
-       try:
-          #dwnhi_fp = np.memmap(sonpath+base+'_data_dwnhi.dat', dtype='int16', mode='r', shape=tuple(shape_hi))
-          with open(os.path.normpath(os.path.join(sonpath,base+'_data_dwnhi.dat')), 'r') as ff:
-             dwnhi_fp = np.memmap(ff, dtype='int16', mode='r', shape=tuple(shape_hi))
-
-       except:
-          shape_lo= np.squeeze(meta['shape_low'])
-          #dwnhi_fp = np.memmap(sonpath+base+'_data_dwnhi.dat', dtype='int16', mode='r', shape=tuple(shape_lo))
-          with open(os.path.normpath(os.path.join(sonpath,base+'_data_dwnhi.dat')), 'r') as ff:
-             dwnhi_fp = np.memmap(ff, dtype='int16', mode='r', shape=tuple(shape_lo))
-    
+    dwnhi = io.get_mmap_latest(sonpath, base, ['_data_dwnhi.dat'], 'int16')
+    if dwnhi is not None:
+       dwnhi_fp, shape_hi = dwnhi
 
     if 'dwnhi_fp' in locals():
 
@@ -103,14 +103,14 @@ import warnings
 warnings.filterwarnings("ignore")
 
 #################################################
-def map(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs, use_uncorrected, scalemax): #dogrid = 1, influence = 1, dowrite = 0, 
+def map(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs, use_uncorrected, scalemax, stage_cache=None): #dogrid = 1, influence = 1, dowrite = 0, 
 
     '''
     Create plots of the spatially referenced sidescan echograms
 
     Syntax
     ----------
-    [] = PyHum.map(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs)
+    [] = PyHum.map(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs, use_uncorrected, scalemax, stage_cache)
 
     Parameters
     ----------
@@ -133,6 +133,9 @@ def map(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs, use_uncorrected,
        number of nearest neighbours for gridding (used if mode > 1)
     numstdevs: int, *optional* [Default = 4]
        Threshold number of standard deviations in sidescan intensity per grid cell up to which to accept
+    stage_cache : int, *optional* [Default=None]
+       if 1, nothing is done if the inputs and parameters are unchanged since
+       the last run, 0 = always run. None = as PyHum.io.STAGE_CACHE
 
 
     Returns
@@ -214,34 +217,30 @@ def map(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs, use_uncorrected,
 
     meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
 
+    stage_hash, done = io.get_stage(sonpath, base, 'map', {'cs2cs_args': cs2cs_args, 'res': res, 'mode': mode, 'nn': nn, 'numstdevs': numstdevs, 'use_uncorrected': use_uncorrected, 'scalemax': scalemax}, [base+f for f in ['_data_port_lar.dat', '_data_port_la.dat', '_data_port_l.dat', '_data_star_lar.dat', '_data_star_la.dat', '_data_star_l.dat', '_data_range.dat']], meta, cache=stage_cache)
+    if done:
+       return
+
     esi = np.squeeze(meta['e'])
     nsi = np.squeeze(meta['n'])
 
     theta = np.squeeze(meta['heading'])/(180/np.pi)
 
     # load memory mapped scans
-    shape_port = np.squeeze(meta['shape_port'])
-    shape_star = np.squeeze(meta['shape_star'])
-
     if use_uncorrected == 1:
        print("using uncorrected scans")
-       if shape_port!='':
-          port_fp = io.get_mmap_data(sonpath, base, '_data_port_l.dat', 'float32', tuple(shape_port))
-       if shape_port!='':
-          star_fp = io.get_mmap_data(sonpath, base, '_data_star_l.dat', 'float32', tuple(shape_star))
+       port = io.get_mmap_latest(sonpath, base, ['_data_port_l.dat'], 'float32')
+       star = io.get_mmap_latest(sonpath, base, ['_data_star_l.dat'], 'float32')
 
     else:
-       if shape_port!='':
-          if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat'))):
-             port_fp = io.get_mmap_data(sonpath, base, '_data_port_lar.dat', 'float32', tuple(shape_port))
-          else:
-             port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', tuple(shape_port))
-
-       if shape_star!='':
-          if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat'))):
-             star_fp = io.get_mmap_data(sonpath, base, '_data_star_lar.dat', 'float32', tuple(shape_star))
-          else:
-             star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', tuple(shape_star))
+       port = io.get_mmap_latest(sonpath, base, ['_data_port_lar.dat', '_data_port_la.dat'], 'float32')
+       star = io.get_mmap_latest(sonpath, base, ['_data_star_lar.dat', '_data_star_la.dat'], 'float32')
+
+    if port is not None:
+       port_fp, shape_port = port
+
+    if star is not None:
+       star_fp, shape_star = star
 
     # time varying gain
     tvg = ((8.5*10**-5)+(3/76923)+((8.5*10**-5)/4))*meta['c']
@@ -291,6 +290,11 @@ def map(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs, use_uncorrected,
     else:
        res = make_map(esi, nsi, theta, dist_tvg, port_fp, star_fp, R_fp, meta['pix_m'], res, cs2cs_args, sonpath, 0, mode, nn, numstdevs, meta['c'], np.arcsin(meta['c']/(1000*meta['t']*meta['f'])), use_uncorrected, scalemax) #dogrid, influence,dowrite,
 
+    if len(shape_star)>2:
+       io.set_stage(sonpath, base, 'map', stage_hash, ['map'+str(p)+'.png' for p in range(len(star_fp))])
+    else:
+       io.set_stage(sonpath, base, 'map', stage_hash, ['map0.png'])
+
     if os.name=='posix': # true if linux/mac
        elapsed = (time.time() - start)
     else: # windows
@@ -230,19 +230,13 @@ def map_texture(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs): #influe
     theta = np.squeeze(meta['heading'])/(180/np.pi)
 
     # load memory mapped scans
-    shape_port = np.squeeze(meta['shape_port'])
-    if shape_port!='':
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat'))):
-          port_fp = io.get_mmap_data(sonpath, base, '_data_port_lar.dat', 'float32', tuple(shape_port))
-       else:
-          port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', tuple(shape_port))
+    port = io.get_mmap_latest(sonpath, base, ['_data_port_lar.dat', '_data_port_la.dat'], 'float32')
+    if port is not None:
+       port_fp, shape_port = port
 
-    shape_star = np.squeeze(meta['shape_star'])
-    if shape_star!='':
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat'))):
-             star_fp = io.get_mmap_data(sonpath, base, '_data_star_lar.dat', 'float32', tuple(shape_star))
-       else:
-          star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', tuple(shape_star))
+    star = io.get_mmap_latest(sonpath, base, ['_data_star_lar.dat', '_data_star_la.dat'], 'float32')
+    if star is not None:
+       star_fp, shape_star = star
 
     if len(shape_star)>2:    
        shape = shape_port.copy()
@@ -251,8 +245,7 @@ def map_texture(humfile, sonpath, cs2cs_args, res, mode, nn, numstdevs): #influe
        #with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'r') as ff:
        #   class_fp = np.memmap(ff, dtype='float32', mode='r', shape=tuple(shape))
     else:
-       with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'r') as ff:
-          class_fp = np.load(ff)    
+       class_fp = io.get_mmap_data(sonpath, base, '_data_class.dat', 'float32')
 
 
     tvg = ((8.5*10**-5)+(3/76923)+((8.5*10**-5)/4))*c
@@ -205,19 +205,13 @@ def mosaic_texture(humfile, sonpath, cs2cs_args = "epsg:26949", res = 99, nn = 5
     theta = np.squeeze(meta['heading'])/(180/np.pi)
 
     # load memory mapped scans
-    shape_port = np.squeeze(meta['shape_port'])
-    if shape_port!='':
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat'))):
-          port_fp = io.get_mmap_data(sonpath, base, '_data_port_lar.dat', 'float32', tuple(shape_port))
-       else:
-          port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', tuple(shape_port))
+    port = io.get_mmap_latest(sonpath, base, ['_data_port_lar.dat', '_data_port_la.dat'], 'float32')
+    if port is not None:
+       port_fp, shape_port = port
 
-    shape_star = np.squeeze(meta['shape_star'])
-    if shape_star!='':
-       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat'))):
-             star_fp = io.get_mmap_data(sonpath, base, '_data_star_lar.dat', 'float32', tuple(shape_star))
-       else:
-          star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', tuple(shape_star))
+    star = io.get_mmap_latest(sonpath, base, ['_data_star_lar.dat', '_data_star_la.dat'], 'float32')
+    if star is not None:
+       star_fp, shape_star = star
 
     # time varying gain
     tvg = ((8.5*10**-5)+(3/76923)+((8.5*10**-5)/4))*meta['c']
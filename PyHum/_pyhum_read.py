@@ -55,8 +55,8 @@
 
 #operational
 from __future__ import print_function
-import glob, sys #, getopt
-from scipy.io import savemat
+import glob, sys, json #, getopt
+from scipy.io import savemat, loadmat
 import os, time
 try:
    from Tkinter import Tk
@@ -70,6 +70,7 @@ import PyHum.io as io
 #numerical
 #import pyread
 import PyHum.pyread_single as pyread_single
+import PyHum.pyread_fast as pyread_fast
 from joblib import Parallel, delayed, cpu_count
 
 import PyHum.utils as humutils
@@ -94,7 +95,7 @@ import warnings
 warnings.filterwarnings("ignore")
 
 #################################################
-def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, model, calc_bearing, filt_bearing, chunk): #cog = 1,
+def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, model, calc_bearing, filt_bearing, chunk, writeidx=0, stage_cache=None): #cog = 1,
 
     '''
     Read a .DAT and associated set of .SON files recorded by a Humminbird(R)
@@ -109,7 +110,7 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
 
     Syntax
     ----------
-    [] = PyHum.read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, chunksize, model, calc_bearing, filt_bearing, chunk)
+    [] = PyHum.read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, chunksize, model, calc_bearing, filt_bearing, chunk, writeidx, stage_cache)
 
     Parameters
     ------------
@@ -150,6 +151,12 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
        'p' - parse chunks based on number of pings, then number which is number of pings
        'h' - parse chunks based on change in heading, then number which is the change in heading in degrees
        '1' - process just 1 chunk
+    writeidx : int, *optional* [Default=0]
+       if 1, a new .IDX file is written for any .SON file whose .IDX file
+       is absent or corrupt (packets are then found by searching the .SON file)
+    stage_cache : int, *optional* [Default=None]
+       if 1, nothing is done if the inputs and parameters are unchanged since
+       the last run, 0 = always run. None = as PyHum.io.STAGE_CACHE
 
     Returns
     ---------
@@ -304,6 +311,11 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
 #       if cog==1:
 #          print "Heading based on course-over-ground"
 
+    if writeidx:
+       writeidx = int(writeidx)
+       if writeidx==1:
+          print("Missing or corrupt .IDX files will be regenerated")
+
     if calc_bearing:
        calc_bearing = int(calc_bearing)
        if calc_bearing==1:
@@ -359,12 +371,19 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
     # remove underscores, negatives and spaces from basename
     base = humutils.strip_base(base)
 
-    print("WARNING: Because files have to be read in byte by byte,")
-    print("this could take a very long time ...")
+    stage_hash, done = io.get_stage(sonpath, base, 'read', {'cs2cs_args': cs2cs_args, 'c': c, 'draft': draft, 'doplot': doplot, 't': t, 'bedpick': bedpick, 'flip_lr': flip_lr, 'model': model, 'calc_bearing': calc_bearing, 'filt_bearing': filt_bearing, 'chunk': chunk}, [os.path.abspath(f) for f in [humfile]+sorted(sonfiles)+sorted([f.split('.SON')[0]+'.IDX' for f in sonfiles])], cache=stage_cache)
+    if done:
+       return
 
-    #reading each sonfile in parallel should be faster ...
     try:
-       o = Parallel(n_jobs = np.min([len(sonfiles), cpu_count()]), verbose=0)(delayed(getscans)(sonfiles[k], humfile, c, model, cs2cs_args) for k in range(len(sonfiles)))
+       #reading each sonfile in parallel should be faster ...
+       #... and any cpus left over split long sonfiles into ranges of pings (see pyread_fast.decode_parallel)
+       n_files = int(np.min([len(sonfiles), cpu_count()]))
+       n_jobs = int(np.max([1, cpu_count()//n_files]))
+       try: # memory-mapped reader: scans are views over the SON files, so files are read in threads and nothing is copied between processes
+          o = Parallel(n_jobs = n_files, prefer='threads', verbose=0)(delayed(getscans_mmap)(sonfiles[k], humfile, c, model, cs2cs_args, writeidx, n_jobs) for k in range(len(sonfiles)))
+       except:
+          o = Parallel(n_jobs = n_files, verbose=0)(delayed(getscans)(sonfiles[k], humfile, c, model, cs2cs_args, writeidx, n_jobs) for k in range(len(sonfiles)))
        X, Y, A, B = zip(*o)
 
        for k in range(len(Y)):
@@ -372,24 +391,24 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
              dat = A[k] #data.gethumdat()
              metadat = B[k] #data.getmetadata()
              if flip_lr==0:
-                data_port = X[k].astype('int16')
+                data_port = X[k]
              else:
-                data_star = X[k].astype('int16')
+                data_star = X[k]
 
           elif Y[k] == 'sidescan_starboard':
              if flip_lr==0:
-                data_star = X[k].astype('int16')
+                data_star = X[k]
              else:
-                data_port = X[k].astype('int16')
+                data_port = X[k]
 
           elif Y[k] == 'down_lowfreq':
-             data_dwnlow = X[k].astype('int16')
+             data_dwnlow = X[k]
 
           elif Y[k] == 'down_highfreq':
-             data_dwnhi = X[k].astype('int16')
+             data_dwnhi = X[k]
 
           elif Y[k] == 'down_vhighfreq': #hopefully this only applies to mega systems
-             data_dwnhi = X[k].astype('int16')
+             data_dwnhi = X[k]
 
        del X, Y, A, B, o
        old_pyread = 0
@@ -474,21 +493,19 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
        # port scan
        try:
           if flip_lr==0:
-             data_port = data.getportscans().astype('int16')
+             data_port = data.getportscans().T
           else:
-             data_port = data.getstarscans().astype('int16')
+             data_port = data.getstarscans().T
        except:
           data_port = ''
           print("portside scan not available")
 
-    if data_port!='':
+    if len(data_port)>0:
 
-       Zt, ind_port = makechunks_scan(chunkmode, chunkval, metadat, data_port, 0)
+       # scans are written straight into the memory mapped file
+       shape_port, ind_port = makechunks_scan(chunkmode, chunkval, metadat, data_port, 0, sonpath, base, '_data_port.dat')
        del data_port
 
-       ## create memory mapped file for Z
-       shape_port = io.set_mmap_data(sonpath, base, '_data_port.dat', 'int16', Zt)
-
        ##we are only going to access the portion of memory required
        port_fp = io.get_mmap_data(sonpath, base, '_data_port.dat', 'int16', shape_port)
 
@@ -496,21 +513,19 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
        # starboard scan
        try:
           if flip_lr==0:
-             data_star = data.getstarscans().astype('int16')
+             data_star = data.getstarscans().T
           else:
-             data_star = data.getportscans().astype('int16')
+             data_star = data.getportscans().T
        except:
           data_star = ''
           print("starboardside scan not available")
 
-    if data_star!='':
+    if len(data_star)>0:
 
-       Zt, ind_star = makechunks_scan(chunkmode, chunkval, metadat, data_star, 1)
+       # scans are written straight into the memory mapped file
+       shape_star, ind_star = makechunks_scan(chunkmode, chunkval, metadat, data_star, 1, sonpath, base, '_data_star.dat')
        del data_star
 
-       # create memory mapped file for Z
-       shape_star = io.set_mmap_data(sonpath, base, '_data_star.dat', 'int16', Zt)
-
        star_fp = io.get_mmap_data(sonpath, base, '_data_star.dat', 'int16', shape_star)
 
     if 'star_fp' in locals() and 'port_fp' in locals():
@@ -559,38 +574,34 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
     if old_pyread == 1: #older pyread version
        # low-freq. sonar
        try:
-          data_dwnlow = data.getlowscans().astype('int16')
+          data_dwnlow = data.getlowscans().T
        except:
           data_dwnlow = ''
           print("low-freq. scan not available")
 
-    if data_dwnlow!='':
+    if len(data_dwnlow)>0:
 
-       Zt, ind_low = makechunks_scan(chunkmode, chunkval, metadat, data_dwnlow, 2)
+       # scans are written straight into the memory mapped file
+       shape_low, ind_low = makechunks_scan(chunkmode, chunkval, metadat, data_dwnlow, 2, sonpath, base, '_data_dwnlow.dat')
        del data_dwnlow
 
-       # create memory mapped file for Z
-       shape_low = io.set_mmap_data(sonpath, base, '_data_dwnlow.dat', 'int16', Zt)
-
        ##we are only going to access the portion of memory required
        dwnlow_fp = io.get_mmap_data(sonpath, base, '_data_dwnlow.dat', 'int16', shape_low)
 
     if old_pyread == 1: #older pyread version
        # hi-freq. sonar
        try:
-          data_dwnhi = data.gethiscans().astype('int16')
+          data_dwnhi = data.gethiscans().T
        except:
           data_dwnhi = ''
           print("high-freq. scan not available")
 
-    if data_dwnhi!='':
+    if len(data_dwnhi)>0:
 
-       Zt, ind_hi = makechunks_scan(chunkmode, chunkval, metadat, data_dwnhi, 3)
+       # scans are written straight into the memory mapped file
+       shape_hi, ind_hi = makechunks_scan(chunkmode, chunkval, metadat, data_dwnhi, 3, sonpath, base, '_data_dwnhi.dat')
        del data_dwnhi
 
-       # create memory mapped file for Z
-       shape_hi = io.set_mmap_data(sonpath, base, '_data_dwnhi.dat', 'int16', Zt)
-
        dwnhi_fp = io.get_mmap_data(sonpath, base, '_data_dwnhi.dat', 'int16', shape_hi)
 
     if 'dwnhi_fp' in locals() and 'dwnlow_fp' in locals():
@@ -843,6 +854,8 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
 
           plot_dwnhi(dwnhi_fp, chunkmode, sonpath)
 
+    io.set_stage(sonpath, base, 'read', stage_hash, [base+f for f in ['_data_port.dat', '_data_star.dat', '_data_dwnlow.dat', '_data_dwnhi.dat', '_data_port2.dat', '_data_star2.dat', '_data_dwnlow2.dat', '_data_dwnhi2.dat', 'meta.mat', 'rawdat.csv']])
+
     if os.name=='posix': # true if linux/mac
        elapsed = (time.time() - start)
     else: # windows
@@ -854,11 +867,372 @@ def read(humfile, sonpath, cs2cs_args, c, draft, doplot, t, bedpick, flip_lr, mo
 
 
 # =========================================================
-def getscans(sonfile, humfile, c, model, cs2cs_args):
+def tail(humfile, sonpath, cs2cs_args="epsg:26949", c=1450.0, model=998, flip_lr=0, poll=5, timeout=60, t=0.108, chunk=1000, doplot=1):
+
+    '''
+    Follow a survey that is still being recorded by a Humminbird(R)
+    instrument.
+
+    Every poll seconds, only the packets appended to the .SON files since
+    the last check are decoded. Their scans are appended, a chunk at a time,
+    to the memory mapped files written by PyHum.read (or started here if
+    there are none), and their metadata to meta.mat and rawdat.csv, so the
+    other stages can be run on the survey so far at any time. The kml boat
+    trackline and the plots of the new chunks are refreshed as data arrive.
+
+    The byte offset in each .SON file of the first ping not yet in the scans
+    is kept in a file, so that following can be stopped and resumed
+
+    Syntax
+    ----------
+    [] = PyHum.tail(humfile, sonpath, cs2cs_args, c, model, flip_lr, poll, timeout, t, chunk, doplot)
+
+    Parameters
+    ------------
+    humfile : str
+       path to the .DAT file
+    sonpath : str
+       path where the *.SON files are
+    cs2cs_args : int, *optional* [Default="epsg:26949"]
+       arguments to create coordinates in a projected coordinate system
+    c : float, *optional* [Default=1450.0]
+       speed of sound in water (m/s). Defaults to a value of freshwater
+    model: int, *optional* [Default=998]
+       A 3 or 4 number code indicating the model number
+    flip_lr : int, *optional* [Default=0]
+       if 1, port and starboard scans will be flipped
+    poll : float, *optional* [Default=5]
+       time between checks for new packets (s)
+    timeout : float, *optional* [Default=60]
+       stop once no new packets have arrived for this long (s)
+    t : float, *optional* [Default=0.108]
+       length of transducer, used if there is no meta.mat yet
+    chunk : int, *optional* [Default=1000]
+       pings per chunk, for scans that have not been read yet, or that were
+       read as one 2d array (chunkmode 4), which are widened this many pings
+       at a time. Otherwise pings are appended in chunks as long as those
+       already written
+    doplot : int, *optional* [Default=1]
+       if 1, plots of each new chunk are made
+
+    Returns
+    ---------
+    sonpath+base+'_data_port.dat': int16 file
+        port sidescan scans with new chunks appended (or '_data_port2.dat',
+        if that is what PyHum.read left). Likewise '_data_star.dat',
+        '_data_dwnhi.dat' and '_data_dwnlow.dat'. The shape in the header
+        of each file is updated as chunks are added
+
+    sonpath+base+'meta.mat': .mat file
+        metadata with those of the new port sidescan pings appended, and
+        shape_port, shape_star, shape_low and shape_hi updated
+
+    sonpath+base+'rawdat.csv': comma separated value file
+        as written by PyHum.read, with rows for the new pings appended
+
+    sonpath+base+"trackline.kml": google-earth kml file
+        contains the trackline of the vessel so far
+
+    sonpath+base+'_tail.json': json file
+        byte offset in each .SON file of the first ping not yet appended
+    '''
+
+    c = float(c)
+    t = float(t)
+    poll = float(poll)
+    timeout = float(timeout)
+    flip_lr = int(flip_lr)
+    chunk = int(chunk)
+    doplot = int(doplot)
+    try:
+       model = int(model)
+    except:
+       model = {'onix': 0, 'helix': 1, 'mega': 2}[model]
+
+    # if son path name supplied has no separator at end, put one on
+    if sonpath[-1]!=os.sep:
+       sonpath = sonpath + os.sep
+
+    base = humfile.split('.DAT') # get base of file name for output
+    base = base[0].split(os.sep)[-1]
+
+    # remove underscores, negatives and spaces from basename
+    base = humutils.strip_base(base)
+
+    f = 455
+    # theta at 3dB in the horizontal
+    theta3dB = np.arcsin(c/(t*(f*1000)))
+    #resolution of 1 sidescan pixel to nadir
+    ft = (np.pi/2)*(1/theta3dB)
+
+    if flip_lr==0:
+       names = {'sidescan_port': 'port', 'sidescan_starboard': 'star'}
+    else:
+       names = {'sidescan_port': 'star', 'sidescan_starboard': 'port'}
+    names['down_lowfreq'] = 'dwnlow'
+    names['down_highfreq'] = 'dwnhi'
+    names['down_vhighfreq'] = 'dwnhi'
+
+    # arrays are appended to as PyHum.read left them (see io.get_store_name)
+    strings = {}
+    for k in set(names.values()):
+       strings[k] = io.get_store_name(sonpath, base, ['_data_'+k+'2.dat', '_data_'+k+'.dat']) or '_data_'+k+'.dat'
+
+    offsets = get_tail_offsets(sonpath, base)
+
+    # one reader per SON file, each starting from the first ping not yet appended
+    tails = []
+    for sonfile in sorted(glob.glob(sonpath+'*.SON')):
+       key = os.path.basename(sonfile)
+       if key not in offsets:
+          offsets[key] = get_tail_offset(sonfile, sonpath, base, names, strings, model)
+       tails.append(pyread_fast.pytail(sonfile, humfile, c, model, cs2cs_args, offsets[key]))
+
+    # decoded pings not yet making up a whole chunk, for each SON file
+    pending = [None]*len(tails)
+
+    # chunks of the sidescan scans that have been plotted
+    plotted = get_tail_chunks(sonpath, base, strings)
+
+    last = time.time()
+    try:
+       while time.time()-last < timeout:
+          for i, tl in enumerate(tails):
+             o = tl.poll()
+             key = os.path.basename(tl.sonfile)
+             if o is None:
+                continue
+             head, data = o
+             last = time.time()
+
+             if tl.sonarstring not in names:
+                offsets[key] = tl.offset
+                continue
+
+             if pending[i] is None:
+                pending[i] = (head, data, tl.starts)
+             else:
+                pending[i] = (np.concatenate((pending[i][0], head)), np.vstack((pending[i][1], data)), np.concatenate((pending[i][2], tl.starts)))
+             head, data, starts = pending[i]
+             print("%s: %s new pings of %s samples" % (tl.sonarstring, str(len(head)), str(tl.packet)))
+
+             name = names[tl.sonarstring]
+             try:
+                shape = io.get_store_header(sonpath, base, strings[name])['shape']
+             except:
+                shape = []
+             # a 2d array (as read leaves with chunkmode 4) is widened by chunk
+             # pings at a time, otherwise chunks are as wide as those written
+             twod = len(shape)==2
+             if len(shape)==3:
+                w = int(shape[-1])
+             else:
+                w = chunk
+
+             # whole chunks of (packet, w) are appended, earliest first
+             n = 0
+             while len(head)-n >= w:
+                if twod:
+                   shape = io.set_mmap_extend(sonpath, base, strings[name], 'int16', data[n:n+w].T)
+                   print("%s: %s pings appended to %s" % (tl.sonarstring, str(w), base+strings[name]))
+                else:
+                   shape = io.set_mmap_append(sonpath, base, strings[name], 'int16', data[n:n+w].T)
+                   print("%s: chunk %s appended to %s" % (tl.sonarstring, str(shape[0]), base+strings[name]))
+
+                if tl.sonarstring == 'sidescan_port':
+                   set_tail_meta(sonpath, base, tl.getmetadata(head[n:n+w]), ft, c, t, f*2 if model==2 else f)
+                set_tail_shape(sonpath, base, name, shape)
+
+                if doplot==1 and name in ['dwnlow', 'dwnhi']:
+                   fp = io.get_mmap_data(sonpath, base, strings[name], 'int16')
+                   if twod:
+                      chunkmode, chunks = 4, None
+                   else:
+                      chunkmode, chunks = 1, [shape[0]-1]
+                   if name=='dwnlow':
+                      plot_dwnlow(fp, chunkmode, sonpath, chunks)
+                   else:
+                      plot_dwnhi(fp, chunkmode, sonpath, chunks)
+                   del fp
+                n += w
+
+             if n>0:
+                pending[i] = (head[n:], data[n:], starts[n:])
+                if len(head)>n:
+                   offsets[key] = int(starts[n])
+                else:
+                   offsets[key] = tl.offset
+                set_tail_offsets(sonpath, base, offsets)
+
+                if tl.sonarstring == 'sidescan_port':
+                   plot_tail(sonpath, base, doplot)
+
+                if doplot==1:
+                   plotted = plot_tail_chunks(sonpath, base, strings, ft, plotted)
+
+          time.sleep(poll)
+
+    except KeyboardInterrupt:
+       pass
+
+    print("Stopped following %s" % (sonpath))
+
+# =========================================================
+def get_tail_offsets(sonpath, base):
+    # byte offset in each SON file of the first ping not yet appended by tail
+    try:
+       with open(os.path.normpath(os.path.join(sonpath,base+'_tail.json')), 'r') as ff:
+          return json.load(ff)
+    except:
+       return {}
+
+# =========================================================
+def set_tail_offsets(sonpath, base, offsets):
+    with open(os.path.normpath(os.path.join(sonpath,base+'_tail.json')), 'w') as ff:
+       json.dump(offsets, ff, indent=1, sort_keys=True)
+
+# =========================================================
+def get_tail_offset(sonfile, sonpath, base, names, strings, model):
+    # byte offset of the first ping of sonfile that is not already in the
+    # scans written by read, found from the packet boundaries in the file
+    buf = np.memmap(sonfile, dtype=np.uint8, mode='r')
+    if len(buf)==0:
+       return 0
+    fbreak = pyread_fast.find_packets(buf)
+    if len(fbreak)==0:
+       return 0
+
+    head = pyread_fast.decode_heads(buf, fbreak[:1], model)
+    name = names.get(pyread_fast.CHANNELS.get(int(head['beam'][0]), 'unknown'))
+    try:
+       shape = io.get_store_header(sonpath, base, strings[name])['shape']
+    except:
+       return 0
+
+    if len(shape)>2:
+       npings = shape[0]*shape[2]
+    else:
+       npings = shape[1]
+    if npings < len(fbreak):
+       return int(fbreak[npings])
+    return len(buf)
+
+# =========================================================
+def set_tail_shape(sonpath, base, name, shape):
+    # records the new shape of a scan in meta.mat
+    try:
+       meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
+    except:
+       return
+    key = {'port': 'shape_port', 'star': 'shape_star', 'dwnlow': 'shape_low', 'dwnhi': 'shape_hi'}[name]
+    meta[key] = np.asarray(shape)
+    savemat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')), meta ,oned_as='row')
+
+# =========================================================
+def set_tail_meta(sonpath, base, metadat, ft, c, t, f):
+    # appends the metadata of new port sidescan pings to meta.mat (as written
+    # by read, but without smoothing positions or picking the bed across
+    # chunks) and their rows to rawdat.csv
+    nrec = len(metadat['n'])
+    metadat['instr_heading'] = metadat['heading']
+    metadat['es'] = metadat['e']
+    metadat['ns'] = metadat['n']
+    try:
+       metadat['dep_m'] = humutils.get_depth(metadat['dep_m'])
+    except:
+       pass
+    metadat['bed'] = metadat['dep_m']*ft
+
+    try:
+       meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
+       lat0 = np.squeeze(meta['lat'])[-1]
+       lon0 = np.squeeze(meta['lon'])[-1]
+       dist0 = np.squeeze(meta['dist_m'])[-1]
+    except:
+       meta = {'pix_m': 1/ft, 'c': c, 't': t, 'f': f, 'shape_port': '', 'shape_star': '', 'shape_low': '', 'shape_hi': ''}
+       lat0 = metadat['lat'][0]
+       lon0 = metadat['lon'][0]
+       dist0 = 0
+
+    # distance continues from the last ping already in meta.mat
+    metadat['dist_m'] = dist0 + humutils.get_dist(np.r_[lat0, metadat['lat']], np.r_[lon0, metadat['lon']])[:-1]
+
+    for k in ['lat', 'lon', 'e', 'n', 'es', 'ns', 'spd', 'time_s', 'dep_m', 'caltime', 'heading', 'instr_heading', 'dist_m', 'bed']:
+       v = np.atleast_1d(np.squeeze(metadat[k]))
+       if len(v)!=nrec: # e.g. no calendar time in the DAT file
+          continue
+       if k in meta:
+          meta[k] = np.append(np.atleast_1d(np.squeeze(meta[k])), v)
+       else:
+          meta[k] = v
+
+    savemat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')), meta ,oned_as='row')
+
+    new = not os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'rawdat.csv')))
+    ff = open(os.path.normpath(os.path.join(sonpath,base+'rawdat.csv')), 'at')
+    writer = csv.writer(ff)
+    if new:
+       writer.writerow( ('longitude', 'latitude', 'easting', 'northing', 'depth (m)', 'distance (m)', 'instr. heading (deg)', 'heading (deg.)' ) )
+    for i in range(0, nrec):
+       writer.writerow(( float(metadat['lon'][i]),float(metadat['lat'][i]),float(metadat['es'][i]),float(metadat['ns'][i]),float(metadat['dep_m'][i]),float(metadat['dist_m'][i]), float(metadat['instr_heading'][i]), float(metadat['heading'][i]) ))
+    ff.close()
+
+# =========================================================
+def plot_tail(sonpath, base, doplot):
+    # refreshes the kml trackline and the plot of positions so far
+    meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
+    lon = np.squeeze(meta['lon'])
+    lat = np.squeeze(meta['lat'])
+    try:
+       humutils.make_trackline(lon, lat, sonpath, base)
+    except:
+       pass
+    if doplot==1:
+       plot_pos(sonpath, {'e': np.squeeze(meta['e']), 'n': np.squeeze(meta['n']), 'lon': lon, 'lat': lat}, np.squeeze(meta['es']), np.squeeze(meta['ns']))
+
+# =========================================================
+def get_tail_chunks(sonpath, base, strings):
+    # number of chunks in both the port and starboard scans
+    try:
+       return min([io.get_store_header(sonpath, base, strings[k])['chunks'] for k in ['port', 'star']])
+    except:
+       return 0
+
+# =========================================================
+def plot_tail_chunks(sonpath, base, strings, ft, plotted):
+    # plots the chunks of the sidescan scans that are now in both the port
+    # and starboard scans and meta.mat, and have not been plotted yet
+    nchunks = get_tail_chunks(sonpath, base, strings)
+    if nchunks<=plotted:
+       return plotted
+    meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
+    bed = np.squeeze(meta['bed'])
+    dist_m = np.squeeze(meta['dist_m'])
+    port_fp = io.get_mmap_data(sonpath, base, strings['port'], 'int16')
+    star_fp = io.get_mmap_data(sonpath, base, strings['star'], 'int16')
+    shape_port = np.shape(port_fp)
+    w = shape_port[-1]
+    for k in range(plotted, min(nchunks, len(bed)//w)):
+       plot_bedpick(port_fp[k], star_fp[k], (1/ft)*bed[w*k:w*(k+1)], dist_m[w*k:w*(k+1)], ft, shape_port, sonpath, k, 1)
+       plotted = k+1
+    del port_fp, star_fp
+    return plotted
 
-   data = pyread_single.pyread(sonfile, humfile, c, model, cs2cs_args)
+# =========================================================
+def getscans(sonfile, humfile, c, model, cs2cs_args, writeidx=0, n_jobs=1):
 
-   a, b = data.getscan()
+   try: # vectorized reader
+      data = pyread_fast.pyread(sonfile, humfile, c, model, cs2cs_args, writeidx=writeidx==1, n_jobs=n_jobs)
+   except:
+      print("WARNING: Because %s has to be read in byte by byte," % (sonfile))
+      print("this could take a very long time ...")
+      data = pyread_single.pyread(sonfile, humfile, c, model, cs2cs_args)
+
+   if isinstance(data, pyread_fast.pyread):
+      a, b = data.getpings()
+   else: # pyread_single scans are (packet, npings)
+      a, b = data.getscan()
+      a = a.T
 
    if b == 'sidescan_port':
       dat = data.gethumdat()
@@ -870,10 +1244,28 @@ def getscans(sonfile, humfile, c, model, cs2cs_args):
    return a, b, dat, metadat
 
 # =========================================================
-def plot_dwnhi(dwnhi_fp, chunkmode, sonpath):
+def getscans_mmap(sonfile, humfile, c, model, cs2cs_args, writeidx=0, n_jobs=1):
+
+   data = pyread_fast.pyread(sonfile, humfile, c, model, cs2cs_args, mmap=True, writeidx=writeidx==1, cache=True, n_jobs=n_jobs)
+
+   a, b = data.getpings()
+
+   if b == 'sidescan_port':
+      dat = data.gethumdat()
+      metadat = data.getmetadata()
+   else:
+      dat = None
+      metadat = None
+
+   return a, b, dat, metadat
+
+# =========================================================
+def plot_dwnhi(dwnhi_fp, chunkmode, sonpath, chunks=None):
 
     if chunkmode!=4:
-       for k in range(len(dwnhi_fp)):
+       if chunks is None:
+          chunks = range(len(dwnhi_fp))
+       for k in chunks:
           fig = plt.figure()
           plt.imshow(dwnhi_fp[k],cmap='gray')
           plt.axis('normal'); plt.axis('tight')
@@ -894,10 +1286,12 @@ def plot_dwnhi(dwnhi_fp, chunkmode, sonpath):
        plt.close(); del fig
 
 # =========================================================
-def plot_dwnlow(dwnlow_fp, chunkmode, sonpath):
+def plot_dwnlow(dwnlow_fp, chunkmode, sonpath, chunks=None):
 
     if chunkmode!=4:
-       for k in range(len(dwnlow_fp)):
+       if chunks is None:
+          chunks = range(len(dwnlow_fp))
+       for k in chunks:
           fig = plt.figure()
           plt.imshow(dwnlow_fp[k],cmap='gray')
           plt.axis('normal'); plt.axis('tight')
@@ -939,7 +1333,7 @@ def plot_pos(sonpath, metadat, es, ns):
     plt.close(); del fig
 
 # =========================================================
-def makechunks_scan(chunkmode, chunkval, metadat, data, flag):
+def makechunks_scan(chunkmode, chunkval, metadat, data, flag, sonpath, base, string):
 
     if chunkmode==1:
        nchunks = 0
@@ -957,7 +1351,6 @@ def makechunks_scan(chunkmode, chunkval, metadat, data, flag):
        elif flag==3:
           print("high-freq. sonar data will be parsed into %s, %s m chunks" % (str(nchunks), str(chunkval)))
        chunkval = chunkval+1
-       Zt, ind = makechunks_simple(data, nchunks)
 
     elif chunkmode==2:
        nchunks = 0
@@ -975,7 +1368,6 @@ def makechunks_scan(chunkmode, chunkval, metadat, data, flag):
        elif flag==3:
           print("high-freq. sonar data will be parsed into %s, %s m chunks" % (str(nchunks), str(chunkval)))
        chunkval = chunkval+1
-       Zt, ind = makechunks_simple(data, nchunks)
 
     elif chunkmode==3:
        nchunks = 0
@@ -993,28 +1385,18 @@ def makechunks_scan(chunkmode, chunkval, metadat, data, flag):
        elif flag==3:
           print("high-freq. sonar data will be parsed into %s, %s m chunks" % (str(nchunks), str(chunkval)))
        chunkval = chunkval+1
-       Zt, ind = makechunks_simple(data, nchunks)
 
     elif chunkmode==4:
-       Zt, ind = makechunks_simple(data, 1)
+       nchunks = 1
 
-    return Zt, ind
+    # data is (npings, packet), e.g. a view of the samples in the SON file
+    return io.set_mmap_chunks(sonpath, base, string, 'int16', data, nchunks)
 
 # =========================================================
 def custom_save(figdirec,root):
     #plt.savefig(figdirec+root,bbox_inches='tight',dpi=400)
     plt.savefig(os.path.normpath(os.path.join(figdirec,root)),bbox_inches='tight',dpi=400)
 
-# =========================================================
-def makechunks_simple(dat, numchunks):
-   Ny, Nx = np.shape(dat)
-   # get windowed data
-   try:
-      return sliding_window(dat,(Ny,Nx/int(numchunks)))    #humutils.
-   except:
-      print("memory-mapping failed in sliding window - trying memory intensive version")
-      return humutils.sliding_window_nomm(dat,(Ny,Nx/int(numchunks)))
-
 # =========================================================
 def plot_2bedpicks(dat_port, dat_star, Zbed, Zdist, Zx, ft, shape_port, sonpath, k, chunkmode):
 
@@ -1090,16 +1472,14 @@ def sliding_window(a,ws,ss = None,flatten = True):
 
    #import PyHum.io as io
 
-   shape_tmp = io.set_mmap_data('', '', 'tmp.dat', 'float32', a)
+   # a raw scratch copy, so that it can be strided (whatever io.COMPRESS is)
+   shape_tmp = io.set_mmap_data('', '', 'tmp.dat', 'float32', a, compress=False)
    del a
    a = io.get_mmap_data('', '', 'tmp.dat', 'float32', shape_tmp)
 
    shap = np.array(a.shape)
 
-   try:
-      os.remove('tmp.dat')
-   except:
-      pass
+   io.del_mmap_data('', '', 'tmp.dat')
 
    # ensure that ws, ss, and a.shape all have the same number of dimensions
    ls = [len(shap),len(ws),len(ss)]
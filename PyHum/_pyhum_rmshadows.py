@@ -67,13 +67,10 @@ except:
 #numerical
 import numpy as np
 import PyHum.utils as humutils
+import PyHum.io as io
 #from pyhum_utils import sliding_window, im_resize, cut_kmeans
-from joblib import Parallel, delayed #, cpu_count
 from scipy.ndimage import binary_dilation, binary_erosion, binary_fill_holes, grey_erosion
 
-#import stdev
-from skimage.feature import greycomatrix, greycoprops
-
 #plotting
 import matplotlib.pyplot as plt
 #import matplotlib.colors as colors
@@ -91,7 +88,7 @@ warnings.filterwarnings("ignore")
 # ========================================================
 
 #################################################
-def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contrast, energy, mn):
+def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contrast, energy, mn, winstep=0, stage_cache=None):
     '''
     Remove dark shadows in scans caused by shallows, shorelines, and attenuation of acoustics with distance
     Manual or automated processing options available
@@ -99,7 +96,7 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
     Syntax
     ----------
-    [] = PyHum.rmshadows(humfile, sonpath, win, shadowmask, doplot)
+    [] = PyHum.rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contrast, energy, mn, winstep, stage_cache)
 
     Parameters
     ----------
@@ -113,6 +110,14 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
        1 = do manual shadow masking, otherwise do automatic shadow masking
     doplot : int, *optional* [Default=1]
        1 = make plots, otherwise do not
+    winstep : int, *optional* [Default=0]
+       if > 0, automatic shadow masking scores overlapping windows every winstep
+       pixels (win = one window per tile, 1 = one window per pixel) and each pixel
+       takes the score of the window centred nearest to it. Otherwise windows are
+       non-overlapping tiles and the scores are interpolated back to full size
+    stage_cache : int, *optional* [Default=None]
+       if 1, nothing is done if the inputs and parameters are unchanged since
+       the last run, 0 = always run. None = as PyHum.io.STAGE_CACHE
 
     Returns
     -------
@@ -181,6 +186,10 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
        mn = np.asarray(mn,int)
        print('Threshold mean intensity (shadow is <) is %s' % (str(mn)))
 
+    if winstep:
+       winstep = int(winstep)
+       print('Shadow windows are scored every %s pixels' % (str(winstep)))
+
     # start timer
     if os.name=='posix': # true if linux/mac or cygwin on windows
        start = time.time()
@@ -198,18 +207,23 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
     meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
 
+    # manual shadow masks depend on the picks, so are always redone
+    if shadowmask==1:
+       stage_cache = 0
+    stage_hash, done = io.get_stage(sonpath, base, 'rmshadows', {'win': win, 'shadowmask': shadowmask, 'doplot': doplot, 'dissim': dissim, 'correl': correl, 'contrast': contrast, 'energy': energy, 'mn': mn, 'winstep': winstep}, [base+'_data_port_la.dat', base+'_data_star_la.dat'], meta, cache=stage_cache)
+    if done:
+       return
+
     # load memory mapped scans
     shape_port = np.squeeze(meta['shape_port'])
     if shape_port!='':
        #port_fp = np.memmap(sonpath+base+'_data_port_la.dat', dtype='float32', mode='r', shape=tuple(shape_port))
-       with open(os.path.normpath(os.path.join(sonpath,base+'_data_port_la.dat')), 'r') as ff:
-          port_fp = np.memmap(ff, dtype='float32', mode='r', shape=tuple(shape_port))
+       port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', tuple(shape_port))
 
     shape_star = np.squeeze(meta['shape_star'])
     if shape_star!='':
        #star_fp = np.memmap(sonpath+base+'_data_star_la.dat', dtype='float32', mode='r', shape=tuple(shape_star))
-       with open(os.path.normpath(os.path.join(sonpath,base+'_data_star_la.dat')), 'r') as ff:
-          star_fp = np.memmap(ff, dtype='float32', mode='r', shape=tuple(shape_star))
+       star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', tuple(shape_star))
 
     dist_m = np.squeeze(meta['dist_m'])
     ft = 1/(meta['pix_m'])
@@ -217,7 +231,8 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
     if shadowmask==1: #manual
 
-       Zt = []
+       # each chunk is written out as soon as it is picked
+       Zt = io.create_store(sonpath, base, '_data_star_lar.dat', 'float32', np.shape(star_fp))
        if len(np.shape(star_fp))>2:
           for p in range(len(star_fp)):
              raw_input("Shore picking "+str(p+1)+" of "+str(len(star_fp))+" (starboard), are you ready? 60 seconds. Press Enter to continue...")
@@ -242,7 +257,7 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
              del shoreline_star
 
-             Zt.append(star_mg)
+             Zt.write_chunk(p, star_mg)
              
        else:
 
@@ -268,27 +283,20 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
           del shoreline_star
 
-          Zt.append(star_mg)
+          Zt.write_chunk(0, star_mg)
 
        ## create memory mapped file for Z
        #p = np.memmap(sonpath+base+'_data_star_la.dat', dtype='float32', mode='w+', shape=np.shape(Zt))
        #fp[:] = Zt[:]
        #del fp
 
-       Zt = np.squeeze(Zt)
-             
-       # create memory mapped file for Zs
-       #fp = np.memmap(sonpath+base+'_data_star_lar.dat', dtype='float32', mode='w+', shape=np.shape(Zs))
-       with open(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat')), 'w+') as ff:
-          fp = np.memmap(ff, dtype='float32', mode='w+', shape=np.shape(Zt))
-       fp[:] = Zt[:]
-       del fp
+       Zt.close()
        del Zt
 
        #shutil.move(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat')), os.path.normpath(os.path.join(sonpath,base+'_data_star_la.dat')))
 
 
-       Zt = []
+       Zt = io.create_store(sonpath, base, '_data_port_lar.dat', 'float32', np.shape(port_fp))
        if len(np.shape(star_fp))>2:
           for p in range(len(port_fp)):
 
@@ -314,7 +322,7 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
              del shoreline_port
 
-             Zt.append(port_mg)
+             Zt.write_chunk(p, port_mg)
           
        else:
 
@@ -340,27 +348,18 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
           del shoreline_port
 
-          Zt.append(port_mg)
-
-       Zt = np.squeeze(Zt)
-       ## create memory mapped file for Z
-       #fp = np.memmap(sonpath+base+'_data_port_la.dat', dtype='float32', mode='w+', shape=np.shape(Zt))
-       #fp[:] = Zt[:]
-       #del fp
+          Zt.write_chunk(0, port_mg)
 
-       # create memory mapped file for Zp
-       #fp = np.memmap(sonpath+base+'_data_port_lar.dat', dtype='float32', mode='w+', shape=np.shape(Zp))
-       with open(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat')), 'w+') as ff:
-          fp = np.memmap(ff, dtype='float32', mode='w+', shape=np.shape(Zt))
-       fp[:] = Zt[:]
-       del fp
+       Zt.close()
        del Zt    
 
        #shutil.move(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat')), os.path.normpath(os.path.join(sonpath,base+'_data_port_la.dat')))
 
     else: #auto
 
-       Zs = []; Zp = []
+       # each chunk is written out as soon as it is made
+       Zp = io.create_store(sonpath, base, '_data_port_lar.dat', 'float32', np.shape(port_fp))
+       Zs = io.create_store(sonpath, base, '_data_star_lar.dat', 'float32', np.shape(star_fp))
        if len(np.shape(star_fp))>2:
           for p in range(len(star_fp)):
              merge = np.vstack((np.flipud(port_fp[p]),star_fp[p]))
@@ -375,22 +374,16 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
              merge[np.isnan(merge)] = 0
 
-             #Z,ind = humutils.sliding_window(merge,(win,win),(win/2,win/2))
-             Z,ind = humutils.sliding_window(merge,(win,win),(win,win))
-
-             #zmean = np.reshape(zmean, ( ind[0], ind[1] ) )
              Ny, Nx = np.shape(merge)
-             #zmean[np.isnan(zmean)] = 0
-          
-             try: #parallel processing with all available cores     
-                w = Parallel(n_jobs = -1, verbose=0)(delayed(parallel_me)(Z[k], dissim, correl, contrast, energy, mn) for k in range(len(Z)))
-             except: #fall back to serial
-                w = Parallel(n_jobs = 1, verbose=0)(delayed(parallel_me)(Z[k], dissim, correl, contrast, energy, mn) for k in range(len(Z)))          
-          
-             zmean = np.reshape(w , ( ind[0], ind[1] ) )
-             del w
-        
-             M = humutils.im_resize(zmean,Nx,Ny)
+
+             if winstep>0:
+                # score windows every winstep pixels, and give each pixel the score of its window
+                zmean = get_shadow_windows(merge, win, winstep, dissim, correl, contrast, energy, mn)
+                M = get_window_mask(zmean, win, winstep, Ny, Nx)
+             else:
+                # score every win x win tile of the chunk at once
+                zmean = get_shadow_scores(merge, win, dissim, correl, contrast, energy, mn)
+                M = humutils.im_resize(zmean,Nx,Ny)
              M[mask==0] = 0
              del zmean
 
@@ -429,8 +422,8 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
                 custom_save(sonpath,'merge_corrected_rmshadow_scan'+str(p))
                 del fig
 
-             Zp.append(np.flipud(merge[:shape_port[1],:]))
-             Zs.append(merge[shape_port[1]:,:])
+             Zp.write_chunk(p, np.flipud(merge[:shape_port[1],:]))
+             Zs.write_chunk(p, merge[shape_port[1]:,:])
              del merge, bw2
 
        else:
@@ -447,22 +440,16 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
 
           merge[np.isnan(merge)] = 0
 
-          #Z,ind = humutils.sliding_window(merge,(win,win),(win/2,win/2))
-          Z,ind = humutils.sliding_window(merge,(win,win),(win,win))
-
-          #zmean = np.reshape(zmean, ( ind[0], ind[1] ) )
           Ny, Nx = np.shape(merge)
-          #zmean[np.isnan(zmean)] = 0
-          
-          try: #parallel processing with all available cores     
-             w = Parallel(n_jobs = -1, verbose=0)(delayed(parallel_me)(Z[k], dissim, correl, contrast, energy, mn) for k in range(len(Z)))
-          except: #fall back to serial
-             w = Parallel(n_jobs = 1, verbose=0)(delayed(parallel_me)(Z[k], dissim, correl, contrast, energy, mn) for k in range(len(Z)))          
-          
-          zmean = np.reshape(w , ( ind[0], ind[1] ) )
-          del w
-        
-          M = humutils.im_resize(zmean,Nx,Ny)
+
+          if winstep>0:
+             # score windows every winstep pixels, and give each pixel the score of its window
+             zmean = get_shadow_windows(merge, win, winstep, dissim, correl, contrast, energy, mn)
+             M = get_window_mask(zmean, win, winstep, Ny, Nx)
+          else:
+             # score every win x win tile of the chunk at once
+             zmean = get_shadow_scores(merge, win, dissim, correl, contrast, energy, mn)
+             M = humutils.im_resize(zmean,Nx,Ny)
           M[mask==0] = 0
           del zmean
 
@@ -512,35 +499,15 @@ def rmshadows(humfile, sonpath, win, shadowmask, doplot, dissim, correl, contras
              custom_save(sonpath,'merge_corrected_rmshadow_scan'+str(0))
              del fig
 
-          Zp.append(np.flipud(merge[:shape_port[0],:]))
-          Zs.append(merge[shape_port[0]:,:])
+          Zp.write_chunk(0, np.flipud(merge[:shape_port[0],:]))
+          Zs.write_chunk(0, merge[shape_port[0]:,:])
           del merge, bw2
 
-       Zp = np.squeeze(Zp)
-       Zs = np.squeeze(Zs)
-       # create memory mapped file for Zp
-       #fp = np.memmap(sonpath+base+'_data_port_lar.dat', dtype='float32', mode='w+', shape=np.shape(Zp))
-       #with open(sonpath+base+'_data_port_lar.dat', 'w+') as f:
-       with open(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat')), 'w+') as ff:
-          fp = np.memmap(ff, dtype='float32', mode='w+', shape=np.shape(Zp))
-       fp[:] = Zp[:]
-       del fp
-       del Zp    
-
-       #shutil.move(sonpath+base+'_data_port_lar.dat', sonpath+base+'_data_port_la.dat')
-       #shutil.move(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat')), os.path.normpath(os.path.join(sonpath,base+'_data_port_la.dat')))
-
-       # create memory mapped file for Zs
-       #fp = np.memmap(sonpath+base+'_data_star_lar.dat', dtype='float32', mode='w+', shape=np.shape(Zs))
-       #with open(sonpath+base+'_data_star_lar.dat', 'w+') as f:
-       with open(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat')), 'w+') as ff:
-          fp = np.memmap(ff, dtype='float32', mode='w+', shape=np.shape(Zs))
-       fp[:] = Zs[:]
-       del fp
-       del Zs
+       Zp.close()
+       Zs.close()
+       del Zp, Zs
 
-       #shutil.move(sonpath+base+'_data_star_lar.dat', sonpath+base+'_data_star_la.dat')
-       #shutil.move(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat')), os.path.normpath(os.path.join(sonpath,base+'_data_star_la.dat')))
+       io.set_stage(sonpath, base, 'rmshadows', stage_hash, [base+'_data_port_lar.dat', base+'_data_star_lar.dat'])
 
     if os.name=='posix': # true if linux/mac
        elapsed = (time.time() - start)
@@ -560,16 +527,168 @@ def custom_save(figdirec,root):
     plt.savefig(os.path.normpath(os.path.join(figdirec,root)),bbox_inches='tight',dpi=400)
 
 # =========================================================
-def parallel_me(Z, dissim, correl, contrast, energy, mn):
-    try:
-       glcm = greycomatrix(Z, [5], [0], 256, symmetric=True, normed=True)
-       if (greycoprops(glcm, 'dissimilarity')[0, 0] < dissim) and (greycoprops(glcm, 'correlation')[0, 0] < correl) and (greycoprops(glcm, 'contrast')[0, 0] < contrast) and (greycoprops(glcm, 'energy')[0, 0] > energy) and (np.mean(Z)<mn):
-          return 1
-       else:
-          return 0
-    except:
-       return 0
+def get_shadow_scores(merge, win, dissim, correl, contrast, energy, mn):
+    '''
+    returns a grid with 1 for each non-overlapping win x win tile of merge
+    that looks like shadow, and 0 otherwise. The test is that of greycoprops
+    on a 256 level symmetric, normed grey level co-occurrence matrix of the
+    tile (pixel pairs 5 apart along each row), but the matrices are never
+    made: dissimilarity, contrast and correlation are moments of the pixel
+    pairs, and energy comes from counts of the distinct pairs in each tile
+    '''
+    Ny, Nx = np.shape(merge)
+    ny, nx = Ny//win, Nx//win
+    if win<=5 or ny==0 or nx==0:
+       return np.zeros((ny, nx))
+
+    # tiles, as (ny, nx, win, win)
+    Z = np.reshape(merge[:ny*win,:nx*win], (ny, win, nx, win)).swapaxes(1,2)
+
+    # tiles with values outside 0 to 255 cannot be scored
+    valid = (np.min(Z, axis=(2,3))>=0) & (np.max(Z, axis=(2,3))<256)
+    zmean = np.mean(Z, axis=(2,3))
+
+    Q = np.where(valid[:,:,np.newaxis,np.newaxis], Z, 0).astype('uint8').astype('int64')
+    a = Q[:,:,:,:-5]
+    b = Q[:,:,:,5:]
+    n = win*(win-5)
+
+    d = a-b
+    con = np.sum(d*d, axis=(2,3))/n
+    dis = np.sum(np.abs(d), axis=(2,3))/n
+    del d
+
+    # the matrix is symmetric so both marginals are the mean of a and b
+    mu = np.sum(a+b, axis=(2,3))/(2*n)
+    var = np.sum(a*a+b*b, axis=(2,3))/(2*n) - mu**2
+    cov = np.sum(a*b, axis=(2,3))/n - mu**2
+    cor = np.ones((ny, nx))
+    ok = var>=1e-30
+    cor[ok] = cov[ok]/var[ok]
+
+    # energy is sqrt(sum(P**2)). Count each unordered pair (lo, hi) per tile;
+    # it fills P at (lo, hi) and (hi, lo), each with half its count
+    lo = np.minimum(a, b)
+    hi = np.maximum(a, b)
+    code = np.ravel((np.arange(ny*nx).reshape(ny, nx, 1, 1)*256 + lo)*256 + hi)
+    del lo, hi
+    code = np.sort(code)
+    starts = np.r_[0, np.flatnonzero(np.diff(code))+1]
+    counts = np.diff(np.r_[starts, len(code)]).astype('float64')
+    code = code[starts]
+    counts = counts**2 * np.where(code//256 % 256 == code % 256, 1, 0.5)
+    ene = np.sqrt(np.bincount(code//65536, counts, minlength=ny*nx).reshape(ny, nx))/n
+
+    shadow = valid & (dis<dissim) & (cor<correl) & (con<contrast) & (ene>energy) & (zmean<mn)
+    return shadow.astype('float64')
        
+# =========================================================
+def get_window_sums(x, h, w, ys, xs):
+    '''
+    returns the sum of x over every h x w window with top left corner at
+    rows ys and columns xs, from an integral image of x
+    '''
+    I = np.zeros((np.shape(x)[0]+1, np.shape(x)[1]+1), dtype=x.dtype)
+    I[1:,1:] = np.cumsum(np.cumsum(x, axis=0), axis=1)
+    return I[np.ix_(ys+h, xs+w)] - I[np.ix_(ys, xs+w)] - I[np.ix_(ys+h, xs)] + I[np.ix_(ys, xs)]
+
+# =========================================================
+def get_window_energy(code, win, ys, xs, nb=64):
+    '''
+    returns sum(P**2) for the unnormed co-occurrence counts of every window,
+    from the pair codes (lo*256 + hi) of the chunk. Pair counts are kept for
+    nb window rows at a time and updated as the windows slide along the rows
+    '''
+    m = win-5
+    ncode = 256*256
+    # an unordered pair (lo, hi) fills P at (lo, hi) and (hi, lo), each with half its count
+    wcode = np.where(np.r_[0:ncode]//256 == np.r_[0:ncode] % 256, 1, 0.5)
+    rows = np.r_[0:win]
+    ene = np.zeros((len(ys), len(xs)))
+
+    for b in range(0, len(ys), nb):
+       yb = ys[b:b+nb]
+       band = np.arange(len(yb))[:,np.newaxis,np.newaxis]*ncode
+       r = (yb[:,np.newaxis] + rows[np.newaxis,:])[:,:,np.newaxis]
+
+       keys = np.ravel(band + code[r, np.r_[xs[0]:xs[0]+m]])
+       counts = np.bincount(keys, minlength=len(yb)*ncode)
+       S = np.sum(np.reshape(counts**2, (len(yb), ncode))*wcode, axis=1)
+       ene[b:b+nb,0] = S
+
+       for j in range(1, len(xs)):
+          x0, x1 = xs[j-1], xs[j]
+          # pair columns leaving and entering the window
+          out = np.r_[x0:min(x1, x0+m)]
+          into = np.r_[max(x1, x0+m):x1+m]
+          keys = np.r_[np.ravel(band + code[r, out]), np.ravel(band + code[r, into])]
+          keys, inv = np.unique(keys, return_inverse=True)
+          d = np.bincount(np.ravel(inv), np.r_[-np.ones(len(yb)*win*len(out)), np.ones(len(yb)*win*len(into))]).astype('int64')
+          old = counts[keys]
+          counts[keys] = old + d
+          S = S + np.bincount(keys//ncode, ((old+d)**2 - old**2)*wcode[keys % ncode], minlength=len(yb))
+          ene[b:b+nb,j] = S
+    return ene
+
+# =========================================================
+def get_shadow_windows(merge, win, step, dissim, correl, contrast, energy, mn):
+    '''
+    as get_shadow_scores, but for win x win windows every step pixels down
+    and along the chunk, so windows overlap when step < win. Sums over each
+    window come from integral images, and pair counts for the energy are
+    updated as the windows slide, so no window is built
+    '''
+    Ny, Nx = np.shape(merge)
+    step = max(int(step), 1)
+    ys = np.r_[0:max(Ny-win, -1)+1:step]
+    xs = np.r_[0:max(Nx-win, -1)+1:step]
+    if win<=5 or len(ys)==0 or len(xs)==0:
+       return np.zeros((len(ys), len(xs)))
+
+    # windows with values outside 0 to 255 cannot be scored
+    valid = get_window_sums(((merge<0) | (merge>=256)).astype('int64'), win, win, ys, xs)==0
+    zmean = get_window_sums(np.asarray(merge, 'float64'), win, win, ys, xs)/win**2
+
+    Q = np.where((merge>=0) & (merge<256), merge, 0).astype('uint8').astype('int64')
+    a = Q[:,:-5]
+    b = Q[:,5:]
+    m = win-5
+    n = win*m
+
+    d = a-b
+    con = get_window_sums(d*d, win, m, ys, xs)/n
+    dis = get_window_sums(np.abs(d), win, m, ys, xs)/n
+    del d
+
+    # the matrix is symmetric so both marginals are the mean of a and b
+    mu = get_window_sums(a+b, win, m, ys, xs)/(2*n)
+    var = get_window_sums(a*a+b*b, win, m, ys, xs)/(2*n) - mu**2
+    cov = get_window_sums(a*b, win, m, ys, xs)/n - mu**2
+    cor = np.ones(np.shape(var))
+    ok = var>=1e-30
+    cor[ok] = cov[ok]/var[ok]
+
+    code = np.minimum(a, b)*256 + np.maximum(a, b)
+    del a, b, Q
+    ene = np.sqrt(get_window_energy(code, win, ys, xs))/n
+
+    shadow = valid & (dis<dissim) & (cor<correl) & (con<contrast) & (ene>energy) & (zmean<mn)
+    return shadow.astype('float64')
+
+# =========================================================
+def get_window_mask(zmean, win, step, Ny, Nx):
+    '''
+    returns an Ny x Nx array in which each pixel takes the value in zmean of
+    the window (every step pixels, see get_shadow_windows) centred nearest it
+    '''
+    ny, nx = np.shape(zmean)
+    if ny==0 or nx==0:
+       return np.zeros((Ny, Nx))
+    step = max(int(step), 1)
+    iy = np.clip((np.r_[0:Ny] - win//2 + step//2)//step, 0, ny-1)
+    ix = np.clip((np.r_[0:Nx] - win//2 + step//2)//step, 0, nx-1)
+    return zmean[np.ix_(iy, ix)]
+
 # =========================================================
 # =========================================================
 if __name__ == '__main__':
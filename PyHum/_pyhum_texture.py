@@ -55,7 +55,7 @@
 from __future__ import print_function
 import os, time #sys, getopt, 
 from scipy.io import loadmat #, savemat
-from joblib import Parallel, delayed, cpu_count
+from joblib import cpu_count
 try:
    from Tkinter import Tk
    from tkFileDialog import askopenfilename, askdirectory
@@ -69,8 +69,9 @@ import PyHum.io as io
 import numpy as np
 import PyHum.utils as humutils
 from scipy.ndimage.filters import median_filter
+from scipy.ndimage import map_coordinates
 
-import PyHum.cwt as cwt
+import PyHum.cwt_fast as cwt
 import PyHum.replace_nans as replace_nans
 
 # plotting
@@ -90,8 +91,11 @@ np.seterr(invalid='ignore')
 import warnings
 warnings.filterwarnings("ignore")
 
+# pings in each tile of a single (unchunked) scan
+TILESIZE = 1000
+
 #################################################
-def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale, notes):
+def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale, notes, halo=None, tilesize=TILESIZE, stage_cache=None):
           
       '''
       Create a texture lengthscale map using the algorithm detailed by Buscombe et al. (2015)
@@ -102,7 +106,7 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
 
       Syntax
       ----------
-      [] = PyHum.texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale, notes)
+      [] = PyHum.texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale, notes, halo, tilesize, stage_cache)
 
       Parameters
       ----------
@@ -124,6 +128,16 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
        Max scale as inverse fraction of data length for wavelet analysis
       notes : int, *optional* [Default=100]
        notes per octave for wavelet analysis
+      halo : int, *optional* [Default=None]
+       pings either side of each tile (chunk) taken from its neighbours so that
+       texture is continuous across tiles. None = enough for the moving window
+       and the median filter
+      tilesize : int, *optional* [Default=1000]
+       pings in each tile of a single (unchunked) scan. Memory use grows with
+       tilesize (plus twice the halo), so lower it on small machines
+      stage_cache : int, *optional* [Default=None]
+         if 1, nothing is done if the inputs and parameters are unchanged since
+         the last run, 0 = always run. None = as PyHum.io.STAGE_CACHE
 
       Returns
       -------
@@ -186,6 +200,15 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
          doplot = int(doplot)
          if doplot==0:
             print("Plots will not be made")
+
+      if halo is not None:
+         halo = int(halo)
+         print('Halo is %s pings' % (str(halo)))
+
+      if not tilesize:
+         tilesize = TILESIZE
+      tilesize = int(tilesize)
+      print('Tile size is %s pings' % (str(tilesize)))
       
       
       print('[Default] Number of processors is %s' % (str(cpu_count())))
@@ -211,6 +234,10 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
 
       meta = loadmat(os.path.normpath(os.path.join(sonpath,base+'meta.mat')))
 
+      stage_hash, done = io.get_stage(sonpath, base, 'texture', {'win': win, 'shift': shift, 'doplot': doplot, 'density': density, 'numclasses': numclasses, 'maxscale': maxscale, 'notes': notes, 'halo': halo, 'tilesize': tilesize}, [base+f for f in ['_data_port_lar.dat', '_data_port_la.dat', '_data_port_l.dat', '_data_star_lar.dat', '_data_star_la.dat', '_data_star_l.dat', '_data_range.dat']], meta, cache=stage_cache)
+      if done:
+         return
+
       ft = 1/loadmat(sonpath+base+'meta.mat')['pix_m']
       #pix_m = np.squeeze(meta['pix_m'])
       #dep_m = np.squeeze(meta['dep_m'])
@@ -219,25 +246,18 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
       ### port
       print("processing port side ...")
       # load memory mapped scan ... port
-      shape_port = np.squeeze(meta['shape_port'])
-      if shape_port!='':
-
-         if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat'))):
-            port_fp = io.get_mmap_data(sonpath, base, '_data_port_lar.dat', 'float32', tuple(shape_port))         
-         else:
-            port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', tuple(shape_port))
+      port = io.get_mmap_latest(sonpath, base, ['_data_port_lar.dat', '_data_port_la.dat'], 'float32')
+      if port is not None:
+         port_fp, shape_port = port
 
          port_fp2 = io.get_mmap_data(sonpath, base, '_data_port_l.dat', 'float32', tuple(shape_port))
 
       ### star
       print("processing starboard side ...")
       # load memory mapped scan ... port
-      shape_star = np.squeeze(loadmat(sonpath+base+'meta.mat')['shape_star'])
-      if shape_star!='':
-         if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat'))):
-            star_fp = io.get_mmap_data(sonpath, base, '_data_star_lar.dat', 'float32', tuple(shape_star))
-         else:
-            star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', tuple(shape_star))
+      star = io.get_mmap_latest(sonpath, base, ['_data_star_lar.dat', '_data_star_la.dat'], 'float32')
+      if star is not None:
+         star_fp, shape_star = star
 
          star_fp2 = io.get_mmap_data(sonpath, base, '_data_star_l.dat', 'float32', tuple(shape_star))
 
@@ -251,105 +271,23 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
          shape.append(shape_port[1])
          shape[1] = shape_port[0] + shape_star[0]
 
-      # create memory mapped file for Sp
-      with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'w+') as ff:
-         fp = np.memmap(ff, dtype='float32', mode='w+', shape=tuple(shape))
+      R_fp = io.get_mmap_data(sonpath, base, '_data_range.dat', 'float32', tuple(shape_star))
 
+      # the texture is worked out a tile at a time along track (each chunk, or
+      # tilesize pings of a single scan) with halo pings either side, and each
+      # tile is written straight to file
       if len(shape_star)>2:
-         #SRT = []
-         for p in range(len(port_fp)):
-            
-            Z,ind = humutils.sliding_window_sliced(np.vstack((np.flipud(port_fp[p]), star_fp[p])), density, (win,win),(shift,shift))
-            
-            Snn = get_srt(Z,ind,maxscale, notes, win) #, density)
- 
-            # replace nans using infilling algorithm
-            rn = replace_nans.RN(Snn.astype('float64'),1000,0.01,2,'localmean')
-            Snn = rn.getdata()
-            del rn 
-
-            Ny, Nx = np.shape( np.vstack((np.flipud(port_fp[p]), star_fp[p])) )
-
-            Snn = median_filter(Snn,(int(Nx/100),int(Ny/100)))
-   
-            Sp = humutils.im_resize(Snn,Nx,Ny)
-            del Snn
-
-            Sp[np.isnan(np.vstack((np.flipud(port_fp[p]), star_fp[p])))] = np.nan
-            Sp[np.isnan(np.vstack((np.flipud(port_fp2[p]), star_fp2[p])))] = np.nan
-
-            #extent = shape_port[1]
-            #Zdist = dist_m[shape_port[-1]*p:shape_port[-1]*(p+1)]
-            #yvec = np.linspace(pix_m,extent*pix_m,extent)
-            #d = dep_m[shape_port[-1]*p:shape_port[-1]*(p+1)]
-
-            R_fp = io.get_mmap_data(sonpath, base, '_data_range.dat', 'float32', tuple(shape_star))
-
-            R = np.vstack((np.flipud(R_fp[0]),R_fp[0]))
-            
-            R = R/np.max(R)
-
-            #R[R>0.8] = np.nan
-
-            rn = replace_nans.RN(R.astype('float64'),1000,0.01,2,'localmean')
-            R = rn.getdata()
-            del rn   
-
-            Sp = (Sp**2) * np.cos(np.deg2rad(R)) /shift ##**2
-
-            fp[p] = Sp.astype('float32')
-            del Sp
-
-         del fp # flush data to file
-
-         class_fp = io.get_mmap_data(sonpath, base, '_data_class.dat', 'float32', tuple(shape))
-
-      else: 
-
-            Z,ind = humutils.sliding_window_sliced(np.vstack((np.flipud(port_fp), star_fp)), density, (win,win),(shift,shift))  
-            
-            Snn = get_srt(Z,ind,maxscale, notes, win) #, density)
-            
-            # replace nans using infilling algorithm
-            rn = replace_nans.RN(Snn.astype('float64'),1000,0.01,2,'localmean')
-            Snn = rn.getdata()
-            del rn   
-
-            Ny, Nx = np.shape( np.vstack((np.flipud(port_fp), star_fp)) )
-
-            Snn = median_filter(Snn,(int(Nx/100),int(Ny/100)))
-   
-            Sp = humutils.im_resize(Snn,Nx,Ny)
-            del Snn
-
-            Sp[np.isnan(np.vstack((np.flipud(port_fp), star_fp)))] = np.nan
-            Sp[np.isnan(np.vstack((np.flipud(port_fp2), star_fp2)))] = np.nan
-
-            #extent = shape_port[0]
-            #Zdist = dist_m
-            #yvec = np.linspace(pix_m,extent*pix_m,extent)
-            #d = dep_m
-
-            R_fp = io.get_mmap_data(sonpath, base, '_data_range.dat', 'float32', tuple(shape_star))
-
-            R = np.vstack((np.flipud(R_fp),R_fp))
-            R = R/np.max(R)
-            
-            #R[R>0.8] = np.nan
-
-            rn = replace_nans.RN(R.astype('float64'),1000,0.01,2,'localmean')
-            R = rn.getdata()
-            del rn   
-
-            Sp = (Sp**2) * np.cos(np.deg2rad(R)) / shift ##**2
+         fp = io.create_store(sonpath, base, '_data_class.dat', 'float32', tuple(shape))
+      else:
+         # a raw memory mapped store, so tiles can be written in place
+         fp = io.create_store(sonpath, base, '_data_class.dat', 'float32', tuple(shape[1:]), compress=False)
 
-            with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'w+') as ff:
-               np.save(ff, np.squeeze(Sp).astype('float32'))
+      stream_texture(fp, port_fp, star_fp, port_fp2, star_fp2, R_fp, win, shift, density, maxscale, notes, halo, tilesize)
 
-            with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'r') as ff:
-               class_fp = np.load(ff)
+      fp.close() # flush data to file
+      del fp
 
-            del Sp
+      class_fp = io.get_mmap_data(sonpath, base, '_data_class.dat', 'float32')
 
       dist_m = np.squeeze(loadmat(sonpath+base+'meta.mat')['dist_m'])
 
@@ -373,14 +311,15 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
       # k-means 
       
       if len(shape_star)>2:
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'w+') as ff:
-            fp = np.memmap(ff, dtype='float32', mode='w+', shape=tuple(shape))
+         # each chunk is written out as soon as it is made
+         fp = io.create_store(sonpath, base, '_data_kclass.dat', 'float32', tuple(shape))
 
          for p in range(len(port_fp)):
             wc = get_kclass(class_fp[p].copy(), numclasses)
-            fp[p] = wc.astype('float32')
+            fp.write_chunk(p, wc)
             del wc
 
+         fp.close()
          del fp
 
          kclass_fp = io.get_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', tuple(shape))
@@ -388,13 +327,11 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
       else:
          wc = get_kclass(class_fp.copy(), numclasses)
 
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'w+') as ff:
-            np.save(ff, np.squeeze(wc).astype('float32'))
+         kshape = io.set_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', np.squeeze(wc))
 
          del wc
-         
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'r') as ff:
-            kclass_fp = np.load(ff)
+
+         kclass_fp = io.get_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', kshape)
             
       ########################################################
       if doplot==1:
@@ -405,6 +342,8 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
          else:
             plot_kmeans(dist_m, shape_port, port_fp, star_fp, kclass_fp, ft, humfile, sonpath, base, 0)         
 
+      io.set_stage(sonpath, base, 'texture', stage_hash, [base+'_data_class.dat', base+'_data_kclass.dat'])
+
       if os.name=='posix': # true if linux/mac
          elapsed = (time.time() - start)
       else: # windows
@@ -416,20 +355,115 @@ def texture(humfile, sonpath, win, shift, doplot, density, numclasses, maxscale,
     
 # =========================================================
 def get_srt(Z,ind,maxscale, notes, win): #, density):    
-    try:
-       #print "%s windows to process with a density of %s" % (str(len(Z)), str(density)) #% (str(len(Z)), str(density))
-       print("%s windows to process" % (str(len(Z))))                         
-       # do the wavelet clacs and get the stats
-       d = Parallel(n_jobs = -1, verbose=0)(delayed(parallel_me)(Z[k], maxscale, notes, win) for k in range(len(Z))) #density
-    except:
-       print("memory error: trying serial")
-       d = Parallel(n_jobs = 1, verbose=0)(delayed(parallel_me)(Z[k], maxscale, notes, win) for k in range(len(Z))) #density
+    print("%s windows to process" % (str(len(Z))))
+    # do the wavelet calcs for all windows together and get the stats
+    d = cwt.getvar(Z, maxscale, notes, win)
 
     srt = np.reshape(d , ( ind[0], ind[1] ) )
     del d
 
     return srt #srt+srt2
             
+# =========================================================
+def get_pings(fp, x0, x1):
+    '''
+    returns pings x0 to x1 of a scan, read across chunks if it is chunked
+    '''
+    if np.ndim(fp)==2:
+       return np.asarray(fp[:,x0:x1])
+    w = np.shape(fp)[-1]
+    return np.hstack([fp[p][:,max(x0-p*w,0):min(x1-p*w,w)] for p in range(x0//w, (x1-1)//w+1)])
+
+# =========================================================
+def get_merged(port_fp, star_fp, x0, x1):
+    '''
+    returns pings x0 to x1 of the merged (port above starboard) scan
+    '''
+    return np.vstack((np.flipud(get_pings(port_fp, x0, x1)), get_pings(star_fp, x0, x1)))
+
+# =========================================================
+def get_texture_tile(merge, win, shift, density, maxscale, notes, Nx):
+    '''
+    returns the texture lengthscale of every pixel of merge. Nx is the
+    nominal scan width (a chunk, or a whole unchunked scan), which sets the
+    median filter size
+    '''
+    Ny = np.shape(merge)[0]
+    Z,ind = humutils.sliding_window_sliced(merge, density, (win,win),(shift,shift))
+            
+    Snn = get_srt(Z,ind,maxscale, notes, win)
+    del Z
+ 
+    # replace nans using infilling algorithm
+    rn = replace_nans.RN(Snn.astype('float64'),1000,0.01,2,'localmean')
+    Snn = rn.getdata()
+    del rn 
+
+    Snn = median_filter(Snn,(int(Nx/100),int(Ny/100)))
+
+    # each pixel takes the value at its position among the window centres, so
+    # tiles cut from the same scan agree where they overlap
+    yy = np.clip((np.r_[0:Ny] - (win-1)/2)/shift, 0, ind[0]-1)
+    xx = np.clip((np.r_[0:np.shape(merge)[1]] - (win-1)/2)/shift, 0, ind[1]-1)
+    return map_coordinates(Snn, np.meshgrid(yy, xx, indexing='ij'), order=3, mode='nearest')
+
+# =========================================================
+def stream_texture(fp, port_fp, star_fp, port_fp2, star_fp2, R_fp, win, shift, density, maxscale, notes, halo, tilesize=TILESIZE):
+    '''
+    works out the texture lengthscale a tile at a time along track and writes
+    each tile to fp (a store with one chunk per tile if the scans are chunked,
+    otherwise a 2D memmap). Tiles are read with halo pings either side, taken
+    from the neighbouring chunks, and trimmed once the texture is found. Windows
+    sit on the same grid in every tile, so there are no seams between tiles.
+    A single scan is cut into tiles of tilesize pings
+    '''
+    if np.ndim(port_fp)>2:
+       tw = np.shape(port_fp)[-1]
+       npings = len(port_fp)*tw
+       nx = tw
+    else:
+       tw = tilesize
+       npings = np.shape(port_fp)[-1]
+       # the median filter is sized by the whole scan (as it was before
+       # tiling), so the result does not depend on tilesize
+       nx = npings
+
+    Ny = np.shape(port_fp)[-2] + np.shape(star_fp)[-2]
+    if halo is None:
+       # the moving window, and half the median filter in get_texture_tile
+       halo = win + shift*(int(Ny/100)//2 + 1)
+
+    if np.ndim(port_fp)>2:
+       # the range grid of the first chunk serves every chunk
+       R = np.vstack((np.flipud(R_fp[0]),R_fp[0]))
+       R = R/np.max(R)
+       rn = replace_nans.RN(R.astype('float64'),1000,0.01,2,'localmean')
+       R = rn.getdata()
+       del rn
+    else:
+       Rmax = np.max(R_fp)
+
+    for p, x0 in enumerate(range(0, npings, tw)):
+       x1 = min(x0+tw, npings)
+       # start on the window grid of the whole scan, and take at least one window
+       h1 = min(x1+halo, npings)
+       h0 = max(min(((x0-halo)//shift)*shift, ((h1-win)//shift)*shift), 0)
+
+       Sp = get_texture_tile(get_merged(port_fp, star_fp, h0, h1), win, shift, density, maxscale, notes, nx)[:,x0-h0:x1-h0]
+
+       Sp[np.isnan(get_merged(port_fp, star_fp, x0, x1))] = np.nan
+       Sp[np.isnan(get_merged(port_fp2, star_fp2, x0, x1))] = np.nan
+
+       if np.ndim(port_fp)>2:
+          Sp = (Sp**2) * np.cos(np.deg2rad(R[:,:x1-x0])) /shift ##**2
+          fp.write_chunk(p, Sp)
+       else:
+          rn = replace_nans.RN((get_merged(R_fp, R_fp, h0, h1)/Rmax).astype('float64'),1000,0.01,2,'localmean')
+          Rt = rn.getdata()[:,x0-h0:x1-h0]
+          del rn
+          fp[:,x0:x1] = (Sp**2) * np.cos(np.deg2rad(Rt)) / shift ##**2
+       del Sp
+            
 # =========================================================
 def get_kclass(Sk, numclasses):   
     Sk[np.isnan(Sk)] = 0
@@ -444,11 +478,6 @@ def custom_save(figdirec,root):
     '''
     plt.savefig(os.path.normpath(os.path.join(figdirec,root)),bbox_inches='tight',dpi=400)
 
-# =========================================================
-def parallel_me(x, maxscale, notes, win): #, density):
-   dat = cwt.Cwt(x, maxscale, notes, win) #, density)
-   return dat.getvar()
-
 # =========================================================
 def plot_class(dist_m, shape_port, dat_port, dat_star, dat_class, ft, humfile, sonpath, base, p):
 
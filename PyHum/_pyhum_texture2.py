@@ -71,7 +71,6 @@ import numpy as np
 import PyHum.utils as humutils
 from scipy.signal import convolve2d, medfilt2d
 import PyHum.replace_nans as replace_nans
-from skimage.restoration import denoise_tv_chambolle
 
 # plotting
 import matplotlib.pyplot as plt
@@ -197,25 +196,18 @@ def texture2(humfile, sonpath, win, doplot,  numclasses):
       ### port
       print("processing port side ...")
       # load memory mapped scan ... port
-      shape_port = np.squeeze(meta['shape_port'])
-      if shape_port!='':
-
-         if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat'))):
-            port_fp = io.get_mmap_data(sonpath, base, '_data_port_lar.dat', 'float32', tuple(shape_port))         
-         else:
-            port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', tuple(shape_port))
+      port = io.get_mmap_latest(sonpath, base, ['_data_port_lar.dat', '_data_port_la.dat'], 'float32')
+      if port is not None:
+         port_fp, shape_port = port
 
          port_fp2 = io.get_mmap_data(sonpath, base, '_data_port_l.dat', 'float32', tuple(shape_port))
 
       ### star
       print("processing starboard side ...")
       # load memory mapped scan ... port
-      shape_star = np.squeeze(loadmat(sonpath+base+'meta.mat')['shape_star'])
-      if shape_star!='':
-         if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat'))):
-            star_fp = io.get_mmap_data(sonpath, base, '_data_star_lar.dat', 'float32', tuple(shape_star))
-         else:
-            star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', tuple(shape_star))
+      star = io.get_mmap_latest(sonpath, base, ['_data_star_lar.dat', '_data_star_la.dat'], 'float32')
+      if star is not None:
+         star_fp, shape_star = star
 
          star_fp2 = io.get_mmap_data(sonpath, base, '_data_star_l.dat', 'float32', tuple(shape_star))
 
@@ -229,17 +221,14 @@ def texture2(humfile, sonpath, win, doplot,  numclasses):
          shape.append(shape_port[1])
          shape[1] = shape_port[0] + shape_star[0]
 
-      # create memory mapped file for Sp
-      #with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'w+') as ff:
-      #   fp = np.memmap(ff, dtype='float32', mode='w+', shape=tuple(shape))
-      fp = np.zeros(tuple(shape), dtype='float32')
-
       if len(shape_star)>2:
+         # create memory mapped file for Sp, written out a chunk at a time
+         fp = io.create_store(sonpath, base, '_data_class.dat', 'float32', tuple(shape))
 
          for p in range(len(port_fp)):
             
             merge = np.vstack((np.flipud(port_fp[p]), star_fp[p]))
-            merge = denoise_tv_chambolle(merge.copy(), weight=2, multichannel=False).astype('float32')
+            merge = humutils.denoise_tv(merge, 2)
             Snn = std_convoluted(merge, win)[1]
             del merge
  
@@ -263,18 +252,18 @@ def texture2(humfile, sonpath, win, doplot,  numclasses):
 
             Sp = (Snn**2) * np.cos(np.deg2rad(R)) /win ##**2
 
-            fp[p] = Sp.astype('float32')
+            fp.write_chunk(p, Sp)
             del Sp
 
-         #del fp # flush data to file
-         shape = io.set_mmap_data(sonpath, base, '_data_class.dat', 'float32', np.squeeze(fp))
+         fp.close() # flush data to file
+         shape = fp.shape
          del fp
          class_fp = io.get_mmap_data(sonpath, base, '_data_class.dat', 'float32', tuple(shape))
 
       else: 
 
             merge = np.vstack((np.flipud(port_fp), star_fp))
-            merge = denoise_tv_chambolle(merge.copy(), weight=2, multichannel=False).astype('float32')
+            merge = humutils.denoise_tv(merge, 2)
             Snn = std_convoluted(merge, win)[1]
             del merge
 
@@ -330,14 +319,15 @@ def texture2(humfile, sonpath, win, doplot,  numclasses):
       # k-means 
       
       if len(shape_star)>2:
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'w+') as ff:
-            fp = np.memmap(ff, dtype='float32', mode='w+', shape=tuple(shape))
+         # each chunk is written out as soon as it is made
+         fp = io.create_store(sonpath, base, '_data_kclass.dat', 'float32', tuple(shape))
 
          for p in range(len(port_fp)):
             wc = get_kclass(class_fp[p].copy(), numclasses)
-            fp[p] = wc.astype('float32')
+            fp.write_chunk(p, wc)
             del wc
 
+         fp.close()
          del fp
 
          kclass_fp = io.get_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', tuple(shape))
@@ -345,13 +335,11 @@ def texture2(humfile, sonpath, win, doplot,  numclasses):
       else:
          wc = get_kclass(class_fp.copy(), numclasses)
 
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'w+') as ff:
-            np.save(ff, np.squeeze(wc).astype('float32'))
+         kshape = io.set_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', np.squeeze(wc))
 
          del wc
-         
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'r') as ff:
-            kclass_fp = np.load(ff)
+
+         kclass_fp = io.get_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', kshape)
             
       ########################################################
       if doplot==1:
@@ -69,7 +69,7 @@ import PyHum.io as io
 import numpy as np
 import PyHum.utils as humutils
 
-import PyHum.cwt as cwt
+import PyHum.cwt_fast as cwt
 
 from skimage.segmentation import slic
 
@@ -200,25 +200,18 @@ def texture_slic(humfile, sonpath, doplot=1, numclasses=4, maxscale=20, notes=4)
       ### port
       print("processing port side ...")
       # load memory mapped scan ... port
-      shape_port = np.squeeze(meta['shape_port'])
-      if shape_port!='':
-
-         if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_port_lar.dat'))):
-            port_fp = io.get_mmap_data(sonpath, base, '_data_port_lar.dat', 'float32', tuple(shape_port))         
-         else:
-            port_fp = io.get_mmap_data(sonpath, base, '_data_port_la.dat', 'float32', tuple(shape_port))
+      port = io.get_mmap_latest(sonpath, base, ['_data_port_lar.dat', '_data_port_la.dat'], 'float32')
+      if port is not None:
+         port_fp, shape_port = port
           
          #port_fp2 = io.get_mmap_data(sonpath, base, '_data_port_l.dat', 'float32', tuple(shape_port))
 
       ### star
       print("processing starboard side ...")
       # load memory mapped scan ... port
-      shape_star = np.squeeze(loadmat(sonpath+base+'meta.mat')['shape_star'])
-      if shape_star!='':
-         if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+'_data_star_lar.dat'))):
-            star_fp = io.get_mmap_data(sonpath, base, '_data_star_lar.dat', 'float32', tuple(shape_star))
-         else:
-            star_fp = io.get_mmap_data(sonpath, base, '_data_star_la.dat', 'float32', tuple(shape_star))
+      star = io.get_mmap_latest(sonpath, base, ['_data_star_lar.dat', '_data_star_la.dat'], 'float32')
+      if star is not None:
+         star_fp, shape_star = star
 
          #star_fp2 = io.get_mmap_data(sonpath, base, '_data_star_l.dat', 'float32', tuple(shape_star))
 
@@ -260,12 +253,11 @@ def texture_slic(humfile, sonpath, doplot=1, numclasses=4, maxscale=20, notes=4)
       tl[im==0] = np.nan 
       tl[np.isnan(im)] = np.nan 
 
-      # create memory mapped file for Sp
-      with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'w+') as ff:
-         fp = np.memmap(ff, dtype='float32', mode='w+', shape=tuple(shape))
-
       counter = 0
       if len(shape_star)>2:
+         # create memory mapped file for Sp, written out a chunk at a time
+         fp = io.create_store(sonpath, base, '_data_class.dat', 'float32', tuple(shape))
+
          for p in range(len(port_fp)):
             if p==0:
                n,m = np.shape(np.vstack((np.flipud(port_fp[p]), star_fp[p])))
@@ -273,19 +265,18 @@ def texture_slic(humfile, sonpath, doplot=1, numclasses=4, maxscale=20, notes=4)
                n,m = np.shape(np.vstack((np.flipud(port_fp[p]), star_fp[p])))
             Sp = tl[:n, counter:counter+m]
             counter = counter+m
-            fp[p] = Sp.astype('float32')
+            fp.write_chunk(p, Sp)
             del Sp
-         del fp # flush data to file
+         fp.close() # flush data to file
+         del fp
 
          class_fp = io.get_mmap_data(sonpath, base, '_data_class.dat', 'float32', tuple(shape))
 
       else:
 
-            with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'w+') as ff:
-               np.save(ff, np.squeeze(Sp).astype('float32'))
+            shape = io.set_mmap_data(sonpath, base, '_data_class.dat', 'float32', np.squeeze(tl))
 
-            with open(os.path.normpath(os.path.join(sonpath,base+'_data_class.dat')), 'r') as ff:
-               class_fp = np.load(ff)
+            class_fp = io.get_mmap_data(sonpath, base, '_data_class.dat', 'float32', shape)
 
       dist_m = np.squeeze(loadmat(sonpath+base+'meta.mat')['dist_m'])
 
@@ -309,14 +300,15 @@ def texture_slic(humfile, sonpath, doplot=1, numclasses=4, maxscale=20, notes=4)
       # k-means 
       
       if len(shape_star)>2:
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'w+') as ff:
-            fp = np.memmap(ff, dtype='float32', mode='w+', shape=tuple(shape))
+         # each chunk is written out as soon as it is made
+         fp = io.create_store(sonpath, base, '_data_kclass.dat', 'float32', tuple(shape))
 
          for p in range(len(port_fp)):
             wc = get_kclass(class_fp[p].copy(), numclasses)
-            fp[p] = wc.astype('float32')
+            fp.write_chunk(p, wc)
             del wc
 
+         fp.close()
          del fp
 
          kclass_fp = io.get_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', tuple(shape))
@@ -324,13 +316,11 @@ def texture_slic(humfile, sonpath, doplot=1, numclasses=4, maxscale=20, notes=4)
       else:
          wc = get_kclass(class_fp.copy(), numclasses)
 
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'w+') as ff:
-            np.save(ff, np.squeeze(wc).astype('float32'))
+         kshape = io.set_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', np.squeeze(wc))
 
          del wc
-         
-         with open(os.path.normpath(os.path.join(sonpath,base+'_data_kclass.dat')), 'r') as ff:
-            kclass_fp = np.load(ff)
+
+         kclass_fp = io.get_mmap_data(sonpath, base, '_data_kclass.dat', 'float32', kshape)
             
       ########################################################
       if doplot==1:
@@ -375,8 +365,8 @@ def custom_save(figdirec,root):
 
 # =========================================================
 def parallel_me(x, maxscale, notes, win): 
-   dat = cwt.Cwt(x, maxscale, notes, win) 
-   return dat.getvar()
+   # filter banks are shared by all segments of the same size
+   return cwt.getvar(x[np.newaxis], maxscale, notes, win)[0]
 
 # =========================================================
 def plot_class(dist_m, shape_port, dat_port, dat_star, dat_class, ft, humfile, sonpath, base, p):
@@ -0,0 +1,134 @@
+"""
+Part of PyHum software
+
+INFO:
+batched continuous Morlet wavelet transform (as cwt.Cwt) for the texture
+lengthscale. The columns of many windows are transformed together: one real
+FFT per column, one cached (scales x frequencies) filter bank, and one
+inverse FFT for all scales at once
+
+Author:    Daniel Buscombe
+           Northern Arizona University
+           Flagstaff, AZ 86011
+           daniel.buscombe@nau.edu
+
+For latest code version please visit:
+https://github.com/dbuscombe-usgs
+
+This function is part of 'PyHum' software
+This software is in the public domain because it contains materials that originally came from the United States Geological Survey, an agency of the United States Department of Interior.
+For more information, see the official USGS copyright policy at
+http://www.usgs.gov/visual-id/credit_usgs.html#copyright
+"""
+from __future__ import division
+
+import numpy as np
+from collections import OrderedDict
+try:
+   from scipy.fft import rfft, ifft
+except:
+   from numpy.fft import rfft, ifft
+
+# largest number of transformed values (scales x samples x columns) held at once
+BATCHSIZE = 2**22
+
+# value of pi used by cwt.Cwt (single precision)
+PI = float(np.float32(3.14159265))
+
+# number of filter banks kept (least recently used are dropped first)
+MAXFILTERBANKS = 32
+
+# filter banks by (win, largestscale, notes) (see get_filterbank)
+filterbanks = OrderedDict()
+
+# =========================================================
+def get_scales(ndata, largestscale, notes):
+   '''
+   returns a log scale based on notes per octave (as Cwt._setscales)
+   '''
+   noctave = int(np.log(ndata/largestscale/2+0.0001)/np.log(2.0)+0.0001)
+   nscale = notes*noctave
+   return ndata/(largestscale*(2.0**(nscale-1-np.r_[0:nscale])/notes))
+
+# =========================================================
+def get_filterbank(win, largestscale, notes):
+   '''
+   returns the padded length, the scales, the frequency grid, the Morlet
+   filter bank (scales x frequencies) and the weights over scales used by
+   getvar, for windows of win samples. These depend only on the window and
+   scale settings, so are made once and shared by every window or segment
+   '''
+   key = (int(win), int(largestscale), int(notes))
+   if key in filterbanks:
+      # most recently used go to the end
+      bank = filterbanks.pop(key)
+      filterbanks[key] = bank
+      return bank
+
+   base2 = np.floor(np.log(win)/np.log(2) + 0.4999)
+   ndata = int(2**(base2+1))
+   scales = get_scales(ndata, largestscale, notes)
+   omega = np.r_[np.r_[0:ndata//2], np.r_[-(ndata//2):0]]*(2.0*PI/ndata)
+   s_omega = scales[:,np.newaxis]*omega[np.newaxis,:]
+   psihat = 0.75112554*np.exp(-(s_omega-6.0)**2/2.0) * np.sqrt(2.0*PI*scales)[:,np.newaxis]
+
+   nscale = len(scales)
+   n = np.r_[0:nscale]-(nscale-1)/2
+   weights = np.exp(-(0.5)*((PI/2)*n/((nscale-1)/2))**2)
+
+   if len(filterbanks)>=MAXFILTERBANKS:
+      filterbanks.popitem(last=False)
+   filterbanks[key] = (ndata, scales, omega, psihat, weights)
+   return filterbanks[key]
+
+# =========================================================
+def get_wavevar(Z, ndata, scales, psihat):
+   '''
+   returns, for each window in Z (windows x samples x columns), the variance
+   across columns of the variance along samples of the wavelet power at each
+   scale (as np.var(np.var(Cwt._getwave().T, axis=1), axis=0))
+   '''
+   nwin, win, lr = np.shape(Z)
+   Z = np.asarray(Z, 'float32')
+   data = Z - np.mean(Z, axis=1, dtype='float32')[:,np.newaxis,:]
+
+   # spectra of every column, zero padded to ndata, with the negative
+   # frequencies filled in from the positive ones
+   half = rfft(data.astype('float64'), n=ndata, axis=1)
+   datahat = np.concatenate((half, np.conj(half[:,1:ndata-ndata//2][:,::-1])), axis=1)
+   del half
+
+   # every scale at once: (windows, scales, samples, columns)
+   w = ifft(psihat[np.newaxis,:,:,np.newaxis] * datahat[:,np.newaxis,:,:], axis=2)[:,:,:win].astype('complex64')
+   w = np.abs(w)**2 / scales[np.newaxis,:,np.newaxis,np.newaxis]
+   return np.var(np.var(w, axis=2), axis=2)
+
+# =========================================================
+def getvar(Z, largestscale, notes, win):
+   '''
+   returns the wavelet lengthscale of each window in Z (windows x samples x
+   columns), as cwt.Cwt(Z[k], largestscale, notes, win).getvar() for every k
+   '''
+   ndata, scales, omega, psihat, weights = get_filterbank(win, largestscale, notes)
+   nscale = len(scales)
+   nwin = len(Z)
+   out = np.empty(nwin)
+   if nwin==0:
+      return out
+
+   lr = np.shape(Z)[-1]
+   nb = max(int(BATCHSIZE//(nscale*ndata*lr)), 1)
+   for k in range(0, nwin, nb):
+      x = np.asarray(Z[k:k+nb], 'float32')
+      dat = get_wavevar(x, ndata, scales, psihat)
+
+      dat = dat/np.sum(dat, axis=1)[:,np.newaxis] * weights
+      dat = dat/np.sum(dat, axis=1)[:,np.newaxis]
+      dat = dat/(scales**2)
+      dat = dat/np.sum(dat, axis=1)[:,np.newaxis]
+      out[k:k+nb] = np.sum(dat*scales, axis=1)
+
+      # windows with nothing in them are not transformed
+      out[k:k+nb][np.sum(x, axis=(1,2))<=0] = np.nan
+   return out
+
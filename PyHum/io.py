@@ -1,38 +1,738 @@
 
-import os
+import os, json, time, zlib, hashlib
 import numpy as np
+from joblib import Parallel, delayed, cpu_count
+
+try:
+   import lzma
+except: # python 2
+   lzma = None
+
+# compression used for arrays written by set_mmap_data and create_store:
+# None (raw memory-mappable files), 'zlib' or 'lzma' (see get_codec)
+COMPRESS = None
+
+# if True, processing stages whose inputs, metadata and parameters are
+# unchanged since they were last run are skipped (see get_stage). Off by
+# default, so every stage is rerun unless this is set, or the stage is
+# called with stage_cache=1
+STAGE_CACHE = False
 #dtype = 'int16'
 #string = '_data_port.dat'
     
 
 # =========================================================
-def get_mmap_data(sonpath, base, string, dtype, shape):
+def get_mmap_data(sonpath, base, string, dtype, shape=None):
+    # dtype and shape recorded in the header of the file, if there is one,
+    # take precedence over those given (which may be stale)
+    try:
+       header = get_store_header(sonpath, base, string)
+       dtype = header['dtype']
+       shape = tuple(header['shape'])
+    except:
+       header = {}
+
+    # compressed arrays are decompressed one chunk at a time, when indexed
+    if header.get('codec'):
+       return open_store(sonpath, base, string)
+
     #we are only going to access the portion of memory required
     with open(os.path.normpath(os.path.join(sonpath,base+string)), 'r') as ff:
        fp = np.memmap(ff, dtype=dtype, mode='r', shape=shape)
-    return fp      
-  
-# =========================================================  
-def set_mmap_data(sonpath, base, string, dtype, Zt):
+    return fp
+
+# =========================================================
+def get_store_name(sonpath, base, strings):
+    # returns the first of strings (e.g. the most processed version of a scan
+    # first) whose array file exists, or None if there are none
+    for string in strings:
+       if os.path.isfile(os.path.normpath(os.path.join(sonpath,base+string))):
+          return string
+    return None
+
+# =========================================================
+def get_mmap_latest(sonpath, base, strings, dtype):
+    # opens the first of strings whose array file exists (see get_store_name),
+    # with dtype and shape from its header if it has one (see get_mmap_data),
+    # and returns (fp, shape), or None if none of them exist
+    string = get_store_name(sonpath, base, strings)
+    if string is None:
+       return None
+    fp = get_mmap_data(sonpath, base, string, dtype)
+    return fp, np.asarray(np.shape(fp))
+
+# =========================================================
+def set_mmap_data(sonpath, base, string, dtype, Zt, compress=None):
     # create memory mapped file for Z
     #with open(os.path.normpath(os.path.join(sonpath,base+string)), 'w+') as ff:
     #   fp = np.memmap(ff, dtype=dtype, mode='w+', shape=np.shape(Zt))
+    if compress is None:
+       compress = COMPRESS
+    if compress:
+       st = create_store(sonpath, base, string, dtype, np.shape(Zt), compress=compress)
+       for k in range(st.chunks):
+          if st.chunks>1:
+             st.write_chunk(k, Zt[k])
+          else:
+             st.write_chunk(k, Zt)
+       st.close()
+       return st.shape
+
     try:
        os.remove(os.path.normpath(os.path.join(sonpath,base+string)))
     except:
        pass
 
     try:
-       with open(os.path.normpath(os.path.join(sonpath,base+string)), 'w+') as ff:
+       with open(os.path.normpath(os.path.join(sonpath,base+string)), 'w+b') as ff:
           fp = np.memmap(ff, dtype=dtype, mode='readwrite', shape=np.shape(Zt))
        fp[:] = Zt[:]
 
     except:
-       with open(os.path.normpath(os.path.join(sonpath,base+string)), 'w+') as ff:
+       with open(os.path.normpath(os.path.join(sonpath,base+string)), 'w+b') as ff:
           fp = np.memmap(ff, dtype=dtype, mode='copyonwrite', shape=np.shape(Zt))
        fp[:] = Zt[:]
 
     del fp
     shape = np.shape(Zt)
     del Zt
+    set_store_header(sonpath, base, string, dtype, shape)
     return shape      
+
+# =========================================================
+def set_mmap_stream(sonpath, base, string, dtype, shape, blocks, compress=None):
+    # like set_mmap_data, but for an array of known shape that arrives as an
+    # iterable of chunks (along the first dimension, or one block if 2d),
+    # so only one chunk needs to be held in memory at a time
+    st = create_store(sonpath, base, string, dtype, shape, compress=compress)
+    k = -1
+    for k, block in enumerate(blocks):
+       st.write_chunk(k, np.reshape(block, st.chunkshape))
+    st.close()
+    if k+1 != st.chunks:
+       print("%s: expected %i chunks, got %i" % (base+string, st.chunks, k+1))
+    return st.shape
+
+# =========================================================
+def set_mmap_append(sonpath, base, string, dtype, block):
+    # appends block as a new chunk (along the first dimension) to the array in
+    # file base+string, or creates it with block as its only chunk, and
+    # updates the header. Earlier chunks are not read or rewritten: an array
+    # that is a single 2d chunk becomes the first of several. Returns the shape
+    filename = os.path.normpath(os.path.join(sonpath,base+string))
+    try:
+       header = get_store_header(sonpath, base, string)
+    except:
+       header = None
+    if header is None or not os.path.isfile(filename):
+       st = create_store(sonpath, base, string, dtype, (1,)+np.shape(block), chunks=1)
+       st.write_chunk(0, block)
+       st.close()
+       return st.shape
+
+    shape = [int(i) for i in header['shape']]
+    if len(shape)==2:
+       shape = [1]+shape
+    if list(np.shape(block))!=shape[1:]:
+       raise ValueError("cannot append a chunk of shape %s to %s, with chunks of shape %s" % (str(np.shape(block)), base+string, str(tuple(shape[1:]))))
+
+    block = np.ascontiguousarray(block, dtype=header['dtype'])
+    if header.get('codec'):
+       buf = encode_chunk(block, header['codec'])
+    else:
+       buf = block.tobytes()
+    with open(filename, 'ab') as ff:
+       ff.seek(0, 2)
+       offset = ff.tell()
+       ff.write(buf)
+    if header.get('codec'):
+       header['index'] = list(header['index'])+[[int(offset), len(buf)]]
+
+    shape[0] += 1
+    header['shape'] = shape
+    header['chunks'] = shape[0]
+    # the array no longer holds what the stage that wrote it made,
+    # so it is identified by its size and modification time (see get_file_hash)
+    header['provenance'].pop('hash', None)
+    header['provenance']['appended'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(get_header_file(sonpath, base, string), 'w') as ff:
+       json.dump(header, ff, indent=1, sort_keys=True)
+    return tuple(shape)
+
+# =========================================================
+def set_mmap_extend(sonpath, base, string, dtype, block, blocksize=64):
+    # appends the columns (pings) of block to the 2d array in file base+string,
+    # or creates it as block, so that it stays a single (packet, npings) chunk
+    # (as PyHum.read writes with chunkmode 4), and updates the header. Unlike
+    # set_mmap_append, the array is rewritten: blocksize rows at a time if
+    # raw, or as its one chunk if compressed. Returns the shape
+    try:
+       header = get_store_header(sonpath, base, string)
+    except:
+       header = None
+    if header is None or not os.path.isfile(os.path.normpath(os.path.join(sonpath,base+string))):
+       st = create_store(sonpath, base, string, dtype, np.shape(block))
+       st.write_chunk(0, block)
+       st.close()
+       return st.shape
+
+    shape = [int(i) for i in header['shape']]
+    if len(shape)!=2 or np.ndim(block)!=2 or np.shape(block)[0]!=shape[0]:
+       raise ValueError("cannot extend %s, of shape %s, by a block of shape %s" % (base+string, str(tuple(shape)), str(np.shape(block))))
+    newshape = (shape[0], shape[1]+np.shape(block)[1])
+
+    # the array no longer holds what the stage that wrote it made (see set_mmap_append)
+    provenance = dict(header['provenance'])
+    provenance.pop('hash', None)
+    provenance['appended'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    # written to a new file, which then replaces the old one
+    tmp = '_tmp'+string
+    old = open_store(sonpath, base, string)
+    st = create_store(sonpath, base, tmp, header['dtype'], newshape, provenance=provenance, compress=header.get('codec') or False)
+    if header.get('codec'):
+       st.write_chunk(0, np.hstack((old.read_chunk(0), block)))
+    else:
+       for r in range(0, shape[0], blocksize):
+          st[r:r+blocksize, :shape[1]] = old[r:r+blocksize]
+          st[r:r+blocksize, shape[1]:] = block[r:r+blocksize]
+    old.close()
+    st.close()
+
+    newheader = get_store_header(sonpath, base, tmp)
+    newheader['file'] = base+string
+    newheader['provenance']['created'] = header['provenance'].get('created', newheader['provenance']['created'])
+    del_mmap_data(sonpath, base, string)
+    os.rename(os.path.normpath(os.path.join(sonpath,base+tmp)), os.path.normpath(os.path.join(sonpath,base+string)))
+    with open(get_header_file(sonpath, base, string), 'w') as ff:
+       json.dump(newheader, ff, indent=1, sort_keys=True)
+    del_mmap_data(sonpath, base, tmp)
+    return newshape
+
+# =========================================================
+def set_mmap_chunks(sonpath, base, string, dtype, data, nchunks, blocksize=1024):
+    # create memory mapped file for the (npings, packet) scans in data, split
+    # into nchunks chunks of (packet, npings/nchunks), and fill it in place,
+    # blocksize pings at a time. data may be any array-like that can be sliced
+    # along pings, e.g. a view of the samples in a SON file
+    try:
+       os.remove(os.path.normpath(os.path.join(sonpath,base+string)))
+    except:
+       pass
+
+    npings, packet = np.shape(data)
+    nchunks = int(nchunks)
+    w = npings//nchunks
+
+    # chunk dimension is dropped if there is only one
+    if nchunks==1:
+       shape = (packet, w)
+    else:
+       shape = (nchunks, packet, w)
+
+    with open(os.path.normpath(os.path.join(sonpath,base+string)), 'w+b') as ff:
+       fp = np.memmap(ff, dtype=dtype, mode='readwrite', shape=shape)
+
+    Z = fp.reshape((nchunks, packet, w))
+    for k in range(nchunks):
+       for j in range(0, w, blocksize):
+          n = min(blocksize, w-j)
+          Z[k,:,j:j+n] = np.asarray(data[k*w+j:k*w+j+n]).T
+
+    del Z, fp
+    set_store_header(sonpath, base, string, dtype, shape, nchunks)
+    return shape, (1, nchunks, packet, w)
+
+# =========================================================
+def map_chunks(func, inputs, outputs, chunkargs, n_jobs=None):
+    # runs func(chunk p of each input, *chunkargs[p]) for every chunk p in
+    # parallel, and writes the arrays it returns to chunk p of each output.
+    # Inputs are given as (sonpath, base, string, dtype, shape) and outputs,
+    # which must already exist (see create_store), as (sonpath, base, string),
+    # or None to drop that result. Workers open the files themselves, so no
+    # array data is passed between processes, except for compressed outputs,
+    # whose chunks are written by this process as they come back
+    if n_jobs is None:
+       n_jobs = cpu_count()
+    compressed = False
+    for o in outputs:
+       if o is not None and get_store_header(*o).get('codec'):
+          compressed = True
+
+    if not compressed:
+       Parallel(n_jobs = n_jobs, verbose=0)(delayed(run_chunk)(func, inputs, outputs, p, chunkargs[p]) for p in range(len(chunkargs)))
+       return
+
+    st = [open_store(*o, mode='r+') if o is not None else None for o in outputs]
+    for k in range(0, len(chunkargs), n_jobs):
+       w = Parallel(n_jobs = n_jobs, verbose=0)(delayed(run_chunk)(func, inputs, None, p, chunkargs[p]) for p in range(k, min(k+n_jobs, len(chunkargs))))
+       for p in range(len(w)):
+          for j in range(len(st)):
+             if st[j] is not None:
+                st[j].write_chunk(k+p, np.reshape(w[p][j], st[j].chunkshape))
+       del w
+    for j in range(len(st)):
+       if st[j] is not None:
+          st[j].close()
+
+# =========================================================
+def run_chunk(func, inputs, outputs, p, args):
+    # one task of map_chunks: returns the results only if outputs is None
+    blocks = []
+    for i in inputs:
+       fp = get_mmap_data(*i)
+       if len(np.shape(fp))>2:
+          blocks.append(np.asarray(fp[p]))
+       else:
+          blocks.append(np.asarray(fp[:]))
+       del fp
+    out = func(*(tuple(blocks)+tuple(args)))
+    if outputs is None:
+       return out
+
+    for j in range(len(outputs)):
+       if outputs[j] is not None:
+          st = open_store(*outputs[j], mode='r+')
+          st.write_chunk(p, np.reshape(out[j], st.chunkshape))
+          st.close()
+          del st
+
+# =========================================================
+def get_header_file(sonpath, base, string):
+    # name of the json header describing the array in file base+string
+    return os.path.normpath(os.path.join(sonpath,base+os.path.splitext(string)[0]+'.hdr'))
+
+# =========================================================
+def set_store_header(sonpath, base, string, dtype, shape, chunks=None, provenance=None, codec=None, index=None):
+    # write the header describing the array in file base+string:
+    # dtype, shape, number of chunks (along the first dimension) and provenance
+    # and, for compressed arrays, the codec and the (offset, nbytes) of each chunk
+    shape = [int(i) for i in shape]
+    if chunks is None:
+       if len(shape)==3:
+          chunks = shape[0]
+       else:
+          chunks = 1
+
+    if provenance is None:
+       provenance = {}
+    provenance = dict(provenance)
+    provenance['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    header = {'file': base+string, 'dtype': np.dtype(dtype).str, 'shape': shape, 'chunks': int(chunks), 'provenance': provenance}
+    if codec:
+       header['codec'] = codec
+       if index is None:
+          index = [None]*int(chunks)
+       header['index'] = index
+    try:
+       with open(get_header_file(sonpath, base, string), 'w') as ff:
+          json.dump(header, ff, indent=1, sort_keys=True)
+    except: # the array itself is still usable with a known shape
+       print("could not write header for %s" % (base+string))
+    return header
+
+# =========================================================
+def get_store_header(sonpath, base, string):
+    # read the header describing the array in file base+string
+    with open(get_header_file(sonpath, base, string), 'r') as ff:
+       return json.load(ff)
+
+# =========================================================
+def del_mmap_data(sonpath, base, string):
+    # remove an array file and its header
+    for ff in [os.path.normpath(os.path.join(sonpath,base+string)), get_header_file(sonpath, base, string)]:
+       try:
+          os.remove(ff)
+       except:
+          pass
+
+# =========================================================
+def create_store(sonpath, base, string, dtype, shape, chunks=None, provenance=None, compress=None):
+    # create an array file of the given dtype and shape, and its header,
+    # and return it opened for writing chunk by chunk (see ArrayStore)
+    # if compress is given (see get_codec), chunks are stored compressed (see CompressedStore)
+    del_mmap_data(sonpath, base, string)
+    if compress is None:
+       compress = COMPRESS
+    if compress:
+       open(os.path.normpath(os.path.join(sonpath,base+string)), 'wb').close()
+       set_store_header(sonpath, base, string, dtype, shape, chunks, provenance, get_codec(compress))
+       return open_store(sonpath, base, string, mode='r+')
+
+    with open(os.path.normpath(os.path.join(sonpath,base+string)), 'w+b') as ff:
+       fp = np.memmap(ff, dtype=dtype, mode='readwrite', shape=tuple(shape))
+    del fp
+    set_store_header(sonpath, base, string, dtype, shape, chunks, provenance)
+    return open_store(sonpath, base, string, mode='r+')
+
+# =========================================================
+def open_store(sonpath, base, string, mode='r'):
+    # open an array file by name, with dtype, shape and chunks from its header
+    header = get_store_header(sonpath, base, string)
+    if header.get('codec'):
+       return CompressedStore(os.path.normpath(os.path.join(sonpath,base+string)), header, mode)
+    return ArrayStore(os.path.normpath(os.path.join(sonpath,base+string)), header, mode)
+
+# =========================================================
+class ArrayStore(object):
+    """
+    array held in a raw file, described by a json header (see set_store_header)
+    and read or written one chunk at a time. Chunks are taken along the first
+    dimension if there is more than one, otherwise the array is a single chunk
+    """
+
+    # =========================================================
+    def __init__(self, filename, header, mode='r'):
+       self.filename = filename
+       self.header = header
+       self.dtype = np.dtype(header['dtype'])
+       self.shape = tuple(header['shape'])
+       self.chunks = int(header['chunks'])
+       self.ndim = len(self.shape)
+       if self.chunks>1:
+          self.chunkshape = self.shape[1:]
+       else:
+          self.chunkshape = self.shape
+       self.fp = np.memmap(filename, dtype=self.dtype, mode=mode, shape=self.shape)
+
+    # =========================================================
+    def __len__(self):
+       return self.shape[0]
+
+    # =========================================================
+    def __getitem__(self, ind):
+       return self.fp[ind]
+
+    # =========================================================
+    def __setitem__(self, ind, value):
+       self.fp[ind] = value
+
+    # =========================================================
+    def __array__(self, dtype=None, copy=None):
+       if dtype is not None:
+          return np.asarray(self.fp, dtype)
+       return np.asarray(self.fp)
+
+    # =========================================================
+    def read_chunk(self, k):
+       # returns a copy of chunk k
+       return np.array(self.fp.reshape((self.chunks,)+self.chunkshape)[k])
+
+    # =========================================================
+    def write_chunk(self, k, block):
+       # writes block to chunk k
+       self.fp.reshape((self.chunks,)+self.chunkshape)[k] = block
+
+    # =========================================================
+    def flush(self):
+       self.fp.flush()
+
+    # =========================================================
+    def close(self):
+       try:
+          self.fp.flush()
+       except:
+          pass
+       del self.fp
+
+# =========================================================
+def get_codec(compress):
+    # returns the codec for compress, which is the name of a compressor
+    # ('zlib' or 'lzma') or a dictionary with any of the keys:
+    # compressor, level, shuffle (store the bytes of each value by significance)
+    # and delta (store differences between neighbouring values along the last dimension)
+    if not isinstance(compress, dict):
+       compress = {'compressor': str(compress)}
+    codec = {'compressor': 'zlib', 'level': 6, 'shuffle': True, 'delta': True}
+    codec.update(compress)
+    if codec['compressor'] not in ['zlib', 'lzma']:
+       raise ValueError("compressor must be 'zlib' or 'lzma'")
+    if (codec['compressor']=='lzma') and (lzma is None):
+       print("lzma is not available - using zlib")
+       codec['compressor'] = 'zlib'
+    return codec
+
+# =========================================================
+def encode_chunk(block, codec):
+    # returns the compressed bytes of an array
+    # delta and shuffle work on the unsigned integer view of the values,
+    # so they are exactly reversible for any dtype
+    block = np.ascontiguousarray(block)
+    size = block.dtype.itemsize
+    u = block.view('u%i' % (size))
+    if codec['delta'] and u.ndim>0 and u.shape[-1]>1:
+       u = u.copy()
+       u[...,1:] = np.diff(u, axis=-1)
+    if codec['shuffle'] and size>1:
+       buf = u.view(np.uint8).reshape(-1, size).T.tobytes()
+    else:
+       buf = u.tobytes()
+    if codec['compressor']=='lzma':
+       return lzma.compress(buf, preset=int(codec['level']))
+    return zlib.compress(buf, int(codec['level']))
+
+# =========================================================
+def decode_chunk(buf, codec, dtype, shape):
+    # returns the array of the given dtype and shape compressed by encode_chunk
+    dtype = np.dtype(dtype)
+    size = dtype.itemsize
+    if codec['compressor']=='lzma':
+       buf = lzma.decompress(buf)
+    else:
+       buf = zlib.decompress(buf)
+    u = np.frombuffer(buf, dtype=np.uint8)
+    if codec['shuffle'] and size>1:
+       u = u.reshape(size, -1).T
+    u = np.ascontiguousarray(u).view('u%i' % (size)).reshape(shape)
+    if codec['delta'] and u.ndim>0 and u.shape[-1]>1:
+       u = np.cumsum(u, axis=-1, dtype=u.dtype)
+    return u.view(dtype)
+
+# =========================================================
+class CompressedStore(ArrayStore):
+    """
+    array held in a file of separately compressed chunks, described by a json
+    header holding the codec and the (offset, nbytes) of every chunk in the file
+    (see set_store_header). Only the chunks that are indexed are decompressed
+    """
+
+    # =========================================================
+    def __init__(self, filename, header, mode='r'):
+       self.filename = filename
+       self.header = header
+       self.mode = mode
+       self.dtype = np.dtype(header['dtype'])
+       self.shape = tuple(header['shape'])
+       self.chunks = int(header['chunks'])
+       self.ndim = len(self.shape)
+       if self.chunks>1:
+          self.chunkshape = self.shape[1:]
+       else:
+          self.chunkshape = self.shape
+       self.codec = header['codec']
+       self.index = header['index']
+       self.hdrfile = os.path.splitext(filename)[0]+'.hdr'
+
+    # =========================================================
+    def __getitem__(self, ind):
+       if not isinstance(ind, tuple):
+          ind = (ind,)
+       if self.chunks==1:
+          return self.read_chunk(0)[ind]
+       if isinstance(ind[0], (int, np.integer)):
+          return self.read_chunk(ind[0])[ind[1:]]
+       # several chunks
+       k = np.arange(self.chunks)[ind[0]]
+       return np.asarray([self.read_chunk(i) for i in k], self.dtype)[(slice(None),)+ind[1:]]
+
+    # =========================================================
+    def __setitem__(self, ind, value):
+       # whole chunks only
+       if self.chunks==1:
+          block = self.read_chunk(0)
+          block[ind] = value
+          self.write_chunk(0, block)
+       else:
+          self.write_chunk(ind, value)
+
+    # =========================================================
+    def __array__(self, dtype=None, copy=None):
+       out = self[:]
+       if dtype is not None:
+          return out.astype(dtype)
+       return out
+
+    # =========================================================
+    def read_chunk(self, k):
+       # returns chunk k, decompressed (zeros if it was never written)
+       k = np.arange(self.chunks)[k]
+       if self.index[k] is None:
+          return np.zeros(self.chunkshape, self.dtype)
+       offset, nbytes = self.index[k]
+       with open(self.filename, 'rb') as ff:
+          ff.seek(offset)
+          buf = ff.read(nbytes)
+       return decode_chunk(buf, self.codec, self.dtype, self.chunkshape).copy()
+
+    # =========================================================
+    def write_chunk(self, k, block):
+       # compresses block and writes it as chunk k: over the old chunk k if
+       # it fits in the space that chunk had, otherwise at the end of the file
+       k = int(np.arange(self.chunks)[k])
+       block = np.broadcast_to(np.asarray(block, self.dtype), self.chunkshape)
+       buf = encode_chunk(block, self.codec)
+       offset = None
+       if self.index[k] is not None and len(buf)<=self.get_slot(k):
+          offset = self.index[k][0]
+       with open(self.filename, 'r+b') as ff:
+          if offset is None:
+             ff.seek(0, 2)
+             offset = ff.tell()
+          else:
+             ff.seek(offset)
+          ff.write(buf)
+       self.index[k] = [int(offset), len(buf)]
+
+    # =========================================================
+    def get_slot(self, k):
+       # returns the bytes from the start of chunk k to the start of the
+       # next chunk in the file (or the end of the file)
+       offset = self.index[k][0]
+       end = os.path.getsize(self.filename)
+       for i in self.index:
+          if i is not None and i[0]>offset:
+             end = min(end, i[0])
+       return end - offset
+
+    # =========================================================
+    def compact(self):
+       # moves the chunks together, in file order, over the space left by
+       # chunks that were rewritten at the end of the file, and truncates it
+       used = sorted([(i[0], k) for k, i in enumerate(self.index) if i is not None])
+       if sum([self.index[k][1] for o, k in used]) == os.path.getsize(self.filename):
+          return
+       pos = 0
+       with open(self.filename, 'r+b') as ff:
+          for offset, k in used:
+             # chunks only ever move towards the start, so none is overwritten before it is read
+             nbytes = self.index[k][1]
+             if offset!=pos:
+                ff.seek(offset)
+                buf = ff.read(nbytes)
+                ff.seek(pos)
+                ff.write(buf)
+             self.index[k] = [int(pos), nbytes]
+             pos += nbytes
+          ff.truncate(pos)
+
+    # =========================================================
+    def flush(self):
+       # writes the chunk index to the header
+       if self.mode!='r':
+          self.header['index'] = self.index
+          with open(self.hdrfile, 'w') as ff:
+             json.dump(self.header, ff, indent=1, sort_keys=True)
+
+    # =========================================================
+    def close(self):
+       if self.mode!='r':
+          self.compact()
+       self.flush()
+
+# =========================================================
+def get_stage_file(sonpath, base, stage):
+    # name of the record of the last run of a processing stage
+    return os.path.normpath(os.path.join(sonpath,base+'_'+stage+'_stage.json'))
+
+# =========================================================
+def get_stage_hash(sonpath, base, stage, params, inputs=(), meta=None, skip=()):
+    # content address of a processing stage: md5 of its name, parameters,
+    # meta.mat fields (other than those in skip) and input files (names
+    # relative to sonpath, or absolute). Inputs written by an earlier stage
+    # are identified by the hash in their header, others by their size and
+    # modification time
+    m = hashlib.md5()
+    m.update(stage.encode('utf-8'))
+    m.update(repr(sorted(params.items())).encode('utf-8'))
+    if meta is not None:
+       for k in sorted(meta.keys()):
+          if k.startswith('__') or k in skip:
+             continue
+          m.update(k.encode('utf-8'))
+          v = np.asarray(meta[k])
+          if v.dtype.kind=='O':
+             m.update(repr(v.tolist()).encode('utf-8'))
+          else:
+             m.update((v.dtype.str+repr(v.shape)).encode('utf-8'))
+             m.update(np.ascontiguousarray(v).tobytes())
+    for f in inputs:
+       m.update(os.path.basename(f).encode('utf-8'))
+       m.update(get_file_hash(sonpath, f).encode('utf-8'))
+    return m.hexdigest()
+
+# =========================================================
+def get_file_hash(sonpath, f):
+    # hash recorded in the header of file f by the stage that wrote it,
+    # or else its size and modification time (raw SON/DAT files can be
+    # several GB, too big to read just to see whether they have changed)
+    try:
+       h = get_store_header(sonpath, '', f)['provenance']['hash']
+       if h:
+          return h
+    except:
+       pass
+    return get_file_stamp(sonpath, f)
+
+# =========================================================
+def get_file_stamp(sonpath, f):
+    # size and modification time of file f (as the SON header cache in pyread_fast)
+    try:
+       st = os.stat(os.path.normpath(os.path.join(sonpath,f)))
+    except:
+       return 'missing'
+    return '%s %s' % (str(st.st_size), repr(st.st_mtime))
+
+# =========================================================
+def get_stage(sonpath, base, stage, params, inputs=(), meta=None, skip=(), cache=None):
+    # hash of a processing stage (see get_stage_hash), to be recorded with
+    # set_stage once it has run, and True if there is nothing to do: stage
+    # caching is on (cache, or STAGE_CACHE if cache is None) and the stage
+    # was last run with the same hash (see check_stage)
+    h = get_stage_hash(sonpath, base, stage, params, inputs, meta, skip)
+    if cache is None:
+       cache = STAGE_CACHE
+    if cache and check_stage(sonpath, base, stage, h):
+       print("Inputs and parameters unchanged since last run, skipping %s (see %s)" % (stage, get_stage_file(sonpath, base, stage)))
+       return h, True
+    return h, False
+
+# =========================================================
+def check_stage(sonpath, base, stage, h):
+    # True if the stage was last run with hash h (see get_stage_hash)
+    # and its outputs are still there, unmodified by anything else
+    try:
+       with open(get_stage_file(sonpath, base, stage), 'r') as ff:
+          record = json.load(ff)
+    except:
+       return False
+    if record.get('hash')!=h:
+       return False
+    stamps = record.get('stamps', {})
+    for f in record.get('outputs', []):
+       if not os.path.isfile(os.path.normpath(os.path.join(sonpath,f))):
+          return False
+       try: # arrays are rewritten with a fresh header
+          header = get_store_header(sonpath, '', f)
+       except: # other files (meta.mat, csv, png) must be as they were left
+          if stamps.get(f)!=get_file_stamp(sonpath, f):
+             return False
+          continue
+       if header['provenance'].get('hash')!=h:
+          return False
+    return True
+
+# =========================================================
+def set_stage(sonpath, base, stage, h, outputs):
+    # record that the stage has been run with hash h, writing the hash into
+    # the headers of those of its outputs (names relative to sonpath) that have one,
+    # and the size and modification time of the others
+    outputs = [f for f in outputs if os.path.isfile(os.path.normpath(os.path.join(sonpath,f)))]
+    stamps = {}
+    for f in outputs:
+       try:
+          header = get_store_header(sonpath, '', f)
+       except:
+          stamps[f] = get_file_stamp(sonpath, f)
+          continue
+       header['provenance']['stage'] = stage
+       header['provenance']['hash'] = h
+       with open(get_header_file(sonpath, '', f), 'w') as ff:
+          json.dump(header, ff, indent=1, sort_keys=True)
+
+    record = {'stage': stage, 'hash': h, 'outputs': outputs, 'stamps': stamps, 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+       with open(get_stage_file(sonpath, base, stage), 'w') as ff:
+          json.dump(record, ff, indent=1, sort_keys=True)
+    except: # the stage will just be rerun next time
+       print("could not write stage record for %s" % (base+'_'+stage))
@@ -0,0 +1,140 @@
+"""
+Part of PyHum software
+
+INFO:
+phase preserving dynamic range compression (as ppdrc) using real input
+FFTs in single precision. The frequency grids and the Butterworth/monogenic
+filters are worked out once per shape and reused by every chunk, and very
+tall chunks are processed in overlapping tiles
+
+Author:    Daniel Buscombe
+           Northern Arizona University
+           Flagstaff, AZ 86011
+           daniel.buscombe@nau.edu
+
+For latest code version please visit:
+https://github.com/dbuscombe-usgs
+
+This function is part of 'PyHum' software
+This software is in the public domain because it contains materials that originally came from the United States Geological Survey, an agency of the United States Department of Interior.
+For more information, see the official USGS copyright policy at
+http://www.usgs.gov/visual-id/credit_usgs.html#copyright
+"""
+from __future__ import division
+
+import numpy as np
+try:
+   from scipy.fft import rfft2, irfft2
+except:
+   from numpy.fft import rfft2, irfft2
+
+# rows in each tile of a tall chunk (including the halo at either end)
+TILESIZE = 4096
+
+# filters kept per (rows, cols, wavelength, n)
+MAXFILTERS = 8
+
+# filters by shape (see get_filters)
+filters = {}
+
+# =========================================================
+def get_patterns(u1, u2, wavelength, n):
+   '''
+   Butterworth high pass filter H, and H times each of the two monogenic
+   filters, at frequencies u1, u2
+   '''
+   radius = np.sqrt(u1*u1 + u2*u2)
+   # the 0 radius value is where both monogenic filters are set to 0
+   zero = radius==0
+   r = np.where(zero, 1, radius)
+
+   H = 1.0 - 1.0 / (1.0 + (radius * wavelength)**(2*n))
+   H1 = np.where(zero, 0, 1j*u1/r)
+   H2 = np.where(zero, 0, 1j*u2/r)
+   return H, H*H1, H*H2
+
+# =========================================================
+def get_filters(rows, cols, wavelength, n):
+   '''
+   returns the Butterworth high pass filter, and that filter times each of
+   the two monogenic filters, on the half spectrum used by rfft2. These are
+   the same filters as ppdrc, made conjugate symmetric so that irfft2 gives
+   the real part ppdrc takes of each full complex ifft2
+   '''
+   key = (rows, cols, wavelength, n)
+   if key in filters:
+      return filters[key]
+
+   # horizontal and vertical frequency grids that vary from -0.5 to 0.5,
+   # quadrant shifted (as ppdrc), kept as vectors
+   v1 = np.fft.ifftshift((np.r_[0:cols]-(np.fix(cols/2)+1))/(cols-np.mod(cols,2)))
+   v2 = np.fft.ifftshift((np.r_[0:rows]-(np.fix(rows/2)+1))/(rows-np.mod(rows,2)))
+
+   # columns of the half spectrum, and the frequencies mirrored through 0
+   j = np.r_[0:cols//2+1]
+   i = np.r_[0:rows]
+   G = get_patterns(v1[j][np.newaxis,:], v2[i][:,np.newaxis], wavelength, n)
+   Gm = get_patterns(v1[-j % cols][np.newaxis,:], v2[-i % rows][:,np.newaxis], wavelength, n)
+
+   # keep the part of each filter that is conjugate symmetric about 0 frequency
+   out = tuple(((g + np.conj(gm))/2).astype('complex64') for g, gm in zip(G, Gm))
+
+   if len(filters)>=MAXFILTERS:
+      filters.clear()
+   filters[key] = out
+   return filters[key]
+
+# =========================================================
+def ppdrc_tile(im, wavelength, n):
+   '''
+   ppdrc of a single 2D array, in float32
+   '''
+   eps = np.float32(2.2204e-16)
+   rows, cols = np.shape(im)
+   H, H1, H2 = get_filters(rows, cols, wavelength, n)
+
+   IM = rfft2(im)
+   f = irfft2(H*IM, s=(rows, cols))
+   h1f = irfft2(H1*IM, s=(rows, cols))
+   h2f = irfft2(H2*IM, s=(rows, cols))
+   del IM
+
+   h1f *= h1f
+   h2f *= h2f
+   h1f += h2f # squared amplitude of the monogenic pair
+   del h2f
+   E = np.log1p(np.sqrt(f*f + h1f))
+   h1f += eps
+   np.sqrt(h1f, h1f)
+   np.divide(f, h1f, f)
+   np.arctan(f, f)
+   np.sin(f, f)
+   f *= E
+   return f
+
+# =========================================================
+def ppdrc(im, wavelength=768, n=2, tilesize=TILESIZE):
+   '''
+   phase preserving dynamic range compression of im, returned as float32
+
+   chunks with more rows than tilesize are split into tiles of tilesize
+   rows that overlap by a halo of wavelength rows, and only the middle of
+   each tile is kept
+   '''
+   im = np.asarray(im, dtype='float32')
+   wavelength = int(wavelength)
+   rows, cols = np.shape(im)
+
+   halo = max(wavelength, 1)
+   core = tilesize - 2*halo
+   if rows<=tilesize or core<halo:
+      return ppdrc_tile(im, wavelength, n)
+
+   res = np.empty((rows, cols), dtype='float32')
+   for s in range(0, rows, core):
+      e = min(s+core, rows)
+      # every tile is tilesize rows so one set of filters is used throughout
+      w0 = min(max(s-halo, 0), rows-tilesize)
+      res[s:e] = ppdrc_tile(im[w0:w0+tilesize], wavelength, n)[s-w0:e-w0]
+   return res
+
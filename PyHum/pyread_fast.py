@@ -0,0 +1,687 @@
+"""
+Part of PyHum software
+
+INFO:
+vectorized reader for Humminbird(R) .SON/.IDX/.DAT files
+each SON file is read in bulk and packets are decoded with numpy structured
+dtypes, rather than byte by byte as in pyread and pyread_single
+
+Author:    Daniel Buscombe
+           Northern Arizona University
+           Flagstaff, AZ 86011
+           daniel.buscombe@nau.edu
+
+For latest code version please visit:
+https://github.com/dbuscombe-usgs
+
+This function is part of 'PyHum' software
+This software is in the public domain because it contains materials that originally came from the United States Geological Survey, an agency of the United States Department of Interior.
+For more information, see the official USGS copyright policy at
+http://www.usgs.gov/visual-id/credit_usgs.html#copyright
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os, hashlib
+import numpy as np
+from numpy.lib.stride_tricks import as_strided as ast
+import pyproj
+from joblib import Parallel, delayed, cpu_count
+
+import PyHum.utils as humutils
+
+# number of pings gathered at once (bounds the size of temporary index arrays)
+BLOCKSIZE = 4096
+
+# number of bytes searched at once for packet start sequences
+SCANSIZE = 2**26
+
+# smallest number of pings worth decoding in a separate process
+MINRANGE = 4*BLOCKSIZE
+
+# start sequence of every SON packet
+SYNC = [192,222,171,33,128]
+
+# channel names, indexed by the beam byte in each packet header
+CHANNELS = {0: 'down_lowfreq', 1: 'down_highfreq', 2: 'sidescan_port', 3: 'sidescan_starboard', 4: 'down_vhighfreq'}
+
+# =========================================================
+def get_headbytes(model):
+   '''
+   returns the number of bytes in a packet header for a given model
+   '''
+   if model==798:
+      return 72
+   elif model in [1199, 0, 1, 2]: #1199, onix, helix, mega
+      return 68
+   else: #tested so far 998, 1198, 898
+      return 67
+
+# =========================================================
+def get_head_dtype(model):
+   '''
+   returns a numpy structured dtype describing the (big-endian) packet header
+   the first 29 bytes are common to all models
+   '''
+   names = ['recnum', 'time_ms', 'x_utm', 'y_utm', 'gps1', 'heading']
+   formats = ['>i4', '>i4', '>i4', '>i4', '>i2', '>i2']
+   offsets = [5, 10, 15, 20, 25, 27]
+
+   if model==798:
+      names += ['gps2', 'speed', 'depth', 'beam', 'voltscale', 'freq', 'sentlen']
+      formats += ['>i2', '>i2', '>i4', 'u1', 'u1', '>i4', '>i4']
+      offsets += [30, 32, 40, 45, 47, 49, 67]
+   elif model in [1199, 0, 1, 2]: # no sentlen in header, linesize from .DAT is used
+      names += ['gps2', 'speed', 'depth', 'beam', 'voltscale', 'freq']
+      formats += ['>i2', '>i2', '>i4', 'u1', 'u1', '>i4']
+      offsets += [30, 32, 40, 45, 47, 49]
+   else:
+      names += ['gps2', 'speed', 'depth', 'beam', 'voltscale', 'freq', 'sentlen']
+      formats += ['>i2', '>i2', '>i4', 'u1', 'u1', '>i4', '>i4']
+      offsets += [30, 32, 35, 40, 42, 44, 62]
+
+   return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': get_headbytes(model)})
+
+# =========================================================
+def read_idx(idxfile):
+   '''
+   returns the byte offset of each packet in a SON file, from its IDX file
+   each IDX record is 8 bytes: a 4 byte time and a 4 byte offset
+   '''
+   dat = np.fromfile(idxfile, dtype='>u4')
+   dat = dat[:2*(len(dat)//2)].reshape(-1,2)
+   return dat[:,1].astype('int64')
+
+# =========================================================
+def check_idx(buf, fbreak):
+   '''
+   returns True if every offset in fbreak is the start of a packet in buf
+   '''
+   if len(fbreak)<2 or fbreak[-1]+len(SYNC)>len(buf) or np.any(np.diff(fbreak)<=0):
+      return False
+   for k in range(len(SYNC)):
+      if np.any(buf[fbreak+k]!=SYNC[k]):
+         return False
+   return True
+
+# =========================================================
+def find_packets(buf):
+   '''
+   returns the byte offset of every packet start sequence in buf
+   (replaces the Knuth-Morris-Pratt search over a list of ints in pyread)
+   buf is searched in blocks, so it may be a memory-mapped SON file
+   '''
+   fbreak = []
+   n = len(SYNC)
+   for k in range(0, len(buf), SCANSIZE):
+      blk = np.asarray(buf[k:k+SCANSIZE+n-1])
+      cand = np.flatnonzero(blk[:len(blk)-n+1]==SYNC[0])
+      for j in range(1, n):
+         cand = cand[blk[cand+j]==SYNC[j]]
+      fbreak.append(cand+k)
+   return np.hstack(fbreak).astype('int64')
+
+# =========================================================
+def write_idx(idxfile, fbreak, time_ms):
+   '''
+   writes an IDX file (4 byte time, 4 byte offset for each packet)
+   '''
+   np.vstack((time_ms, fbreak)).T.astype('>u4').tofile(idxfile)
+
+# =========================================================
+def gather(buf, start, nbytes, length=None):
+   '''
+   returns a (len(start), nbytes) uint8 matrix of the bytes in buf
+   beginning at each position in start. Where length is given, bytes
+   beyond length (or beyond the end of buf) are zero
+   '''
+   out = np.zeros((len(start), nbytes), dtype=np.uint8)
+   r = np.arange(nbytes, dtype='int64')
+   for k in range(0, len(start), BLOCKSIZE):
+      ind = start[k:k+BLOCKSIZE,np.newaxis] + r
+      valid = ind < len(buf)
+      if length is not None:
+         valid &= r < length[k:k+BLOCKSIZE,np.newaxis]
+      out[k:k+BLOCKSIZE] = np.where(valid, buf[np.where(valid, ind, 0)], 0)
+   return out
+
+# =========================================================
+def get_pingview(buf, start, packet, length):
+   '''
+   returns a read-only (len(start), packet) view of the sonar samples in buf
+   where packets are equally spaced and long enough, this is a strided view
+   (no copy). Otherwise a PingView, which gathers pings only when indexed
+   '''
+   if len(start)>1:
+      stride = np.diff(start)
+      regular = np.all(stride==stride[0])
+      stride = int(stride[0])
+   else:
+      regular = True
+      stride = packet
+
+   if regular and (len(start)>0) and np.all(length>=packet) and (start[-1]+packet<=len(buf)):
+      return ast(buf[start[0]:], shape=(len(start), packet), strides=(stride, buf.strides[0]), writeable=False)
+   else:
+      return PingView(buf, start, packet, length)
+
+# =========================================================
+class PingView(object):
+   """
+   read-only (npings, packet) view of the sonar samples in a (memory-mapped)
+   SON file, for packets of unequal length. Pings are gathered from the file
+   only when indexed, so the full channel is never held in memory
+   """
+
+   # =========================================================
+   def __init__(self, buf, start, packet, length):
+      self.buf = buf
+      self.start = np.asarray(start, 'int64')
+      self.length = np.asarray(length, 'int64')
+      self.shape = (len(self.start), packet)
+      self.dtype = np.dtype(np.uint8)
+      self.ndim = 2
+
+   # =========================================================
+   def __len__(self):
+      return self.shape[0]
+
+   # =========================================================
+   def __getitem__(self, ind):
+      if isinstance(ind, tuple):
+         out = self[ind[0]]
+         if out.ndim==1:
+            return out[ind[1:]]
+         return out[(slice(None),)+ind[1:]]
+      if isinstance(ind, (int, np.integer)):
+         ind = np.arange(self.shape[0])[ind]
+         return gather(self.buf, self.start[ind:ind+1], self.shape[1], self.length[ind:ind+1])[0]
+      return gather(self.buf, self.start[ind], self.shape[1], self.length[ind])
+
+   # =========================================================
+   def __array__(self, dtype=None, copy=None):
+      out = self[:]
+      if dtype is not None:
+         return out.astype(dtype)
+      return out
+
+   # =========================================================
+   def astype(self, dtype):
+      return np.asarray(self).astype(dtype)
+
+   @property
+   def T(self):
+      return np.asarray(self).T
+
+# =========================================================
+def decode_heads(buf, start, model):
+   '''
+   returns a structured array of packet headers starting at each position in start
+   (packed, i.e. without the spacer bytes between fields)
+   '''
+   dt = get_head_dtype(model)
+   head = gather(buf, start, dt.itemsize).view(dt).ravel()
+   out = np.empty(len(head), dtype=[(name, dt.fields[name][0]) for name in dt.names])
+   for name in dt.names:
+      out[name] = head[name]
+   return out
+
+# =========================================================
+def get_cachefile(sonfile):
+   '''
+   returns the name of the header cache file for a SON file
+   '''
+   return sonfile.split('.SON')[0]+'_head.npz'
+
+# =========================================================
+def get_fingerprint(sonfile, model):
+   '''
+   returns a string identifying the contents of a SON file and its IDX file:
+   model, SON file size and modification time, and md5 hash of the IDX file
+   '''
+   try:
+      with open(sonfile.split('.SON')[0]+'.IDX', 'rb') as ff:
+         idxhash = hashlib.md5(ff.read()).hexdigest()
+   except:
+      idxhash = ''
+   st = os.stat(sonfile)
+   return '%s %s %s %s' % (str(model), str(st.st_size), repr(st.st_mtime), idxhash)
+
+# =========================================================
+def load_heads(sonfile, model):
+   '''
+   returns (fbreak, head) from the header cache of a SON file,
+   or None if there is no cache or it does not match the SON/IDX files
+   '''
+   try:
+      dat = np.load(get_cachefile(sonfile))
+      try:
+         if str(dat['fingerprint'])==get_fingerprint(sonfile, model):
+            return dat['fbreak'], dat['head']
+      finally:
+         dat.close()
+   except:
+      pass
+   return None
+
+# =========================================================
+def save_heads(sonfile, model, fbreak, head):
+   '''
+   writes packet offsets and decoded headers of a SON file to its header cache
+   '''
+   try:
+      with open(get_cachefile(sonfile), 'wb') as ff:
+         np.savez(ff, fingerprint=np.asarray(get_fingerprint(sonfile, model)), fbreak=fbreak, head=head)
+   except: # e.g. SON files in a read-only directory
+      print("could not write header cache for %s" % (sonfile))
+
+# =========================================================
+def decode_humdat(humfile, model):
+   '''
+   returns data from .DAT file
+   '''
+   with open(humfile, 'rb') as fid2:
+      dumpstr = fid2.read()
+
+   if model==0: #onix
+      return decode_onix(dumpstr)
+
+   dt = np.dtype({'names': ['water_code', 'sonar_name', 'unix_time', 'utm_x', 'utm_y', 'filename', 'numrecords', 'recordlens_ms', 'linesize'],
+                  'formats': ['u1', '>i4', '>i4', '>i4', '>i4', 'S10', '>i4', '>i4', '>i4'],
+                  'offsets': [1, 4, 20, 24, 28, 32, 44, 48, 52], 'itemsize': 56})
+   h = np.frombuffer(dumpstr[:dt.itemsize], dtype=dt)[0]
+
+   water_type = {0: 'fresh', 1: 'deep salt', 2: 'shallow salt'}.get(int(h['water_code']), 'unknown')
+
+   humlat = np.float32(np.arctan(np.tan(np.arctan(np.exp(h['utm_y']/ 6378388.0)) * 2.0 - 1.570796326794897) * 1.0067642927) * 57.295779513082302)
+   humlon = np.float32(h['utm_x'] * 57.295779513082302 / 6378388.0)
+
+   return {'water_code': int(h['water_code']), 'sonar_name': str(int(h['sonar_name'])), 'unix_time': int(h['unix_time']), 'utm_x': int(h['utm_x']), 'utm_y': int(h['utm_y']), 'filename': h['filename'].decode('latin-1'), 'numrecords': int(h['numrecords']), 'recordlens_ms': int(h['recordlens_ms']), 'linesize': int(h['linesize']), 'water_type': water_type, 'lat': float(humlat), 'lon': float(humlon) }
+
+# =========================================================
+def decode_onix(dumpstr):
+   '''
+   returns data from onix .DAT file
+   '''
+   tmp = ''.join(dumpstr.decode('latin-1').split('<')[1:])
+   humdat = {}
+   for key, name in [('NumberOfPings','NumberOfPings'), ('TotalTimeMs','TotalTimeMs'), ('linesize','PingSizeBytes'), ('FirstPingPeriodMs','FirstPingPeriodMs'), ('BeamMask','BeamMask'),
+                     ('Chirp1StartFrequency','Chirp1StartFrequency'), ('Chirp1EndFrequency','Chirp1EndFrequency'), ('Chirp2StartFrequency','Chirp2StartFrequency'), ('Chirp2EndFrequency','Chirp2EndFrequency'),
+                     ('Chirp3StartFrequency','Chirp3StartFrequency'), ('Chirp3EndFrequency','Chirp3EndFrequency'),
+                     ('SourceDeviceModelId2D','SourceDeviceModelId2D'), ('SourceDeviceModelIdSI','SourceDeviceModelIdSI'), ('SourceDeviceModelIdDI','SourceDeviceModelIdDI')]:
+      humdat[key] = int(tmp.split(name+'=')[1].split('>')[0])
+   return humdat
+
+# =========================================================
+def get_fbreak(sonfile, buf, model, writeidx=False):
+   '''
+   returns the byte offset of every packet in a SON file (whose contents are buf)
+   from the IDX file or, if that is absent or corrupt, by searching buf
+   '''
+   idxfile = sonfile.split('.SON')[0]+'.IDX'
+   try: #faster to use the idx file, if it exists
+      fbreak = read_idx(idxfile)
+   except:
+      fbreak = []
+
+   if not check_idx(buf, fbreak): #if idx is absent, or empty, or if son files are corrupted
+      print("%s is absent or corrupt: searching %s for packets" % (idxfile, sonfile))
+      fbreak = find_packets(buf)
+      if len(fbreak)<2:
+         raise IOError('%s contains no packets' % (sonfile))
+      if writeidx:
+         write_idx(idxfile, fbreak, decode_heads(buf, fbreak, model)['time_ms'])
+
+   return fbreak
+
+# =========================================================
+def get_packet(head, humdat):
+   '''
+   returns the number of samples per ping: the sentence length of the
+   first packet or, for models without one in the header, the .DAT linesize
+   '''
+   if 'sentlen' in head.dtype.names:
+      return int(head['sentlen'][0])
+   else:
+      return int(humdat['linesize'])
+
+# =========================================================
+def iter_pings(sonfile, humfile, model=998, blocksize=BLOCKSIZE, packet=None):
+   '''
+   yields consecutive blocks of pings from a SON file, as
+   (head, data) where head is a structured array of blocksize packet headers
+   (see get_head_dtype) and data is a (blocksize, packet) uint8 matrix of samples
+
+   the SON file is memory mapped and each block is only read when requested,
+   so memory use does not grow with the length of the recording
+
+   packet: number of samples per ping. By default, that of the first packet
+   '''
+   humdat = decode_humdat(humfile, model)
+   headbytes = get_headbytes(model)
+
+   buf = np.memmap(sonfile, dtype=np.uint8, mode='r')
+
+   # use the header cache, if there is a valid one
+   dat = load_heads(sonfile, model)
+   if dat is not None:
+      fbreak, heads = dat
+   else:
+      fbreak = get_fbreak(sonfile, buf, model)
+      heads = None
+
+   # the last packet has no following offset, so (as in pyread) it is not used
+   start = fbreak[:-1]
+   dfbreak = np.diff(fbreak)
+
+   if packet is None:
+      packet = get_packet(decode_heads(buf, start[:1], model), humdat)
+
+   for k in range(0, len(start), blocksize):
+      if heads is not None:
+         head = heads[k:k+blocksize]
+      else:
+         head = decode_heads(buf, start[k:k+blocksize], model)
+      yield head, gather(buf, start[k:k+blocksize]+headbytes, packet, dfbreak[k:k+blocksize]-headbytes)
+
+# =========================================================
+def decode_range(sonfile, start, length, model, packet):
+   '''
+   returns (head, data) for the packets of a SON file beginning at each
+   position in start (see decode_heads and gather). If packet is None,
+   only headers are decoded and data is None
+   '''
+   headbytes = get_headbytes(model)
+   buf = np.memmap(sonfile, dtype=np.uint8, mode='r')
+   head = decode_heads(buf, start, model)
+   if packet is None:
+      return head, None
+   return head, gather(buf, start+headbytes, packet, length-headbytes)
+
+# =========================================================
+def decode_parallel(sonfile, start, length, model, packet=None, n_jobs=-1):
+   '''
+   as decode_range, but the packets are split into contiguous ranges
+   which are decoded concurrently in n_jobs processes (all cpus if -1).
+   Ranges are merged back in file (i.e. recnum) order
+   '''
+   if n_jobs<1:
+      n_jobs = cpu_count()
+   n_jobs = int(np.max([1, np.min([n_jobs, len(start)//MINRANGE])]))
+
+   if n_jobs==1:
+      return decode_range(sonfile, start, length, model, packet)
+
+   bounds = np.linspace(0, len(start), n_jobs+1).astype('int64')
+   o = Parallel(n_jobs = n_jobs, verbose=0)(delayed(decode_range)(sonfile, start[bounds[k]:bounds[k+1]], length[bounds[k]:bounds[k+1]], model, packet) for k in range(n_jobs))
+   head, data = zip(*o)
+
+   if packet is None:
+      return np.concatenate(head), None
+   return np.concatenate(head), np.vstack(data)
+
+# =========================================================
+def get_trans(cs2cs_args1):
+   '''
+   returns a pyproj projection object
+   '''
+   try:
+      return pyproj.Proj(init=cs2cs_args1)
+   except:
+      return pyproj.Proj(cs2cs_args1.lstrip(), inverse=True)
+
+# =========================================================
+def beam_pos(head, c, trans):
+   '''
+   returns lat, lon, northing and easting of the sidescan beam for every ping
+   in head (see calc_beam_pos)
+   '''
+   return calc_beam_pos(head['x_utm'], head['y_utm'], head['depth']/10, head['heading']/10, c, trans)
+
+# =========================================================
+def calc_beam_pos(x_utm, y_utm, depth_m, heading_deg, c, trans):
+   '''
+   returns lat, lon, northing and easting of the sidescan beam for pings
+   at the given (Humminbird mercator) positions, depths and headings. Arithmetic is
+   rounded to single precision at the same points as the per-ping calculation
+   formerly in pyread._gethead, so results are the same
+   '''
+   depth_m = np.asarray(depth_m, 'float64')
+   heading_deg = np.asarray(heading_deg, 'float64')
+
+   tvg = np.float32(((8.5*10**-5)+(3/76923)+((8.5*10**-5)/4))*np.float32(c))
+   pi = np.float32(3.14159265)
+
+   dist = (np.tan(25*0.0174532925)*depth_m + np.float64(tvg)).astype('float32')
+   bearing = (0.0174532925*heading_deg - np.float64(pi/np.float32(2))).astype('float32')
+   bearing = np.fmod(bearing, np.float32(360))
+
+   dist_x = (dist*np.sin(bearing.astype('float64'))).astype('float32')
+   dist_y = (dist*np.cos(bearing.astype('float64'))).astype('float32')
+   x_utm = np.asarray(x_utm, 'float64') + dist_x.astype('float64')
+   y_utm = np.asarray(y_utm, 'float64') + dist_y.astype('float64')
+
+   lat = (np.arctan(np.tan(np.arctan(np.exp(y_utm/ 6378388.0)) * 2.0 - 1.570796326794897) * 1.0067642927) * 57.295779513082302).astype('float32')
+   lon = (x_utm * 57.295779513082302 / 6378388.0).astype('float32')
+
+   e, n = trans(lon.astype('float64'), lat.astype('float64'))
+   return lat.astype('float64'), lon.astype('float64'), np.asarray(n, 'float32').astype('float64'), np.asarray(e, 'float32').astype('float64')
+
+# =========================================================
+class pyread(object):
+   """
+   read a humminbird SON file (vectorized)
+   """
+
+   # =========================================================
+   def __init__(self, sonfile, humfile, c, model=998, cs2cs_args1="epsg:26949", mmap=False, writeidx=False, cache=False, n_jobs=1):
+      """
+      PyRead
+
+      sonfile:     path to the .SON file. If the associated .IDX file is
+                   absent or corrupt, packets are found by searching the
+                   SON file for their start sequence
+      humfile:     path to the .DAT file
+      c:           speed of sound in water (m/s)
+      model:       Humminbird model code
+      cs2cs_args1: projection argument given to pyproj
+      mmap:        if True, the SON file is memory mapped and the scan is
+                   a view of the raw samples in the file (see get_pingview)
+      writeidx:    if True, and the .IDX file was absent or corrupt, a new
+                   one is written next to the SON file
+      cache:       if True, packet offsets and decoded headers are kept in a
+                   cache file next to the SON file (see get_cachefile), and
+                   loaded from there while the SON and IDX files are unchanged
+      n_jobs:      number of processes the packets are decoded in (all cpus
+                   if -1). See decode_parallel
+      """
+      self.trans = get_trans(cs2cs_args1)
+      self.humdat = decode_humdat(humfile, model)
+      self.c = c
+      self.model = model
+
+      headbytes = get_headbytes(model)
+
+      if mmap:
+         buf = np.memmap(sonfile, dtype=np.uint8, mode='r')
+      else:
+         buf = np.fromfile(sonfile, dtype=np.uint8)
+
+      dat = None
+      if cache:
+         dat = load_heads(sonfile, model)
+
+      if dat is not None:
+         fbreak, self.head = dat
+      else:
+         fbreak = get_fbreak(sonfile, buf, model, writeidx)
+
+      # the last packet has no following offset, so (as in pyread) it is not used
+      start = fbreak[:-1]
+      dfbreak = np.diff(fbreak)
+
+      packet = get_packet(decode_heads(buf, start[:1], model), self.humdat)
+
+      self.data = None
+      if dat is None:
+         if n_jobs==1:
+            self.head = decode_heads(buf, start, model)
+         elif mmap:
+            self.head, _ = decode_parallel(sonfile, start, dfbreak, model, None, n_jobs)
+         else:
+            self.head, self.data = decode_parallel(sonfile, start, dfbreak, model, packet, n_jobs)
+         if cache:
+            save_heads(sonfile, model, fbreak, self.head)
+
+      # payload lengths, truncated/padded to the sentence length of the first packet
+      if mmap:
+         self.data = get_pingview(buf, start+headbytes, packet, dfbreak-headbytes)
+      elif self.data is None:
+         self.data = gather(buf, start+headbytes, packet, dfbreak-headbytes)
+      del buf
+
+      self.sonarstring = CHANNELS.get(int(self.head['beam'][0]), 'unknown')
+      return
+
+   # external functions ======================================
+   # =========================================================
+   def gethumdat(self):
+      """
+      returns data in .DAT file
+      """
+      return self.humdat
+
+   # =========================================================
+   def getheads(self):
+      """
+      returns the structured array of packet headers
+      """
+      return self.head
+
+   # =========================================================
+   def getscan(self):
+      """
+      returns compiled scan
+      """
+      if self.sonarstring=='unknown':
+         raise ValueError('unknown sonar channel (beam %s)' % (str(self.head['beam'][0])))
+      return (np.asarray(self.data).T.astype('float16'), self.sonarstring)
+
+   # =========================================================
+   def getpings(self):
+      """
+      returns the (npings, packet) uint8 sonar samples and channel name.
+      In mmap mode these are a view over the SON file rather than a copy
+      """
+      if self.sonarstring=='unknown':
+         raise ValueError('unknown sonar channel (beam %s)' % (str(self.head['beam'][0])))
+      return (self.data, self.sonarstring)
+
+   # =========================================================
+   def getmetadata(self):
+      """
+      returns meta data
+      """
+      return get_metadata(self.head, self.humdat, self.c, self.trans)
+
+# =========================================================
+class pytail(object):
+   """
+   follow a SON file that is still being recorded
+   each call to poll decodes only the packets appended since the last call
+   """
+
+   # =========================================================
+   def __init__(self, sonfile, humfile, c, model=998, cs2cs_args1="epsg:26949", offset=0):
+      """
+      PyTail
+
+      sonfile:     path to the .SON file
+      humfile:     path to the .DAT file
+      c:           speed of sound in water (m/s)
+      model:       Humminbird model code
+      cs2cs_args1: projection argument given to pyproj
+      offset:      byte offset in the SON file of the first packet to decode
+      """
+      self.trans = get_trans(cs2cs_args1)
+      self.humdat = decode_humdat(humfile, model)
+      self.sonfile = sonfile
+      self.c = c
+      self.model = model
+      self.offset = offset
+      self.packet = None
+      self.sonarstring = None
+      self.starts = np.array([], 'int64')
+      return
+
+   # =========================================================
+   def poll(self):
+      """
+      returns (head, data) for the packets appended to the SON file since
+      the last call (see pyread), or None if there are none yet. A packet
+      is only decoded once the start of the next one has been written
+      """
+      headbytes = get_headbytes(self.model)
+      if os.path.getsize(self.sonfile) <= self.offset+headbytes:
+         return None
+
+      buf = np.memmap(self.sonfile, dtype=np.uint8, mode='r', offset=self.offset)
+      fbreak = find_packets(buf)
+      if len(fbreak)<2:
+         return None
+
+      start = fbreak[:-1]
+      head = decode_heads(buf, start, self.model)
+      if self.packet is None:
+         # samples per ping are those of the first packet in the file (as pyread),
+         # which may be before offset
+         whole = np.memmap(self.sonfile, dtype=np.uint8, mode='r')
+         first = decode_heads(whole, find_packets(whole[:2**16])[:1], self.model)
+         del whole
+         self.packet = get_packet(first, self.humdat)
+         self.sonarstring = CHANNELS.get(int(first['beam'][0]), 'unknown')
+
+      data = gather(buf, start+headbytes, self.packet, np.diff(fbreak)-headbytes)
+      # byte offsets in the SON file of the packets returned
+      self.starts = self.offset + start
+      self.offset += int(fbreak[-1])
+      del buf
+      return head, data
+
+   # =========================================================
+   def getmetadata(self, head):
+      """
+      returns meta data for packet headers returned by poll
+      """
+      return get_metadata(head, self.humdat, self.c, self.trans)
+
+# =========================================================
+def get_metadata(head, humdat, c, trans):
+   '''
+   returns a dictionary of meta data (positions, speed, time, depth, heading)
+   for every ping in head
+   '''
+   lat, lon, n, e = beam_pos(head, c, trans)
+
+   hdg2 = np.asarray(head['heading']/10, 'float')
+
+   # remove headings with bad gps flags
+   hdg2[head['gps1']==0] = np.nan
+   hdg2[head['gps2']==0] = np.nan
+
+   try:
+      nans, y= humutils.nan_helper(hdg2)
+      hdg2[nans]= np.interp(y(nans), y(~nans), hdg2[~nans])
+   except:
+      pass
+
+   time_s = head['time_ms']/1000
+
+   try:
+      starttime = np.asarray(humdat['unix_time'], 'float')
+      caltime = np.asarray(starttime + time_s, 'float')
+   except:
+      caltime = 0
+
+   metadict={'lat': lat, 'lon': lon, 'spd': head['speed']/10, 'time_s': time_s, 'e': e, 'n': n, 'dep_m': head['depth']/10, 'caltime': np.asarray(caltime), 'heading': hdg2 }
+   return metadict
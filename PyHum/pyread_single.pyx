@@ -25,13 +25,14 @@ from __future__ import division
 
 import numpy as np
 cimport numpy as np
-from libc.math cimport tan, atan, exp, sin, cos
+from libc.math cimport tan, atan, exp
 
 from array import array as arr
 import pyproj
 import os, struct
 
 import PyHum.utils as humutils
+import PyHum.pyread_fast as pyread_fast
 
 # =========================================================
 cdef class pyread:
@@ -40,7 +41,8 @@ cdef class pyread:
     """
     cdef object trans
     #cdef object transWGS84
-    cdef object data
+    cdef object scans
+    cdef object heads
     cdef object humdat
     
     # =========================================================
@@ -85,7 +87,6 @@ cdef class pyread:
        cdef list data = [] 
        cdef list dfbreak = []  
        cdef list ints_list = []   
-       cdef list int_list = [] 
        cdef list fbreak=[]
        cdef list tmpdata = [] 
               
@@ -107,7 +108,7 @@ cdef class pyread:
 
              fid = open(sonfile,'rb')
              for i from 0 <= i < len(dfbreak):       
-                tmpdata.append(self._gethead(fid,trans,c, model, humdat['linesize']))
+                tmpdata.append(self._gethead(fid, model, humdat['linesize']))
                 ints_list = []
                 for j from 0 <= j < dfbreak[i]-headbytes:                 
                    ints_list.append(struct.unpack('>B', ''.join(self._fread(fid,1,'c')) )[0])
@@ -119,26 +120,15 @@ cdef class pyread:
              fid.close()
 
           except: #if idx is absent, or empty, or if son files are corrupted
-             fid = open(sonfile,'rb')
-             dat = self._fread(fid,os.path.getsize(sonfile), 'c')
-             fid.close()
-
-             # unpack into integers
-             for i from 0 <= i < len(dat):
-                int_list.append(struct.unpack('>B', dat[i])[0])
-             dat = [] 
-
-             # find the start sequences in the list of integers
-             for s in self._KnuthMorrisPratt(int_list, [192,222,171,33,128]): 
-                fbreak.append(s)
-             int_list = [] 
+             # find the start sequences in the file
+             fbreak = pyread_fast.find_packets(np.memmap(sonfile, dtype=np.uint8, mode='r')).tolist()
           
              dfbreak = [ x-y for (x,y) in zip(fbreak[1:],fbreak[:-1]) ]
              fbreak = []
      
              fid = open(sonfile,'rb')
              for i from 0 <= i < len(dfbreak):
-                tmpdata.append(self._gethead(fid,trans, c, model, humdat['linesize'])) # get header for packet transWGS84,
+                tmpdata.append(self._gethead(fid, model, humdat['linesize'])) # get header for packet transWGS84,
                 ints_list = []
                 for j from 0 <= j < dfbreak[i]-headbytes: 
                    ints_list.append(struct.unpack('>B', ''.join(self._fread(fid,1,'c')) )[0])
@@ -149,54 +139,13 @@ cdef class pyread:
      
              fid.close()
           
-       self.data = data
+       self._demux(data)
+       self._beam_pos(trans, c)
        return
 
     # internal functions ======================================
 
 
-    # =========================================================
-    cpdef tuple _calc_beam_pos(self, float dist, float bearing, tuple point):
-    #def _calc_beam_pos(self, float dist, float bearing, tuple point):
-       cdef float dist_x, dist_y, x_final, y_final
-       with nogil:
-          dist_x, dist_y = (dist*sin(bearing), dist*cos(bearing))
-       xfinal, yfinal = (point[0] + dist_x, point[1] + dist_y)
-       return (xfinal, yfinal)
-
-    # =========================================================
-    def _KnuthMorrisPratt(self, list text, list pattern):
-       # Knuth-Morris-Pratt string matching
-       # David Eppstein, UC Irvine, 1 Mar 2002
-       # http://code.activestate.com/recipes/117214/
-
-       '''Yields all starting positions of copies of the pattern in the text.
-       Calling conventions are similar to string.find, but its arguments can be
-       lists or iterators, not just strings, it returns all matches, not just
-       the first one, and it does not need the whole text in memory at once. 
-       Whenever it yields, it will have read the text exactly up to and including
-       the match that caused the yield.'''
-
-       # build table of shift amounts
-       cdef list shifts = [1] * (len(pattern) + 1)
-       cdef int shift = 1
-       for pos from 0 <= pos < len(pattern):       
-          while shift <= pos and pattern[pos] != pattern[pos-shift]:
-             shift += shifts[pos-shift]
-          shifts[pos+1] = shift
-
-       # do the actual search
-       cdef int startPos = 0
-       cdef int matchLen = 0
-       for c in text:
-          while matchLen == len(pattern) or \
-                matchLen >= 0 and pattern[matchLen] != c:
-              startPos += shifts[matchLen]
-              matchLen -= shifts[matchLen]
-          matchLen += 1
-          if matchLen == len(pattern):
-             yield startPos
-
     # =========================================================
     cpdef list _fread(self, object infile, int num, str typ):
     #def _fread(self, object infile, int num, str typ):
@@ -211,8 +160,8 @@ cdef class pyread:
           return(list(dat))
 
     # =========================================================
-    cpdef list _gethead(self, object fid, object trans, float c, int model, int linesize): #transWGS84,
-    #def _gethead(self, object fid, object trans, float c, int model, int linesize): #transWGS84,
+    cpdef list _gethead(self, object fid, int model, int linesize):
+    #def _gethead(self, object fid, int model, int linesize):
        cdef list hd = self._fread(fid, 3, 'B')
        cdef list head=[] #pre-allocate list
        cdef int flag
@@ -316,46 +265,8 @@ cdef class pyread:
        else:
           head.append('unknown')
 
-       cdef float lon, lat
-       cdef float dist, bearing, theta
+       # the beam position of sidescan pings is added afterwards, for all pings at once (see _beam_pos)
 
-       cdef float tvg = ((8.5*10**-5)+(3/76923)+((8.5*10**-5)/4))*c
-       
-       cdef float pi = 3.14159265
-        
-       if head[9]==3 or head[9]==2: #starboard or port
-          dist = ((tan(25*0.0174532925))*head[8]) +(tvg) #depth
-
-          bearing = 0.0174532925*head[5] - (pi/2) #heading_deg
-
-#          theta = bearing/(180/pi)
-#          #course over ground is given as a compass heading (ENU) from True north, or Magnetic north.
-#          #To get this into NED (North-East-Down) coordinates, you need to rotate the ENU
-#          # (East-North-Up) coordinate frame.
-#          #Subtract pi/2 from your heading
-#          theta = theta - pi/2
-#          # (re-wrap to Pi to -Pi)
-#          theta = np.unwrap(-theta)
-#          bearing = theta * (180/pi)
-
-          #bearing = (bearing + 360) % 360
-          bearing = bearing % 360
-          
-          x_utm, y_utm = self._calc_beam_pos(dist, bearing, (head[2],head[3]))
- 
-          #x_utm = head[2]
-          #y_utm = head[3]
-          lat = atan(tan(atan(exp(y_utm/ 6378388.0)) * 2.0 - 1.570796326794897) * 1.0067642927) * 57.295779513082302
-          lon = x_utm * 57.295779513082302 / 6378388.0
-          
-          #lat = atan(tan(atan(exp(y_utm/ 6378137.0)) * 2.0 - 1.570796326794897) * 1.006705621329495) * 57.295779513082302
-          #lon = x_utm * 57.295779513082302 / 6378137.0          
-          head.append(lat)
-          head.append(lon)
-          lon, lat = trans(lon, lat)
-          head.append(lat)
-          head.append(lon)      
-       
        return head
 
 
@@ -439,26 +350,65 @@ cdef class pyread:
 
 
     # =========================================================
-    cpdef list _getsonar(self, str sonarstring):
-    #def _getsonar(self, str sonarstring):    
+    cpdef _demux(self, list data):
+    #def _demux(self, list data):
         """
-        returns sonar data
+        sorts packets into channels by their beam byte, in a single pass,
+        into (npings, packet) scan arrays and header lists. A channel's scan
+        array is allocated when the channel is first seen, doubled in place
+        whenever it fills, and trimmed to its number of pings at the end
         """
-        dat = self.data
-        for k in dat:
-           if k[0][13] == sonarstring:
-              return k  
-                 
+        cdef dict pos = {}
+        cdef int i, k
+        cdef list ping
+
+        self.scans = {}
+        self.heads = {}
+        for dat in data:
+           for i in range(0, len(dat), 2):
+              name = dat[i][13]
+              if name not in pos:
+                 # samples per ping from the first header of the channel
+                 self.scans[name] = np.zeros( (len(dat)//2, dat[i][12]), 'float16')
+                 self.heads[name] = []
+                 pos[name] = 0
+              k = pos[name]
+              if k==len(self.scans[name]):
+                 self.scans[name].resize( (2*k, self.scans[name].shape[1]), refcheck=False)
+              ping = dat[i+1][:self.scans[name].shape[1]]
+              self.scans[name][k,:len(ping)] = ping
+              self.heads[name].append(dat[i])
+              pos[name] = k+1
+
+        for name in pos:
+           self.scans[name].resize( (pos[name], self.scans[name].shape[1]), refcheck=False)
+
     # =========================================================
-    cpdef np.ndarray _get_scans(self, list scan, int packet):
-    #def _get_scans(self, list scan, int packet):    
+    cpdef _beam_pos(self, object trans, float c):
+    #def _beam_pos(self, object trans, float c):
+        """
+        appends lat, lon, northing and easting of the beam to the header
+        of every sidescan ping, computed for all pings at once
+        """
+        cdef list heads
+        cdef np.ndarray hd
+        cdef int k
+
+        for name in ['sidescan_port', 'sidescan_starboard']:
+           if name in self.heads:
+              heads = self.heads[name]
+              hd = np.asarray([[h[2], h[3], h[5], h[8]] for h in heads], 'float64')
+              lat, lon, n, e = pyread_fast.calc_beam_pos(hd[:,0], hd[:,1], hd[:,3], hd[:,2], c, trans)
+              for k in range(len(heads)):
+                 heads[k].extend([float(lat[k]), float(lon[k]), float(n[k]), float(e[k])])
+
+    # =========================================================
+    cpdef tuple _getsonar(self, str sonarstring):
+    #def _getsonar(self, str sonarstring):    
         """
-        returns an individual scan
-        """ 
-        cdef np.ndarray d = np.zeros( (packet,) )
-        cdef np.ndarray tmp = np.squeeze(scan) 
-        d[:len(tmp)] = tmp[:packet]
-        return d[:packet]                    
+        returns headers and scans of a sonar channel
+        """
+        return self.heads[sonarstring], self.scans[sonarstring]
                    
     # external functions ======================================                        
     # =========================================================
@@ -475,33 +425,14 @@ cdef class pyread:
         returns compiled scan
         """       
         
-        cdef list scan
-        
-        scan = self._getsonar('sidescan_port')
-        cdef str sonarstring = 'sidescan_port'
-        
-        if not scan:
-           scan = self._getsonar('sidescan_starboard')
-           sonarstring = 'sidescan_starboard'       
-        if not scan:
-           scan = self._getsonar('down_lowfreq')           
-           sonarstring = 'down_lowfreq'       
-        if not scan:
-           scan = self._getsonar('down_highfreq')           
-           sonarstring = 'down_highfreq'                     
-        if not scan:
-           scan = self._getsonar('down_vhighfreq')           
-           sonarstring = 'down_vhighfreq' 
-        
-        cdef int packet = scan[0][12]
-        cdef list ind = range(0,len(scan))
-        ind = ind[1::2]
+        cdef str sonarstring = 'down_vhighfreq'
 
-        cdef list c_scan = []
-        for i in ind:
-           c_scan.append(self._get_scans(scan[i], packet))
+        for name in ['sidescan_port', 'sidescan_starboard', 'down_lowfreq', 'down_highfreq']:
+           if name in self.scans:
+              sonarstring = name
+              break
 
-        return (np.asarray(c_scan,'float16').T, sonarstring)
+        return (self._getsonar(sonarstring)[1].T, sonarstring)
 
     # =========================================================
     cpdef dict getmetadata(self):
@@ -509,13 +440,7 @@ cdef class pyread:
         """
         returns meta data
         """  
-        cdef list data_port = self._getsonar('sidescan_port')
-        
-        cdef int packet = data_port[0][12]
-        cdef list ind = range(0,len(data_port))
-        ind = ind[1::2]        
-        
-        cdef np.ndarray tmp = np.squeeze(data_port)
+        cdef list heads = self._getsonar('sidescan_port')[0]
 
         cdef list hdg = []        
         cdef list lon = []
@@ -527,17 +452,17 @@ cdef class pyread:
         cdef list n = []
         cdef list gps1 = []
         cdef list gps2 = []
-        for i in ind:
-           lon.append(float(tmp[i-1][15]) )
-           lat.append(float(tmp[i-1][14]) )
-           spd.append(float(tmp[i-1][7]) )
-           time_s.append(float(tmp[i-1][1])/1000 )
-           dep_m.append(float(tmp[i-1][8]) )
-           e.append(float(tmp[i-1][17]) )
-           n.append(float(tmp[i-1][16]) )
-           hdg.append(float(tmp[i-1][5]) )
-           gps1.append(float(tmp[i-1][4]))
-           gps2.append(float(tmp[i-1][6]))
+        for head in heads:
+           lon.append(float(head[15]) )
+           lat.append(float(head[14]) )
+           spd.append(float(head[7]) )
+           time_s.append(float(head[1])/1000 )
+           dep_m.append(float(head[8]) )
+           e.append(float(head[17]) )
+           n.append(float(head[16]) )
+           hdg.append(float(head[5]) )
+           gps1.append(float(head[4]))
+           gps2.append(float(head[6]))
 
         cdef np.ndarray hdg2 = np.asarray(hdg, 'float')
         cdef np.ndarray gps_a = np.asarray(gps1, 'float')
@@ -0,0 +1,44 @@
+"""
+tests for the bed shift of PyHum.correct, against shifting each column in turn
+"""
+from __future__ import division
+
+import numpy as np
+import pytest
+
+from PyHum._pyhum_correct import get_bed_shift, bed_shift
+
+# =========================================================
+def bed_shift_ref(x, Zbed):
+   '''
+   each column shifted up by its bed pick, as np.r_[x[Zbed[k]:,k], zeros],
+   and columns with no pick set to ones
+   '''
+   n, ncols = np.shape(x)
+   out = np.ones((n, ncols), x.dtype)
+   for k in range(min(ncols, len(Zbed))):
+      col = np.r_[x[Zbed[k]:,k], np.zeros(n, x.dtype)][:n]
+      out[:,k] = col
+   return out
+
+# =========================================================
+@pytest.mark.parametrize('dtype', ['int16', 'float32', 'float64'])
+def test_bed_shift(dtype):
+   rng = np.random.RandomState(0)
+   x = (rng.rand(50, 40)*1000).astype(dtype)
+   # picks within the column, at either end, beyond it and negative
+   Zbed = rng.randint(-70, 70, 40)
+   Zbed[:6] = [0, 49, 50, 51, -1, -50]
+   res = bed_shift(x, *get_bed_shift(50, Zbed, 40))
+   assert res.dtype == x.dtype
+   assert np.array_equal(res, bed_shift_ref(x, Zbed))
+
+# =========================================================
+def test_bed_shift_nopick():
+   x = np.arange(600.).reshape(20, 30)
+   # fewer picks than columns
+   Zbed = np.arange(25)
+   assert np.array_equal(bed_shift(x, *get_bed_shift(20, Zbed, 30)), bed_shift_ref(x, Zbed))
+   # and no picks at all
+   assert np.array_equal(bed_shift(x, *get_bed_shift(20, 5, 30)), np.ones((20, 30)))
+   assert np.array_equal(bed_shift(x, *get_bed_shift(20, [], 30)), np.ones((20, 30)))
@@ -0,0 +1,90 @@
+"""
+tests for PyHum.cwt_fast, against a window by window Morlet transform
+"""
+from __future__ import division
+
+import numpy as np
+import pytest
+
+import PyHum.cwt_fast as cwt_fast
+
+# =========================================================
+def getvar_ref(matrix, largestscale, notes, win):
+   '''
+   cwt.Cwt(matrix, largestscale, notes, win).getvar(), in numpy (as cwt.pyx)
+   '''
+   pi = float(np.float32(3.14159265))
+   lr = np.shape(matrix)[1]
+   base2 = np.floor(np.log(win)/np.log(2) + 0.4999)
+   ndata = int(2**(base2+1))
+   noctave = int(np.log(ndata/largestscale/2+0.0001)/np.log(2.0)+0.0001)
+   nscale = notes*noctave
+   scales = np.array([ndata/(largestscale*(2.0**(nscale-1-j)/notes)) for j in range(nscale)])
+   if not np.sum(matrix)>0:
+      return np.nan
+
+   cwt = np.zeros((nscale, ndata, lr), np.complex64)
+   omega = np.array(list(range(0, ndata//2))+list(range(-(ndata//2), 0)))*(2.0*pi/ndata)
+   for i in range(lr):
+      data = np.asarray([row[i] for row in matrix])
+      Y = np.zeros(ndata)
+      Y[:win] = data - np.mean(data)
+      datahat = np.fft.fft(Y)
+      for j in range(nscale):
+         s = scales[j]
+         psihat = 0.75112554*np.exp(-(omega*s-6.0)**2/2.0)*np.sqrt(2.0*pi*s)
+         cwt[j,:,i] = np.fft.ifft(psihat*datahat)
+
+   wave = np.empty((nscale, win, lr))
+   for i in range(lr):
+      wave[:,:,i] = np.tile(scales**-1, (win, 1)).T*(np.abs(cwt[:,0:win,i])**2)
+
+   n = np.r_[0:nscale]-(nscale-1)/2
+   dat = np.var(np.var(wave.T, axis=1), axis=0)
+   dat = dat/np.sum(dat)*np.exp(-(0.5)*((pi/2)*n/((nscale-1)/2))**2)
+   dat = dat/np.sum(dat)
+   dat = dat/(scales**2)
+   dat = dat/np.sum(dat)
+   return np.sum(dat*scales)
+
+# =========================================================
+def get_windows(nwin, win, lr, seed=0):
+   '''
+   windows of noise, with empty, negative and smoothly varying ones
+   '''
+   rng = np.random.RandomState(seed)
+   Z = (rng.rand(nwin, win, lr)*50).astype('float32')
+   Z[1] = 0
+   Z[2] = -1
+   Z[3] = np.cumsum(rng.rand(win, lr), axis=0).astype('float32')
+   return Z
+
+# =========================================================
+@pytest.mark.parametrize('win, largestscale, notes', [(20, 2, 4), (31, 2, 4), (64, 3, 8)])
+def test_getvar_ref(win, largestscale, notes):
+   Z = get_windows(12, win, win//2)
+   ref = np.array([getvar_ref(Z[k], largestscale, notes, win) for k in range(len(Z))])
+   res = cwt_fast.getvar(Z, largestscale, notes, win)
+   assert np.array_equal(np.isnan(res), np.isnan(ref))
+   assert np.isnan(res[1]) and np.isnan(res[2])
+   ok = ~np.isnan(ref)
+   assert np.allclose(res[ok], ref[ok], rtol=1e-4)
+
+# =========================================================
+def test_getvar_compiled():
+   cwt = pytest.importorskip('PyHum.cwt')
+   Z = get_windows(6, 31, 15)
+   ref = np.array([cwt.Cwt(Z[k], 2, 4, 31).getvar() for k in range(len(Z))])
+   res = cwt_fast.getvar(Z, 2, 4, 31)
+   ok = ~np.isnan(ref)
+   assert np.array_equal(np.isnan(res), ~ok)
+   assert np.allclose(res[ok], ref[ok], rtol=1e-4)
+
+# =========================================================
+def test_getvar_batches(monkeypatch):
+   Z = get_windows(15, 20, 10)
+   ref = cwt_fast.getvar(Z, 2, 4, 20)
+   # one window per batch
+   monkeypatch.setattr(cwt_fast, 'BATCHSIZE', 1)
+   assert np.allclose(cwt_fast.getvar(Z, 2, 4, 20), ref, equal_nan=True)
+   assert len(cwt_fast.getvar(Z[:0], 2, 4, 20)) == 0
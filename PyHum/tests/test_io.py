@@ -0,0 +1,174 @@
+"""
+tests for PyHum.io, on small arrays written to a temporary directory
+"""
+from __future__ import division
+
+import os
+import numpy as np
+import pytest
+
+import PyHum.io as io
+
+# =========================================================
+def get_size(sonpath, base, string):
+   return os.path.getsize(os.path.join(sonpath, base+string))
+
+# =========================================================
+def get_chunk(seed, shape=(40, 50), scale=100.):
+   '''
+   smooth values plus noise, so chunks compress by differing amounts
+   '''
+   rng = np.random.RandomState(seed)
+   return (np.cumsum(rng.rand(*shape), axis=1) + rng.rand(*shape)*scale).astype('float32')
+
+# =========================================================
+@pytest.mark.parametrize('compress', [False, 'zlib', {'compressor': 'zlib', 'shuffle': False, 'delta': False}])
+def test_store_roundtrip(tmpdir, compress):
+   sonpath = str(tmpdir)+os.sep
+   Z = np.asarray([get_chunk(k) for k in range(4)])
+   shape = io.set_mmap_data(sonpath, 'x', '_data.dat', 'float32', Z, compress=compress)
+   assert shape == (4, 40, 50)
+   fp = io.get_mmap_data(sonpath, 'x', '_data.dat', 'int16')
+   assert np.array_equal(np.asarray(fp), Z)
+   assert np.array_equal(fp[2], Z[2])
+   assert np.array_equal(fp[1:3, 5], Z[1:3, 5])
+
+# =========================================================
+def test_compressed_rewrite(tmpdir):
+   sonpath = str(tmpdir)+os.sep
+   Z = np.asarray([get_chunk(k) for k in range(4)])
+   io.set_mmap_data(sonpath, 'x', '_data.dat', 'float32', Z, compress='zlib')
+   size = get_size(sonpath, 'x', '_data.dat')
+
+   # rewriting every chunk in place (as level_store) does not grow the file
+   st = io.open_store(sonpath, 'x', '_data.dat', mode='r+')
+   for p in range(st.chunks):
+      Z[p] = Z[p] - 1
+      st.write_chunk(p, Z[p])
+   st.close()
+   assert get_size(sonpath, 'x', '_data.dat') <= size + 4*64
+   assert np.array_equal(np.asarray(io.get_mmap_data(sonpath, 'x', '_data.dat', 'float32')), Z)
+
+   # a chunk that no longer fits is written at the end, and the space it
+   # left is taken back when the store is closed
+   st = io.open_store(sonpath, 'x', '_data.dat', mode='r+')
+   Z[1] = get_chunk(10, scale=1e6)
+   st.write_chunk(1, Z[1])
+   Z[2] = 0
+   st[2] = Z[2]
+   assert np.array_equal(st.read_chunk(1), Z[1])
+   st.close()
+   st = io.open_store(sonpath, 'x', '_data.dat')
+   assert get_size(sonpath, 'x', '_data.dat') == sum([i[1] for i in st.index])
+   assert np.array_equal(np.asarray(st), Z)
+
+# =========================================================
+def test_compressed_unwritten(tmpdir):
+   sonpath = str(tmpdir)+os.sep
+   st = io.create_store(sonpath, 'x', '_data.dat', 'float32', (3, 4, 5), compress='zlib')
+   st.write_chunk(1, np.ones((4, 5)))
+   st.close()
+   fp = io.get_mmap_data(sonpath, 'x', '_data.dat', 'float32')
+   assert np.array_equal(np.asarray(fp), np.r_[np.zeros((1, 4, 5)), np.ones((1, 4, 5)), np.zeros((1, 4, 5))])
+
+# =========================================================
+@pytest.mark.parametrize('compress', [False, 'zlib'])
+def test_append(tmpdir, compress):
+   sonpath = str(tmpdir)+os.sep
+   Z = np.asarray([get_chunk(k) for k in range(3)])
+   io.set_mmap_data(sonpath, 'x', '_data.dat', 'float32', Z[0], compress=compress)
+   assert io.set_mmap_append(sonpath, 'x', '_data.dat', 'float32', Z[1]) == (2, 40, 50)
+   assert io.set_mmap_append(sonpath, 'x', '_data.dat', 'float32', Z[2]) == (3, 40, 50)
+   assert np.array_equal(np.asarray(io.get_mmap_data(sonpath, 'x', '_data.dat', 'float32')), Z)
+   with pytest.raises(ValueError):
+      io.set_mmap_append(sonpath, 'x', '_data.dat', 'float32', Z[0][:10])
+
+# =========================================================
+def test_mmap_latest(tmpdir):
+   sonpath = str(tmpdir)+os.sep
+   assert io.get_mmap_latest(sonpath, 'x', ['_data2.dat', '_data.dat'], 'float32') is None
+   Z = np.asarray([get_chunk(k) for k in range(2)])
+   io.set_mmap_data(sonpath, 'x', '_data.dat', 'float32', Z)
+   fp, shape = io.get_mmap_latest(sonpath, 'x', ['_data2.dat', '_data.dat'], 'int16')
+   assert np.array_equal(shape, [2, 40, 50])
+   assert np.array_equal(np.asarray(fp), Z)
+   # the first of the arrays that exists is opened
+   io.set_mmap_data(sonpath, 'x', '_data2.dat', 'float32', Z[0], compress='zlib')
+   fp, shape = io.get_mmap_latest(sonpath, 'x', ['_data2.dat', '_data.dat'], 'int16')
+   assert np.array_equal(shape, [40, 50])
+   assert np.array_equal(np.asarray(fp), Z[0])
+
+# =========================================================
+def test_stage_cache(tmpdir, monkeypatch):
+   sonpath = str(tmpdir)+os.sep
+   io.set_mmap_data(sonpath, 'x', '_data_in.dat', 'float32', get_chunk(0))
+   params = {'win': 10, 'doplot': 0}
+   meta = {'pix_m': np.asarray([[0.02]]), 'dep_m': np.arange(5.)}
+
+   def get_stage(params=params, meta=meta, cache=1):
+      return io.get_stage(sonpath, 'x', 'test', params, ['x_data_in.dat'], meta, cache=cache)
+
+   h, done = get_stage()
+   assert not done
+   io.set_mmap_data(sonpath, 'x', '_data_out.dat', 'float32', get_chunk(1))
+   io.set_stage(sonpath, 'x', 'test', h, ['x_data_out.dat'])
+   assert io.get_store_header(sonpath, 'x', '_data_out.dat')['provenance']['hash'] == h
+
+   # unchanged, so skipped if caching is on
+   assert get_stage() == (h, True)
+   assert get_stage(cache=0) == (h, False)
+   assert get_stage(cache=None) == (h, False)
+   monkeypatch.setattr(io, 'STAGE_CACHE', True)
+   assert get_stage(cache=None) == (h, True)
+
+   # but not if the parameters, metadata or inputs have changed
+   assert not get_stage(params={'win': 11, 'doplot': 0})[1]
+   assert not get_stage(meta={'pix_m': np.asarray([[0.02]]), 'dep_m': np.arange(6.)})[1]
+   io.set_mmap_data(sonpath, 'x', '_data_in.dat', 'float32', get_chunk(0, shape=(41, 50)))
+   assert not get_stage()[1]
+
+   # or the outputs are gone, or were rewritten since
+   h, done = get_stage()
+   io.set_stage(sonpath, 'x', 'test', h, ['x_data_out.dat'])
+   assert get_stage()[1]
+   io.set_mmap_data(sonpath, 'x', '_data_out.dat', 'float32', get_chunk(2))
+   assert not get_stage()[1]
+   io.set_stage(sonpath, 'x', 'test', h, ['x_data_out.dat'])
+   io.del_mmap_data(sonpath, 'x', '_data_out.dat')
+   assert not get_stage()[1]
+
+# =========================================================
+def scale_chunk(a, b, s):
+   return a*s, a+b
+
+# =========================================================
+@pytest.mark.parametrize('n_jobs', [1, 2])
+@pytest.mark.parametrize('compress', [False, 'zlib'])
+def test_map_chunks(tmpdir, n_jobs, compress):
+   sonpath = str(tmpdir)+os.sep
+   A = np.asarray([get_chunk(k) for k in range(5)])
+   B = np.asarray([get_chunk(k+5) for k in range(5)])
+   io.set_mmap_data(sonpath, 'x', '_data_a.dat', 'float32', A, compress=compress)
+   io.set_mmap_data(sonpath, 'x', '_data_b.dat', 'float32', B, compress=False)
+   for s in ['_data_c.dat', '_data_d.dat']:
+      io.create_store(sonpath, 'x', s, 'float32', np.shape(A), compress=compress).close()
+
+   inputs = [(sonpath, 'x', '_data_a.dat', 'float32', np.shape(A)), (sonpath, 'x', '_data_b.dat', 'float32', np.shape(B))]
+   outputs = [(sonpath, 'x', '_data_c.dat'), (sonpath, 'x', '_data_d.dat')]
+   io.map_chunks(scale_chunk, inputs, outputs, [(p+1,) for p in range(5)], n_jobs=n_jobs)
+
+   assert np.array_equal(np.asarray(io.get_mmap_data(sonpath, 'x', '_data_c.dat', 'float32')), A*np.r_[1:6].astype('float32')[:,np.newaxis,np.newaxis])
+   assert np.array_equal(np.asarray(io.get_mmap_data(sonpath, 'x', '_data_d.dat', 'float32')), A+B)
+
+# =========================================================
+def test_map_chunks_2d(tmpdir):
+   # a 2d input is given whole to every chunk, and results may be dropped
+   sonpath = str(tmpdir)+os.sep
+   A = np.asarray([get_chunk(k) for k in range(3)])
+   io.set_mmap_data(sonpath, 'x', '_data_a.dat', 'float32', A)
+   io.set_mmap_data(sonpath, 'x', '_data_b.dat', 'float32', A[0])
+   io.create_store(sonpath, 'x', '_data_d.dat', 'float32', np.shape(A), compress='zlib').close()
+
+   inputs = [(sonpath, 'x', '_data_a.dat', 'float32', np.shape(A)), (sonpath, 'x', '_data_b.dat', 'float32', np.shape(A[0]))]
+   io.map_chunks(scale_chunk, inputs, [None, (sonpath, 'x', '_data_d.dat')], [(1,)]*3, n_jobs=1)
+   assert np.array_equal(np.asarray(io.get_mmap_data(sonpath, 'x', '_data_d.dat', 'float32')), A+A[0])
@@ -0,0 +1,88 @@
+"""
+tests for PyHum.ppdrc_fast, against the full complex FFT ppdrc
+"""
+from __future__ import division
+
+import numpy as np
+import pytest
+
+import PyHum.ppdrc_fast as ppdrc_fast
+
+# =========================================================
+def ppdrc_ref(im, wavelength=768, n=2):
+   '''
+   ppdrc.ppdrc(im, wavelength, n).getdata(), in numpy (as ppdrc.pyx)
+   '''
+   eps = 2.2204e-16
+   rows, cols = np.shape(im)
+   IM = np.fft.fft2(im)
+
+   u1, u2 = np.meshgrid((np.r_[0:cols]-(np.fix(cols/2)+1))/(cols-np.mod(cols,2)),(np.r_[0:rows]-(np.fix(rows/2)+1))/(rows-np.mod(rows,2)))
+   u1 = np.fft.ifftshift(u1)
+   u2 = np.fft.ifftshift(u2)
+
+   radius = np.sqrt(u1*u1 + u2*u2)
+   radius[1,1] = 1
+   H1 = 1j*u1/radius
+   H2 = 1j*u2/radius
+   H1[1,1] = 0
+   H2[1,1] = 0
+   radius[1,1] = 0
+
+   H = 1.0 - 1.0 / (1.0 + (radius * wavelength)**(2*n))
+
+   f = np.real(np.fft.ifft2(H*IM))
+   h1f = np.real(np.fft.ifft2(H*H1*IM))
+   h2f = np.real(np.fft.ifft2(H*H2*IM))
+
+   ph = np.arctan(f/np.sqrt(h1f*h1f + h2f*h2f + eps))
+   E = np.sqrt(f*f + h1f*h1f + h2f*h2f)
+   return np.sin(ph)*np.log1p(E)
+
+# =========================================================
+def get_image(rows, cols, seed=0):
+   '''
+   a speckled sidescan-like image with a bright band and a dark shadow
+   '''
+   rng = np.random.RandomState(seed)
+   im = rng.gamma(2.0, 10.0, (rows, cols))
+   im[rows//4:rows//3] += 80
+   im[rows//2:, cols//2:] *= 0.1
+   return im
+
+# =========================================================
+@pytest.mark.parametrize('shape', [(64, 48), (65, 47), (128, 97)])
+@pytest.mark.parametrize('wavelength', [3, 20, 768])
+def test_ppdrc_ref(shape, wavelength):
+   im = get_image(*shape)
+   ref = ppdrc_ref(im, wavelength, 2)
+   res = ppdrc_fast.ppdrc(im, wavelength, 2)
+   assert res.dtype == np.float32
+   assert np.shape(res) == shape
+   assert np.allclose(res, ref, rtol=1e-4, atol=1e-4*np.max(np.abs(ref)))
+
+# =========================================================
+def test_ppdrc_compiled():
+   ppdrc = pytest.importorskip('PyHum.ppdrc')
+   im = get_image(64, 50)
+   ref = ppdrc.ppdrc(im, 10, 2).getdata()
+   assert np.allclose(ppdrc_fast.ppdrc(im, 10, 2), ref, rtol=1e-4, atol=1e-4*np.max(np.abs(ref)))
+
+# =========================================================
+def test_ppdrc_tiles():
+   im = get_image(600, 40)
+   ref = ppdrc_fast.ppdrc(im, 8, 2, tilesize=1000)
+   res = ppdrc_fast.ppdrc(im, 8, 2, tilesize=100)
+   # tiles overlap by a halo of a wavelength, so the result barely depends
+   # on the tiling, except at either end where the whole chunk wraps around
+   err = np.abs(res-ref)/np.max(np.abs(ref))
+   assert np.median(err) < 5e-3
+   assert np.max(err[100:-100]) < 0.1
+   assert np.corrcoef(np.ravel(res), np.ravel(ref))[0,1] > 0.99
+
+# =========================================================
+def test_ppdrc_filters_cached():
+   ppdrc_fast.filters.clear()
+   ppdrc_fast.ppdrc(get_image(32, 32), 10, 2)
+   ppdrc_fast.ppdrc(get_image(32, 32, 1), 10, 2)
+   assert list(ppdrc_fast.filters.keys()) == [(32, 32, 10, 2)]
@@ -0,0 +1,220 @@
+"""
+tests for PyHum.pyread_fast, on small synthetic SON/IDX files and on the
+SON/IDX files shipped with PyHum
+"""
+from __future__ import division
+
+import os, struct
+import numpy as np
+import pytest
+
+import PyHum.pyread_fast as pyread_fast
+
+PKGDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HUMFILE = os.path.join(PKGDIR, 'test.DAT')
+
+# packet header of model 998 (and 1198, 898), spacer bytes included
+HEADFMT = '>5BiBiBiBiBhhBhhBiBBBBBi14xiB'
+
+# =========================================================
+def make_head(recnum, time_ms, x_utm, y_utm, gps1, heading, gps2, speed, depth, beam, voltscale, freq, sentlen):
+   '''
+   returns the 67 header bytes of a model 998 packet
+   '''
+   return struct.pack(HEADFMT, 192, 222, 171, 33, 128, recnum, 131, time_ms, 132, x_utm, 133, y_utm, 135,
+                      gps1, heading, 136, gps2, speed, 138, depth, 145, beam, 146, voltscale, 147, freq, sentlen, 160)
+
+# =========================================================
+def make_son(sonfile, npings, packet=100, beam=2, seed=0, ragged=False):
+   '''
+   writes a SON file of npings packets, and its IDX file, and returns the
+   header fields and payload of every packet. Payload values are below 192
+   so that no packet start sequence occurs within the data
+   '''
+   rng = np.random.RandomState(seed)
+   fields = []
+   payloads = []
+   offsets = []
+   pos = 0
+   with open(sonfile, 'wb') as f:
+      for k in range(npings):
+         while True:
+            h = (k, 100*k+int(rng.randint(0, 50)), int(rng.randint(-2**31, 2**31)), int(rng.randint(-2**31, 2**31)),
+                 int(rng.randint(0, 2)), int(rng.randint(0, 3600)), int(rng.randint(0, 2)), int(rng.randint(0, 100)),
+                 int(rng.randint(10, 1000)), beam, int(rng.randint(0, 100)), 455, packet)
+            head = make_head(*h)
+            # redraw any header that would contain a second start sequence
+            if bytes(bytearray(pyread_fast.SYNC)) not in head[1:]:
+               break
+         n = packet
+         if ragged and k % 3 == 1:
+            n = packet - 7
+         elif ragged and k % 3 == 2:
+            n = packet + 5
+         p = rng.randint(0, 192, n).astype('uint8')
+         f.write(head)
+         f.write(p.tobytes())
+         fields.append(h)
+         payloads.append(p)
+         offsets.append(pos)
+         pos += len(head) + n
+   np.vstack((np.asarray(fields)[:,1], offsets)).T.astype('>u4').tofile(sonfile.split('.SON')[0]+'.IDX')
+   return np.asarray(fields, 'int64'), payloads, np.asarray(offsets, 'int64')
+
+# =========================================================
+def read_heads_bytewise(sonfile, headbytes=67):
+   '''
+   reference decode of model 998 headers, field by field over the spacer bytes
+   (as pyread._gethead)
+   '''
+   out = []
+   with open(sonfile, 'rb') as f:
+      buf = f.read()
+   offsets = pyread_fast.read_idx(sonfile.split('.SON')[0]+'.IDX')
+   for s in offsets:
+      h = buf[s:s+headbytes]
+      pos = 5
+      vals = []
+      # fields and the number of spacer bytes that follow each
+      for fmt, skip in [('>i', 1), ('>i', 1), ('>i', 1), ('>i', 1), ('>h', 0), ('>h', 1), ('>h', 0), ('>h', 1), ('>i', 1), ('>B', 1), ('>B', 1), ('>i', 14), ('>i', 1)]:
+         n = struct.calcsize(fmt)
+         vals.append(struct.unpack(fmt, h[pos:pos+n])[0])
+         pos += n + skip
+      out.append(vals)
+   return np.asarray(out, 'int64')
+
+FIELDS = ['recnum', 'time_ms', 'x_utm', 'y_utm', 'gps1', 'heading', 'gps2', 'speed', 'depth', 'beam', 'voltscale', 'freq', 'sentlen']
+
+# =========================================================
+def test_header_layout():
+   assert struct.calcsize(HEADFMT) == pyread_fast.get_headbytes(998)
+   assert pyread_fast.get_head_dtype(998).itemsize == pyread_fast.get_headbytes(998)
+
+# =========================================================
+def test_find_packets_synthetic(tmpdir):
+   sonfile = str(tmpdir.join('B002.SON'))
+   fields, payloads, offsets = make_son(sonfile, 50, ragged=True)
+   buf = np.memmap(sonfile, dtype=np.uint8, mode='r')
+   assert np.array_equal(pyread_fast.find_packets(buf), offsets)
+   assert np.array_equal(pyread_fast.read_idx(sonfile.replace('.SON', '.IDX')), offsets)
+
+# =========================================================
+def test_find_packets_across_scans(tmpdir, monkeypatch):
+   sonfile = str(tmpdir.join('B002.SON'))
+   fields, payloads, offsets = make_son(sonfile, 40)
+   buf = np.memmap(sonfile, dtype=np.uint8, mode='r')
+   # start sequences that straddle the end of a scanned block are still found
+   monkeypatch.setattr(pyread_fast, 'SCANSIZE', 169)
+   assert np.array_equal(pyread_fast.find_packets(buf), offsets)
+
+# =========================================================
+@pytest.mark.parametrize('base', ['B000', 'B001'])
+def test_find_packets_idx(base):
+   sonfile = os.path.join(PKGDIR, base+'.SON')
+   buf = np.memmap(sonfile, dtype=np.uint8, mode='r')
+   assert np.array_equal(pyread_fast.find_packets(buf), pyread_fast.read_idx(os.path.join(PKGDIR, base+'.IDX')))
+
+# =========================================================
+@pytest.mark.parametrize('base', ['B000', 'B001'])
+def test_decode_heads_bytewise(base):
+   sonfile = os.path.join(PKGDIR, base+'.SON')
+   ref = read_heads_bytewise(sonfile)
+   buf = np.fromfile(sonfile, dtype=np.uint8)
+   head = pyread_fast.decode_heads(buf, pyread_fast.read_idx(os.path.join(PKGDIR, base+'.IDX')), 998)
+   for k, name in enumerate(FIELDS):
+      assert np.array_equal(head[name], ref[:,k]), name
+
+# =========================================================
+@pytest.mark.parametrize('mmap', [False, True])
+def test_pyread_synthetic(tmpdir, mmap):
+   sonfile = str(tmpdir.join('B002.SON'))
+   fields, payloads, offsets = make_son(sonfile, 60, ragged=True)
+   r = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998, mmap=mmap)
+
+   # the last packet is not used (as in pyread)
+   head = r.getheads()
+   assert len(head) == 59
+   for k, name in enumerate(FIELDS):
+      assert np.array_equal(head[name], fields[:-1,k]), name
+
+   # payloads are truncated, or padded with zeros, to the first sentence length
+   data, sonarstring = r.getpings()
+   assert sonarstring == 'sidescan_port'
+   ref = np.zeros((59, 100), 'uint8')
+   for k in range(59):
+      ref[k,:min(len(payloads[k]), 100)] = payloads[k][:100]
+   assert np.array_equal(np.asarray(data), ref)
+
+   scan, sonarstring = r.getscan()
+   assert scan.dtype == np.float16
+   assert np.array_equal(scan, ref.T.astype('float16'))
+
+# =========================================================
+def test_pyread_corrupt_idx(tmpdir):
+   sonfile = str(tmpdir.join('B002.SON'))
+   idxfile = sonfile.replace('.SON', '.IDX')
+   fields, payloads, offsets = make_son(sonfile, 30)
+   ref = np.asarray(pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998).getpings()[0])
+
+   # offsets that do not point at packets are not used
+   np.vstack((fields[:,1], offsets+3)).T.astype('>u4').tofile(idxfile)
+   assert np.array_equal(np.asarray(pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998).getpings()[0]), ref)
+
+   # and a missing IDX file is rewritten on request
+   os.remove(idxfile)
+   r = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998, writeidx=True)
+   assert np.array_equal(np.asarray(r.getpings()[0]), ref)
+   assert np.array_equal(pyread_fast.read_idx(idxfile), offsets)
+
+# =========================================================
+def test_pyread_mmap_shipped():
+   sonfile = os.path.join(PKGDIR, 'B000.SON')
+   a = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998)
+   b = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998, mmap=True)
+   assert a.getpings()[1] == 'down_lowfreq'
+   assert np.array_equal(np.asarray(a.getpings()[0]), np.asarray(b.getpings()[0]))
+   assert np.array_equal(a.getheads(), b.getheads())
+
+# =========================================================
+@pytest.mark.parametrize('mmap', [False, True])
+def test_pyread_n_jobs(tmpdir, monkeypatch, mmap):
+   sonfile = str(tmpdir.join('B002.SON'))
+   make_son(sonfile, 80, ragged=True)
+   a = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998, mmap=mmap)
+   # small enough ranges that the packets are split over processes
+   monkeypatch.setattr(pyread_fast, 'MINRANGE', 10)
+   b = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998, mmap=mmap, n_jobs=3)
+   assert np.array_equal(a.getheads(), b.getheads())
+   assert np.array_equal(np.asarray(a.getpings()[0]), np.asarray(b.getpings()[0]))
+
+# =========================================================
+def test_iter_pings(tmpdir):
+   sonfile = str(tmpdir.join('B002.SON'))
+   make_son(sonfile, 45, ragged=True)
+   r = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998)
+   blocks = list(pyread_fast.iter_pings(sonfile, HUMFILE, 998, blocksize=10))
+   assert len(blocks) == 5
+   assert np.array_equal(np.concatenate([h for h, d in blocks]), r.getheads())
+   assert np.array_equal(np.vstack([d for h, d in blocks]), np.asarray(r.getpings()[0]))
+
+# =========================================================
+def test_beam_pos_per_ping(tmpdir):
+   sonfile = str(tmpdir.join('B002.SON'))
+   make_son(sonfile, 20)
+   r = pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998)
+   head = r.getheads()
+   meta = r.getmetadata()
+
+   # per ping, in single precision (as pyread._gethead)
+   c = np.float32(1450.0)
+   pi = np.float32(3.14159265)
+   tvg = np.float32(((8.5*10**-5)+(3/76923)+((8.5*10**-5)/4))*c)
+   for k in range(len(head)):
+      dist = np.float32(np.tan(25*0.0174532925)*(head['depth'][k]/10) + tvg)
+      bearing = np.float32(np.fmod(np.float32(0.0174532925*(head['heading'][k]/10) - pi/2), np.float32(360)))
+      x = head['x_utm'][k] + np.float32(dist*np.sin(bearing))
+      y = head['y_utm'][k] + np.float32(dist*np.cos(bearing))
+      lat = np.float32(np.arctan(np.tan(np.arctan(np.exp(y/ 6378388.0)) * 2.0 - 1.570796326794897) * 1.0067642927) * 57.295779513082302)
+      lon = np.float32(x * 57.295779513082302 / 6378388.0)
+      assert meta['lat'][k] == lat
+      assert meta['lon'][k] == lon
@@ -0,0 +1,129 @@
+"""
+tests for the shadow scores of PyHum.rmshadows, against a grey level
+co-occurrence matrix built for each window in turn
+"""
+from __future__ import division
+
+import numpy as np
+import pytest
+
+from PyHum._pyhum_rmshadows import get_shadow_scores, get_shadow_windows, get_window_mask
+
+# dissim, correl, contrast, energy, mn
+THRESHOLDS = [(3, .2, 4, .15, 4), (10, .5, 30, .05, 20), (1e9, 1e9, 1e9, 0.03, 1e9)]
+
+# =========================================================
+def glcm(Z):
+   '''
+   symmetric, normed co-occurrence matrix of Z at distance 5 and angle 0
+   (as greycomatrix(Z, [5], [0], 256, symmetric=True, normed=True))
+   '''
+   I = Z.astype('uint8').astype('int64')
+   P = np.zeros((256, 256))
+   np.add.at(P, (np.ravel(I[:,:-5]), np.ravel(I[:,5:])), 1)
+   P = P + P.T
+   return P/np.sum(P)
+
+# =========================================================
+def props(P):
+   '''
+   dissimilarity, correlation, contrast and energy of P (as greycoprops)
+   '''
+   # only the grey level pairs that occur
+   i, j = np.nonzero(P)
+   P = P[i, j]
+   con = np.sum(P*(i-j)**2)
+   dis = np.sum(P*np.abs(i-j))
+   ene = np.sqrt(np.sum(P**2))
+   mi = np.sum(i*P)
+   mj = np.sum(j*P)
+   si = np.sqrt(np.sum(P*(i-mi)**2))
+   sj = np.sqrt(np.sum(P*(j-mj)**2))
+   if si<1e-15 or sj<1e-15:
+      cor = 1.
+   else:
+      cor = np.sum(P*(i-mi)*(j-mj))/(si*sj)
+   return dis, cor, con, ene
+
+# =========================================================
+def shadow_ref(merge, win, ys, xs, th):
+   '''
+   1 for each win x win window (top left corners at ys, xs) scored as shadow
+   '''
+   out = np.zeros((len(ys), len(xs)))
+   for r, y in enumerate(ys):
+      for c, x in enumerate(xs):
+         Z = merge[y:y+win, x:x+win]
+         # windows with values outside 0 to 255 are not scored
+         if np.min(Z)<0 or np.max(Z)>=256:
+            continue
+         dis, cor, con, ene = props(glcm(Z))
+         out[r,c] = int(dis<th[0] and cor<th[1] and con<th[2] and ene>th[3] and np.mean(Z)<th[4])
+   return out
+
+# =========================================================
+def get_merge(Ny, Nx, seed=0):
+   '''
+   a chunk with low (shadow-like), constant, out of range and empty areas
+   '''
+   rng = np.random.RandomState(seed)
+   merge = rng.rand(Ny, Nx)*60
+   merge[:Ny//3, :Nx//2] = rng.rand(Ny//3, Nx//2)*5
+   merge[Ny//2:Ny//2+20] = 7.
+   merge[2*Ny//3:2*Ny//3+10, 30:50] = 300
+   merge[-20:, -40:] = 0
+   return merge
+
+# =========================================================
+@pytest.mark.parametrize('th', THRESHOLDS)
+def test_shadow_scores(th):
+   merge = get_merge(230, 190)
+   win = 31
+   ref = shadow_ref(merge, win, np.r_[0:230//win]*win, np.r_[0:190//win]*win, th)
+   res = get_shadow_scores(merge, win, *th)
+   assert np.array_equal(res, ref)
+
+# =========================================================
+@pytest.mark.parametrize('th', THRESHOLDS)
+@pytest.mark.parametrize('step', [3, 7, 13, 40])
+def test_shadow_windows(th, step):
+   merge = get_merge(120, 100)
+   win = 25
+   ref = shadow_ref(merge, win, np.r_[0:120-win+1:step], np.r_[0:100-win+1:step], th)
+   res = get_shadow_windows(merge, win, step, *th)
+   assert np.array_equal(res, ref)
+
+# =========================================================
+def test_shadow_windows_tiles():
+   # windows that do not overlap are the tiles of get_shadow_scores
+   merge = get_merge(230, 190)
+   for th in THRESHOLDS:
+      assert np.array_equal(get_shadow_windows(merge, 31, 31, *th), get_shadow_scores(merge, 31, *th))
+
+# =========================================================
+def test_small_windows():
+   merge = get_merge(40, 40)
+   assert np.array_equal(get_shadow_scores(merge, 5, *THRESHOLDS[0]), np.zeros((8, 8)))
+   assert np.shape(get_shadow_windows(merge, 50, 10, *THRESHOLDS[0])) == (0, 0)
+
+# =========================================================
+@pytest.mark.parametrize('win, step', [(10, 10), (10, 3), (7, 4), (9, 1)])
+def test_window_mask(win, step):
+   Ny, Nx = 37, 45
+   ny = len(np.r_[0:Ny-win+1:step])
+   nx = len(np.r_[0:Nx-win+1:step])
+   zmean = np.arange(ny*nx, dtype='float64').reshape(ny, nx)
+   M = get_window_mask(zmean, win, step, Ny, Nx)
+
+   # each pixel takes the value of the window whose centre is nearest
+   # (the later window, where two are equally near)
+   cy = np.r_[0:ny]*step + win//2
+   cx = np.r_[0:nx]*step + win//2
+   ref = np.empty((Ny, Nx))
+   for y in range(Ny):
+      for x in range(Nx):
+         iy = ny-1 - np.argmin(np.abs(y-cy)[::-1])
+         ix = nx-1 - np.argmin(np.abs(x-cx)[::-1])
+         ref[y,x] = zmean[iy,ix]
+   assert np.array_equal(M, ref)
+   assert np.array_equal(get_window_mask(zmean[:0], win, step, Ny, Nx), np.zeros((Ny, Nx)))
@@ -0,0 +1,69 @@
+"""
+tests for PyHum.tail, appending the pings of a synthetic SON file to scans
+already written as PyHum.read leaves them
+"""
+from __future__ import division
+
+import os, json
+import numpy as np
+import pytest
+
+import PyHum.io as io
+import PyHum.pyread_fast as pyread_fast
+from PyHum._pyhum_read import tail
+
+from test_pyread_fast import make_son, HUMFILE
+
+# =========================================================
+def get_pings(sonpath, npings):
+   '''
+   writes a SON file of npings down_lowfreq packets and returns their
+   offsets, and the scans pyread makes of all but the last
+   '''
+   sonfile = os.path.join(sonpath, 'B000.SON')
+   fields, payloads, offsets = make_son(sonfile, npings, beam=0)
+   return offsets, np.asarray(pyread_fast.pyread(sonfile, HUMFILE, 1450.0, 998).getpings()[0]).astype('int16')
+
+# =========================================================
+@pytest.mark.parametrize('compress', [False, 'zlib'])
+def test_tail_2d(tmpdir, compress):
+   sonpath = str(tmpdir)+os.sep
+   offsets, ref = get_pings(sonpath, 30)
+   # scans read as a single 2d array (chunkmode 4)
+   io.set_mmap_data(sonpath, 'test', '_data_dwnlow.dat', 'int16', ref[:20].T, compress=compress)
+
+   tail(HUMFILE, sonpath, poll=0.01, timeout=0.2, chunk=4, doplot=0)
+
+   # the array stays 2d, widened by whole chunks of pings
+   fp = io.get_mmap_data(sonpath, 'test', '_data_dwnlow.dat', 'int16')
+   assert np.shape(fp) == (100, 28)
+   assert np.array_equal(np.asarray(fp), ref[:28].T)
+   assert io.get_store_header(sonpath, 'test', '_data_dwnlow.dat')['chunks'] == 1
+   assert not os.path.isfile(os.path.join(sonpath, 'test_tmp_data_dwnlow.dat'))
+
+   # and following resumes from the first ping not appended
+   with open(os.path.join(sonpath, 'test_tail.json'), 'r') as ff:
+      assert json.load(ff)['B000.SON'] == offsets[28]
+
+# =========================================================
+def test_tail_chunks(tmpdir):
+   sonpath = str(tmpdir)+os.sep
+   offsets, ref = get_pings(sonpath, 35)
+   io.set_mmap_data(sonpath, 'test', '_data_dwnlow.dat', 'int16', np.asarray([ref[:10].T, ref[10:20].T]), compress=False)
+
+   # chunks are as wide as those already written, whatever chunk is
+   tail(HUMFILE, sonpath, poll=0.01, timeout=0.2, chunk=4, doplot=0)
+
+   fp = io.get_mmap_data(sonpath, 'test', '_data_dwnlow.dat', 'int16')
+   assert np.shape(fp) == (3, 100, 10)
+   assert np.array_equal(np.asarray(fp), np.asarray([ref[:10].T, ref[10:20].T, ref[20:30].T]))
+
+# =========================================================
+def test_extend(tmpdir):
+   sonpath = str(tmpdir)+os.sep
+   Z = np.arange(300, dtype='int16').reshape(10, 30)
+   assert io.set_mmap_extend(sonpath, 'x', '_data.dat', 'int16', Z[:, :12]) == (10, 12)
+   assert io.set_mmap_extend(sonpath, 'x', '_data.dat', 'int16', Z[:, 12:], blocksize=3) == (10, 30)
+   assert np.array_equal(np.asarray(io.get_mmap_data(sonpath, 'x', '_data.dat', 'int16')), Z)
+   with pytest.raises(ValueError):
+      io.set_mmap_extend(sonpath, 'x', '_data.dat', 'int16', Z[:5])
@@ -32,8 +32,10 @@ from sklearn.cluster import MiniBatchKMeans
 from scipy.interpolate import RectBivariateSpline
 import string, random
 from scipy.ndimage.filters import median_filter
+from skimage.restoration import denoise_tv_chambolle
 
 import dask.array as da
+from joblib import Parallel, delayed, cpu_count
 
 # suppress divide and invalid warnings
 np.seterr(all='ignore')
@@ -57,6 +59,82 @@ __all__ = [
 
 #################################################
 
+# =========================================================
+def iter_parallel(func, args, n_jobs=None):
+   '''
+   call func(*a) for each tuple a in args, n_jobs at a time in parallel,
+   and yield the results in order. Unlike a single call to Parallel, only
+   n_jobs results (e.g. processed chunks) are held in memory at once
+   '''
+   if n_jobs is None:
+      n_jobs = cpu_count()
+   batch = []
+   for a in args:
+      batch.append(a)
+      if len(batch)==n_jobs:
+         for r in Parallel(n_jobs = n_jobs, verbose=0)(delayed(func)(*b) for b in batch):
+            yield r
+         batch = []
+   if len(batch)>0:
+      for r in Parallel(n_jobs = n_jobs, verbose=0)(delayed(func)(*b) for b in batch):
+         yield r
+
+# =========================================================
+def get_tiles(n, tilesize, overlap):
+   '''
+   returns (start, end) of tiles of up to tilesize along an axis of length
+   n, each overlapping the next by overlap
+   '''
+   if n<=tilesize:
+      return [(0, n)]
+   step = tilesize - overlap
+   tiles = [(s, min(s+tilesize, n)) for s in range(0, n-overlap, step)]
+   if tiles[-1][1]<n:
+      tiles.append((n-tilesize, n))
+   return tiles
+
+# =========================================================
+def get_ramp(s, e, n, overlap):
+   '''
+   blending weights along one axis of a tile from s to e, rising over the
+   overlap at either end except at the ends of the array
+   '''
+   x = np.arange(e-s, dtype='float32')+1
+   w = np.ones(e-s, dtype='float32')
+   if s>0:
+      w = np.minimum(w, x/(overlap+1))
+   if e<n:
+      w = np.minimum(w, x[::-1]/(overlap+1))
+   return w
+
+# =========================================================
+def denoise_tile(im, weight):
+   return denoise_tv_chambolle(im, weight=weight, multichannel=False).astype('float32')
+
+# =========================================================
+def denoise_tv(im, weight, tilesize=1024, overlap=64, n_jobs=None):
+   '''
+   total variation denoising of im (as denoise_tv_chambolle) done in
+   overlapping tiles of tilesize x tilesize, n_jobs tiles at a time in
+   parallel. Tiles are blended linearly over the overlap. Only the output,
+   the blending weights and n_jobs tiles are held in memory at once
+   '''
+   im = np.asarray(im, dtype='float32')
+   rows, cols = np.shape(im)
+   tiles = [(r, c) for r in get_tiles(rows, tilesize, overlap) for c in get_tiles(cols, tilesize, overlap)]
+   if len(tiles)==1:
+      return denoise_tile(im.copy(), weight)
+
+   out = np.zeros((rows, cols), dtype='float32')
+   wsum = np.zeros((rows, cols), dtype='float32')
+   args = ((im[r[0]:r[1],c[0]:c[1]].copy(), weight) for r, c in tiles)
+   for (r, c), tile in zip(tiles, iter_parallel(denoise_tile, args, n_jobs)):
+      w = np.outer(get_ramp(r[0], r[1], rows, overlap), get_ramp(c[0], c[1], cols, overlap))
+      out[r[0]:r[1],c[0]:c[1]] += w*tile
+      wsum[r[0]:r[1],c[0]:c[1]] += w
+   out /= wsum
+   return out
+
 # =========================================================
 def auto_bedpick(ft, dep_m, chunkmode, port_fp, c):
     #buff = 50#10
@@ -419,16 +497,14 @@ def sliding_window(a,ws,ss = None,flatten = True):
 
    import PyHum.io as io
 
-   shape_tmp = io.set_mmap_data('', '', 'tmp.dat', 'float32', a)
+   # a raw scratch copy, so that it can be strided (whatever io.COMPRESS is)
+   shape_tmp = io.set_mmap_data('', '', 'tmp.dat', 'float32', a, compress=False)
    del a
    a = io.get_mmap_data('', '', 'tmp.dat', 'float32', shape_tmp)
 
    shap = np.array(a.shape)
 
-   try:
-      os.remove('tmp.dat')
-   except:
-      pass
+   io.del_mmap_data('', '', 'tmp.dat')
 
    # ensure that ws, ss, and a.shape all have the same number of dimensions
    ls = [len(shap),len(ws),len(ss)]